@@ -0,0 +1,279 @@
+import json
+import logging
+import os
+import struct
+from datetime import date, datetime
+
+import ffmpeg
+
+from hikload.video import concat_codecs, probe_video, remove_video
+
+logger = logging.getLogger('hikload')
+
+# The videos are remuxed into fragments that only depend on the ftyp and moov
+# boxes at the start of the archive, without the index at the end of the file
+FRAGMENT_FLAGS = "frag_keyframe+empty_moov+default_base_moof+skip_trailer"
+
+
+def _boxes(data: bytes, start: int = 0, end: int = None):
+    # Yields the (type, start, body start, end) of the boxes between start and end
+    end = len(data) if end is None else end
+    position = start
+    while position + 8 <= end:
+        size, kind = struct.unpack(">I4s", data[position:position + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[position + 8:position + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header:
+            raise ValueError("Invalid %s box at %s" % (kind, position))
+        yield kind.decode("latin-1"), position, position + header, position + size
+        position += size
+
+
+def _file_boxes(f):
+    # Yields the (type, start, end) of the top level boxes of a file, without reading them
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    position = 0
+    while position + 8 <= end:
+        f.seek(position)
+        header = f.read(16)
+        size, kind = struct.unpack(">I4s", header[:8])
+        if size == 1:
+            size = struct.unpack(">Q", header[8:16])[0]
+        elif size == 0:
+            size = end - position
+        if size < 8:
+            raise ValueError("Invalid %s box at %s" % (kind, position))
+        yield kind.decode("latin-1"), position, position + size
+        position += size
+
+
+def _child(data: bytes, start: int, end: int, path: str) -> tuple | None:
+    # Returns the (body start, end) of the box at the /-separated path inside a box
+    for name in path.split("/"):
+        for kind, _, body, box_end in _boxes(data, start, end):
+            if kind == name:
+                start, end = body, box_end
+                break
+        else:
+            return None
+    return start, end
+
+
+def track_descriptions(moov: bytes) -> dict:
+    """Returns the timescale and sample description of every track of a moov box,
+    by track ID. Fragments can only be appended after a moov with the same tracks"""
+    tracks = {}
+    for kind, _, body, end in _boxes(moov, 8):
+        if kind != "trak":
+            continue
+        tkhd = _child(moov, body, end, "tkhd")
+        mdhd = _child(moov, body, end, "mdia/mdhd")
+        stsd = _child(moov, body, end, "mdia/minf/stbl/stsd")
+        if None in (tkhd, mdhd, stsd):
+            raise ValueError("Incomplete track in moov")
+        # The version 1 boxes have 64 bit times before the ID and timescale
+        long = moov[tkhd[0]] == 1
+        track_id = struct.unpack(">I", moov[tkhd[0] + (20 if long else 12):][:4])[0]
+        long = moov[mdhd[0]] == 1
+        timescale = struct.unpack(">I", moov[mdhd[0] + (20 if long else 12):][:4])[0]
+        tracks[track_id] = (timescale, moov[stsd[0]:stsd[1]].hex())
+    return tracks
+
+
+def shift_fragment(moof: bytearray, offsets: dict, sequence: int):
+    """Moves a moof box `offsets` ticks later, by track ID, and renumbers it after the
+    `sequence` fragments already in the archive"""
+    for kind, _, body, end in _boxes(moof, 8):
+        if kind == "mfhd":
+            number = struct.unpack(">I", moof[body + 4:body + 8])[0]
+            struct.pack_into(">I", moof, body + 4, number + sequence)
+        elif kind == "traf":
+            tfhd = _child(moof, body, end, "tfhd")
+            tfdt = _child(moof, body, end, "tfdt")
+            if tfhd is None or tfdt is None:
+                raise ValueError("Fragment without tfhd or tfdt")
+            track_id = struct.unpack(">I", moof[tfhd[0] + 4:tfhd[0] + 8])[0]
+            if moof[tfdt[0]] == 1:
+                time = struct.unpack(">Q", moof[tfdt[0] + 4:tfdt[0] + 12])[0]
+                struct.pack_into(">Q", moof, tfdt[0] + 4, time + offsets[track_id])
+            else:
+                time = struct.unpack(">I", moof[tfdt[0] + 4:tfdt[0] + 8])[0] + offsets[track_id]
+                if time >= 2 ** 32:
+                    raise ValueError("The archive is too long for a 32 bit decode time")
+                struct.pack_into(">I", moof, tfdt[0] + 4, time)
+
+
+class ChannelArchive():
+    """This is a fragmented MP4 that only grows, holding the videos of a channel for a day.
+
+    Every appended video is remuxed into fragments, which are written after the ones
+    already in the archive with their times moved to the moment of the day the video
+    was recorded, so the existing data is never rewritten. A sidecar next to the archive
+    keeps its complete size, its end and the recordings appended to it, and is replaced
+    only after the fragments are written, so a crash in the middle of an append is undone
+    by cutting the archive back to the size in the sidecar.
+
+    Parameters:
+        path (str): The path of the archive
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state = {"size": 0, "end": 0.0, "fragments": 0, "tracks": None, "appended": []}
+        try:
+            with open(self.sidecar()) as f:
+                self.state.update(json.load(f))
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def latest(cls, folder: str, cid, day: date) -> "ChannelArchive":
+        """Returns the last archive of a channel for a day, which is a new one if there is none"""
+        part = 1
+        while os.path.exists(archive_name(folder, cid, day, part + 1) + ".json"):
+            part += 1
+        return cls(archive_name(folder, cid, day, part))
+
+    def sidecar(self) -> str:
+        return self.path + ".json"
+
+    def _save(self):
+        with open(self.sidecar() + ".tmp", "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.sidecar() + ".tmp", self.sidecar())
+
+    def append(self, filename: str, key: str, start: datetime, debug: bool = False) -> bool:
+        """Appends a video to the archive, at the moment of the day it starts or right after
+        the end of the archive if that is later. Returns False if the streams of the video
+        are not the same as the ones of the archive, so it needs a new archive
+
+        Parameters:
+            filename (str): The video
+            key (str): The recording of the video, which is not appended again
+            start (datetime): When the video starts
+            debug (bool): Enables debug logging (default is False)
+        """
+        probe = probe_video(filename)
+        fragments = self.path + ".append.tmp"
+        loglevel = [] if debug else ['-loglevel', 'error']
+        (
+            ffmpeg
+            .input(filename)
+            .output(fragments, f='mp4', movflags=FRAGMENT_FLAGS, **concat_codecs([probe], "mp4"))
+            .global_args(*loglevel)
+            .overwrite_output()
+            .run()
+        )
+        try:
+            with open(fragments, "rb") as source:
+                boxes = list(_file_boxes(source))
+                moov = next(((box_start, box_end) for kind, box_start, box_end in boxes if kind == "moov"), None)
+                if moov is None:
+                    raise ValueError("%s has no moov box" % fragments)
+                source.seek(0)
+                init = source.read(moov[1])
+                tracks = track_descriptions(init[moov[0]:moov[1]])
+                tracks = {str(track_id): track for track_id, track in tracks.items()}
+                if self.state["tracks"] is not None and tracks != {
+                        track_id: tuple(track) for track_id, track in self.state["tracks"].items()}:
+                    return False
+
+                midnight = datetime.combine(start.date(), datetime.min.time())
+                offset = max((start - midnight).total_seconds(), self.state["end"])
+                offsets = {int(track_id): round(offset * timescale) for track_id, (timescale, _) in tracks.items()}
+                appended = 0
+                with open(self.path, "r+b" if os.path.exists(self.path) else "wb") as archive:
+                    # Drop what a crashed append left after the complete fragments
+                    archive.truncate(self.state["size"])
+                    archive.seek(self.state["size"])
+                    if self.state["size"] == 0:
+                        archive.write(init)
+                    for kind, box_start, box_end in boxes:
+                        if box_start < moov[1]:
+                            continue
+                        source.seek(box_start)
+                        if kind == "moof":
+                            moof = bytearray(source.read(box_end - box_start))
+                            shift_fragment(moof, offsets, self.state["fragments"] + appended)
+                            archive.write(moof)
+                            appended += 1
+                        else:
+                            _copy(source, archive, box_end - box_start)
+                    archive.flush()
+                    os.fsync(archive.fileno())
+                    size = archive.tell()
+        finally:
+            os.remove(fragments)
+
+        self.state.update({
+            "size": size,
+            "end": offset + (probe["duration"] or 0),
+            "fragments": self.state["fragments"] + appended,
+            "tracks": tracks,
+            "appended": self.state["appended"] + [key],
+        })
+        self._save()
+        logger.debug("Appended %s to %s at %s seconds" % (filename, self.path, offset))
+        return True
+
+
+def _copy(source, destination, length: int, chunkSize: int = 1024 * 1024):
+    while length > 0:
+        chunk = source.read(min(chunkSize, length))
+        if not chunk:
+            raise ValueError("Unexpected end of %s" % source.name)
+        destination.write(chunk)
+        length -= len(chunk)
+
+
+def archive_name(folder: str, cid, day: date, part: int = 1) -> str:
+    """Returns the path of an archive of a channel for a day. A new part is started
+    when the streams of the channel change during the day"""
+    name = "%s-%s-archive" % (day.strftime("%Y%m%d"), cid)
+    if part > 1:
+        name += "-%d" % part
+    return os.path.join(os.path.abspath(folder), name + ".mp4")
+
+
+def archived_recordings(folder: str, cid, day: date) -> set:
+    """Returns the keys of the recordings already appended to the archives of a channel for a day"""
+    keys = set()
+    part = 1
+    while os.path.exists(archive_name(folder, cid, day, part) + ".json"):
+        keys.update(ChannelArchive(archive_name(folder, cid, day, part)).state["appended"])
+        part += 1
+    return keys
+
+
+def archive_channel_videos(channel_metadata: dict, cid, args, folder: str = None) -> list:
+    """Appends the downloaded videos of a channel to its archives, one for each day, and
+    removes them. Returns the archives that were appended to"""
+    folder = folder or os.getcwd()
+    archives = {}
+    videos = sorted(zip(channel_metadata["filenames"], channel_metadata["sources"], channel_metadata["starts"]),
+                    key=lambda video: video[2])
+    for filename, recordingobj, start in videos:
+        day = start.date()
+        if day not in archives:
+            archives[day] = ChannelArchive.latest(folder, cid, day)
+        archive = archives[day]
+        if recordingobj.url in archive.state["appended"]:
+            logger.debug("%s is already in %s" % (filename, archive.path))
+        elif not archive.append(filename, recordingobj.url, start, debug=args.debug):
+            part = 2
+            while os.path.exists(archive_name(folder, cid, day, part) + ".json"):
+                part += 1
+            logger.info("The streams of channel %s changed, starting %s" % (cid, archive_name(folder, cid, day, part)))
+            archive = archives[day] = ChannelArchive(archive_name(folder, cid, day, part))
+            archive.append(filename, recordingobj.url, start, debug=args.debug)
+        remove_video(filename)
+    for archive in archives.values():
+        logger.info("Archived the videos of channel %s in %s" % (cid, archive.path))
+    return [archive.path for archive in archives.values()]
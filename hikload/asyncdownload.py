@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import tqdm
+
+from hikload.download import (Recording, archived, bandwidth_limits, channel_bounds, channel_metadata,
+                              create_folder_and_chdir, download_window, in_timespan, inside_bounds,
+                              process_saved_video, recording_name, save_channel_results, search_interval,
+                              select_channels, video_filename, video_start, window_ignored)
+from hikload.hikvisionapi.classes import HikvisionException
+
+
+async def download_recording_async(server, args, recordingobj: Recording, original_path, postprocessing,
+                                   bounds=None) -> tuple:
+    """The asyncio version of _download_recording, which only downloads the recordings
+    directly. The videos are processed by ffmpeg in the `postprocessing` pool"""
+    if archived(args, recordingobj, original_path):
+        return None, False, None
+    name = recording_name(args, recordingobj, original_path)
+    filename = video_filename(args, name, recordingobj.cid)
+    if args.skipdownload:
+        logging.debug("Skipping download of %s" % recordingobj.url)
+        return filename, False, video_start(args, recordingobj, None)
+    start_time = time.perf_counter()
+    if args.photos:
+        downloadname = "%s.jpeg" % name
+    else:
+        downloadname = video_filename(args, name, recordingobj.cid, "mp4")
+    if args.skipexisting and os.path.exists(downloadname) and os.path.getsize(downloadname) > 0:
+        logging.debug(f"Skipping {downloadname} as it already exists")
+        return filename, False, video_start(args, recordingobj, None)
+    logging.debug("Started downloading %s" % downloadname)
+
+    window = None if args.photos else download_window(args, recordingobj, bounds)
+    bounded = False
+    ignored = False
+    skipSeconds, seconds = args.skipseconds, args.seconds
+    try:
+        if window is not None:
+            try:
+                await server.ContentMgmt.search.downloadURI(
+                    recordingobj.url, downloadname, chunkSize=args.chunksize, startTime=window[0], endTime=window[1])
+                ignored = await asyncio.get_running_loop().run_in_executor(
+                    postprocessing, window_ignored, downloadname, window)
+                if not ignored:
+                    bounded = True
+                    skipSeconds, seconds = None, None
+            except HikvisionException as e:
+                logging.debug("Could not download only a part of %s, downloading all of it: %s" % (filename, e))
+        if not bounded and not ignored:
+            await server.ContentMgmt.search.downloadURI(recordingobj.url, downloadname, chunkSize=args.chunksize)
+    except HikvisionException as e:
+        logging.error("Could not download %s" % downloadname)
+        logging.error(e)
+        return filename, bounded, video_start(args, recordingobj, window if bounded else None)
+    logging.info(f"Finished downloading {downloadname} in {time.perf_counter() - start_time:.2f} seconds")
+    if args.photos:
+        if os.environ.get('RUNNING_IN_DOCKER') == 'TRUE':
+            os.chmod(downloadname, 0o777)
+    else:
+        await asyncio.get_running_loop().run_in_executor(
+            postprocessing, process_saved_video, args, downloadname, filename, skipSeconds, seconds)
+    return filename, bounded or inside_bounds(recordingobj, bounds), \
+        video_start(args, recordingobj, window if bounded else None)
+
+
+async def download_channel_async(server, args, channel: dict, starttime: datetime, endtime: datetime,
+                                 original_path, postprocessing, workers: asyncio.Semaphore, progress_bar) -> dict:
+    """Downloads the recordings of a channel while they are still being searched for"""
+    cid, cname = channel['id'], channel['channelName']
+    bounds = channel_bounds(args, {"startTime": starttime, "endTime": endtime})
+    recordings = []
+    downloads = []
+
+    async def download(recordingobj):
+        async with workers:
+            result = await download_recording_async(server, args, recordingobj, original_path, postprocessing, bounds)
+        progress_bar.update()
+        return result
+
+    try:
+        if args.allrecordings:
+            matches = server.ContentMgmt.search.iterAllRecordingsForID(cid)
+        else:
+            matches = server.ContentMgmt.search.iterPastRecordingsForID(
+                cid, starttime.isoformat() + "Z", endtime.isoformat() + "Z")
+        async for match in matches:
+            rec = Recording.from_search_match(match, cid, cname)
+            if not in_timespan(args, rec):
+                continue
+            recordings.append(rec)
+            progress_bar.total += 1
+            progress_bar.refresh()
+            downloads.append(asyncio.create_task(download(rec)))
+    except HikvisionException as e:
+        logging.error("Could not get recordings for channel %s" % cid)
+        logging.error(e)
+    logging.info("Found %s recordings for channel %s" % (len(recordings), cid))
+
+    metadata = channel_metadata(starttime, endtime, recordings)
+    save_channel_results(metadata, await asyncio.gather(*downloads))
+    return metadata
+
+
+async def search_and_download_async(args) -> dict:
+    """The asyncio version of search_for_recordings and download_recordings.
+    All the channels are searched at the same time, and every recording is
+    downloaded as soon as it is found"""
+    try:
+        from hikload.hikvisionapi.aio import AsyncHikvisionServer
+    except ImportError as e:
+        logging.error(e)
+        raise HikvisionException("--asyncio requires httpx, install it with pip install hikload[async]")
+
+    if args.downloads:
+        create_folder_and_chdir(args.downloads)
+    original_path = os.path.abspath(os.getcwd())
+
+    async with AsyncHikvisionServer(
+            args.server, args.username, args.password, httptimeout=args.httptimeout,
+            poolsize=max(args.poolsize, args.workers, args.searchworkers),
+            maxconnections=args.maxconnections, retries=args.retries, retryBackoff=args.retrybackoff,
+            breakerThreshold=args.breakerthreshold, breakerTimeout=args.breakertimeout,
+            bandwidthLimits=bandwidth_limits(args)) as server:
+        await server.test_connection()
+        channelList = None
+        if not args.cameras:
+            try:
+                channelList = await server.Streaming.getChannels()
+            except HikvisionException as e:
+                logging.error(
+                    "Could not get channel list. If you still want to continue, add the argument --cameras with the channel ids you want to download.")
+                raise e
+        channels = select_channels(args, channelList)
+        starttime, endtime = search_interval(args)
+
+        logging.info("Downloading recordings...")
+        workers = asyncio.Semaphore(args.workers)
+        with tqdm.tqdm(total=0) as progress_bar, \
+                ThreadPoolExecutor(max_workers=args.ffmpegworkers) as postprocessing:
+            results = await asyncio.gather(*[
+                download_channel_async(server, args, channel, starttime, endtime, original_path,
+                                       postprocessing, workers, progress_bar)
+                for channel in channels])
+
+    downloadDict = {
+        "num_videos": sum(metadata["num_videos"] for metadata in results),
+        "num_channels": len(results),
+        "channels": {channel['id']: metadata for channel, metadata in zip(channels, results)},
+    }
+    return downloadDict
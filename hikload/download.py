@@ -1,49 +1,85 @@
 import argparse
+import asyncio
+import contextlib
 import logging
+import math
 import os
+import queue
 import re
+import threading
 import time
 from datetime import datetime, timedelta, timezone
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 import sys
 
 import ffmpeg
+import requests
 import tqdm
 from tqdm.contrib.logging import logging_redirect_tqdm
 
 import hikload.hikvisionapi as hikvisionapi
-from hikload.hikvisionapi.classes import HikvisionException
+from hikload.hikvisionapi._ContentMgmt import boundPlaybackURI
+from hikload.hikvisionapi.classes import AdaptiveLimiter, BandwidthLimiter, HikvisionException
 
-from hikload.video import concat_channel_videos, cut_video
+from hikload.journal import DownloadJournal
+from hikload.recordingindex import RecordingIndex
+from hikload.archive import archive_channel_videos, archived_recordings
+from hikload.video import concat_channel_videos, concat_videos, cut_video
 
 if sys.version_info < (3, 9):
     # This is a workaround for Python 3.8 and below not having the BooleanOptionalAction
     argparse.BooleanOptionalAction = "store_true"
 
 
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# Recordings are not split into --segments shorter than this
+MIN_SEGMENT = timedelta(minutes=1)
+# Seconds a downloaded window can be longer than asked for, because the DVR starts and ends
+# it at keyframes. A longer video means that the DVR sent all of the recording instead
+WINDOW_TOLERANCE = 10
+BANDWIDTH_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
 class Recording():
-    def __init__(self, cid, cname, url, startTime, endTime=None):
+    """A recording of a channel, with its timestamps already parsed"""
+    __slots__ = ("cid", "cname", "url", "startTime", "endTime", "contentType", "size")
+
+    def __init__(self, cid: str, cname: str, url: str, startTime: datetime, endTime: datetime | None = None,
+                 contentType: str = "video", size: int | None = None):
         self.cid = cid
         self.cname = cname
         self.url = url
         self.startTime = startTime
         self.endTime = endTime
+        self.contentType = contentType
+        self.size = size
 
-        if self.endTime is not None:
-            start = datetime.strptime(
-                self.startTime, "%Y-%m-%dT%H:%M:%SZ")
-            end = datetime.strptime(
-                self.endTime, "%Y-%m-%dT%H:%M:%SZ")
-            self.duration =  end - start
-        else:
-            self.duration = None
+    @classmethod
+    def from_search_match(cls, match: hikvisionapi.SearchMatch, cid: str, cname: str) -> "Recording":
+        size = re.search(r"[?&]size=(\d+)", match.playbackURI)
+        return cls(
+            cid=cid,
+            cname=cname,
+            url=match.playbackURI,
+            startTime=datetime.strptime(match.startTime, TIME_FORMAT),
+            endTime=datetime.strptime(match.endTime, TIME_FORMAT),
+            contentType=match.contentType,
+            size=int(size.group(1)) if size else None,
+        )
+
+    @property
+    def duration(self) -> timedelta | None:
+        if self.endTime is None:
+            return None
+        return self.endTime - self.startTime
 
     def __str__(self) -> str:
-        return "{}-{}".format(self.cname, self.startTime)
+        return "{}-{}".format(self.cname, self.startTime.strftime(TIME_FORMAT))
 
 
-def parse_args():
+def create_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description='Download Recordings from a HikVision server, from a range interval')
     parser.add_argument('--server', type=str, dest="server",
@@ -92,6 +128,11 @@ def parse_args():
                         help='enable ffmpeg and disable downloading directly from server')
     parser.add_argument('--forcetranscoding', dest="forcetranscoding", action=argparse.BooleanOptionalAction,
                         help='force transcoding if downloading directly from server')
+    parser.add_argument('--pipe', dest="pipe", action=argparse.BooleanOptionalAction,
+                        help='feed downloads directly into ffmpeg when they need processing, saving only the processed video')
+    parser.add_argument('--remux', dest="remux", action=argparse.BooleanOptionalAction,
+                        help='convert the downloads to proper MP4 files while downloading, in Python instead of ffmpeg. '
+                        'Only the video is kept. Other formats, --skipseconds and --seconds still use ffmpeg')
     parser.add_argument('--photos', dest="photos", action=argparse.BooleanOptionalAction,
                         help='enable experimental downloading of saved photos')
     parser.add_argument('--mock', dest="mock", action=argparse.BooleanOptionalAction,
@@ -102,41 +143,146 @@ def parse_args():
                         help='enable concatenating downloaded vides into one file (channel-wise)')
     parser.add_argument('--trim', dest="trim", action=argparse.BooleanOptionalAction,
                         help='enable triming of the concatenated video. Does work only with --concat enabled')
+    parser.add_argument('--exacttrim', dest="exacttrim", action=argparse.BooleanOptionalAction,
+                        help='with --trim, re-encode the frames between the start of the channel and the next '
+                        'keyframe, instead of starting the video at the keyframe before it')
+    parser.add_argument('--archive', dest="archive", action=argparse.BooleanOptionalAction,
+                        help='append the downloaded videos to one fragmented MP4 per channel and day, at the time '
+                        'of the day they were recorded, instead of concatenating them. Recordings already in '
+                        'the archive are not downloaded again')
     parser.add_argument('--httptimeout', dest="httptimeout", type=int,
                         help='HTTP requests will time out after a given seconds of server inactivity while waiting for an answer')
+    parser.add_argument('--retries', dest="retries", type=int, default=3,
+                        help='number of times a failed search or download is retried, or an interrupted download is resumed (default: 3)')
+    parser.add_argument('--retrybackoff', dest="retrybackoff", type=float, default=1.0,
+                        help='seconds waited before the first retry, doubled after every retry (default: 1)')
+    parser.add_argument('--breakerthreshold', dest="breakerthreshold", type=int, default=5,
+                        help='stop sending requests to the server for a while after X failed requests in a row, 0 to disable (default: 5)')
+    parser.add_argument('--breakertimeout', dest="breakertimeout", type=float, default=30.0,
+                        help='seconds the requests are stopped for after --breakerthreshold failed requests (default: 30)')
+    parser.add_argument('--bandwidth', dest="bandwidth", type=parse_bandwidth,
+                        help='maximum download speed from each server in bytes per second, with an optional K, M or G '
+                        'suffix, 0 for no limit. Can change during the day, like 08:00-18:00=2M,22:00-06:00=0,10M '
+                        '(default: no limit)')
+    parser.add_argument('--totalbandwidth', dest="totalbandwidth", type=parse_bandwidth,
+                        help='maximum download speed from all the servers of --fleet together, '
+                        'in the same format as --bandwidth (default: no limit)')
+    parser.add_argument('--chunksize', dest="chunksize", type=int, default=1024 * 1024,
+                        help='number of bytes written to disk at once while downloading (default: 1048576)')
+    parser.add_argument('--workers', dest="workers", type=int, default=1,
+                        help='number of recordings downloaded at the same time (default: 1)')
+    parser.add_argument('--segments', dest="segments", type=int, default=1,
+                        help='split each recording into X time slices downloaded at the same time (default: 1)')
+    parser.add_argument('--maxconnections', dest="maxconnections", type=int,
+                        help='maximum number of simultaneous downloads from the server (default: same as --workers)')
+    parser.add_argument('--adaptive', dest="adaptive", action=argparse.BooleanOptionalAction,
+                        help='adjust the number of downloads and searches sent at the same time to the server '
+                        'to its response times, errors and speed, up to --maxconnections and --poolsize')
+    parser.add_argument('--searchworkers', dest="searchworkers", type=int, default=4,
+                        help='number of searches sent to the server at the same time (default: 4)')
+    parser.add_argument('--searchshard', dest="searchshard", type=int, default=24,
+                        help='split the searched interval into shards of X hours searched in parallel (default: 24)')
+    parser.add_argument('--index', dest="index", type=str,
+                        help='keep a local index of the recordings in this SQLite file and only search the server for new ones')
+    parser.add_argument('--concatworkers', dest="concatworkers", type=int, default=4,
+                        help='maximum number of channels concatenated at the same time. The videos are copied '
+                        'without re-encoding, so this is limited by the disk rather than the CPU: it starts at one '
+                        'channel and only grows while the channels are copied as fast (default: 4)')
+    parser.add_argument('--ffmpegworkers', dest="ffmpegworkers", type=int, default=os.cpu_count() or 1,
+                        help='number of recordings processed by ffmpeg at the same time (default: number of CPUs)')
+    parser.add_argument('--poolsize', dest="poolsize", type=int, default=10,
+                        help='maximum number of keep-alive HTTP connections kept open to the server (default: 10)')
+    parser.add_argument('--asyncio', dest="asyncio", action=argparse.BooleanOptionalAction,
+                        help='search and download with asyncio, starting the downloads while searching. '
+                        'Requires httpx, and does not support --ffmpeg, --frames, --pipe, --remux, --segments, --index and --journal')
+    parser.add_argument('--pipeline', dest="pipeline", action=argparse.BooleanOptionalAction,
+                        help='download the recordings while the channels are still searched, and concatenate every '
+                        'channel as soon as its recordings are ready. Does not support --asyncio, --index and --mock')
+    parser.add_argument('--queuesize', dest="queuesize", type=int,
+                        help='maximum number of recordings found by --pipeline that wait to be downloaded '
+                        '(default: twice --workers)')
     parser.add_argument('--ui', dest="ui", action=argparse.BooleanOptionalAction,
                         # If running under PyInstaller, use the UI
                         default=bool(getattr(sys, 'frozen', False)),
                         help='enable UI interface WARNING! Requires Qt5 to be installed')
     parser.add_argument('--skipexisting', dest="skipexisting", action=argparse.BooleanOptionalAction,
                         help='Skip dowloading files those already exist in the destination dir. Won\'t skip files that need preprocessing')
-    args = parser.parse_args()
+    parser.add_argument('--journal', dest="journal", action=argparse.BooleanOptionalAction,
+                        help='keep a journal of the saved files in the downloads folder, and skip the downloads, '
+                        'processed videos and concatenated channels that are still complete when running again')
+    parser.add_argument('--verify', dest="verify", action=argparse.BooleanOptionalAction,
+                        help='compare the checksums of the files in --journal before skipping them')
+    parser.add_argument('--fleet', dest="fleet", type=str,
+                        help='download from all the servers listed in this JSON file at the same time, '
+                        'sharing --workers and --ffmpegworkers between them')
+    return parser
+
+
+def parse_bandwidth(text: str) -> tuple:
+    """Parses a --bandwidth value into the rate and schedule of a BandwidthLimiter"""
+    rate = None
+    schedule = []
+    for item in text.split(","):
+        match = re.fullmatch(r"\s*(?:(\d{1,2}:\d{2})-(\d{1,2}:\d{2})=)?(\d+(?:\.\d+)?)([KMG]?)\s*",
+                             item, re.IGNORECASE)
+        if match is None:
+            raise argparse.ArgumentTypeError("invalid bandwidth %r, expected a rate like 2M or "
+                                             "a time window like 08:00-18:00=2M" % item)
+        start, end, number, unit = match.groups()
+        value = int(float(number) * BANDWIDTH_UNITS[unit.upper()]) or None
+        if start is None:
+            rate = value
+            continue
+        try:
+            schedule.append((datetime.strptime(start, "%H:%M").time(), datetime.strptime(end, "%H:%M").time(), value))
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid time window %r" % item)
+    return rate, schedule
+
+
+def parse_args(argv=None):
+    args = create_parser().parse_args(argv)
     return args
 
 
-def create_folder_and_chdir(dir):
-    path = str(dir)
+def create_folder(dir):
+    path = os.path.normpath(str(dir))
     if not os.path.exists(path):
-        os.makedirs(os.path.normpath(path))
+        # Another worker could create the same folder at the same time
+        os.makedirs(path, exist_ok=True)
         logging.debug("Created folder %s" % path)
     else:
         logging.debug("Folder %s already exists" % path)
     if os.environ.get('RUNNING_IN_DOCKER') == 'TRUE':
-        os.chmod(os.path.normpath(path), 0o777)
-    os.chdir(os.path.normpath(path))
+        os.chmod(path, 0o777)
+    return path
+
+
+def create_folder_and_chdir(dir):
+    os.chdir(create_folder(dir))
 
 
-def photo_download_from_channel(server: hikvisionapi.HikvisionServer, args, url, filename, cid):
+def photo_download_from_channel(server: hikvisionapi.HikvisionServer, args, url, filename, cid, journal=None):
     start_time = time.perf_counter()
     name = "%s.jpeg" % filename
     if args.skipexisting and os.path.exists(name) and os.path.getsize(name) > 0:
         logging.debug(f"Skipping {name} as it already exists")
         return
+    if journal is not None and journal.verified(url, "download", name, args.verify):
+        logging.debug(f"Skipping {name} as it was already downloaded")
+        return
     logging.debug("Started downloading %s" % name)
     logging.debug(
         "Files to download: (url: %r, name: %r)" % (url, name))
-    r = server.ContentMgmt.search.downloadURI(url)
-    open(name, 'wb').write(r.content)
+    checksum = hikvisionapi.Checksum() if journal is not None else None
+    try:
+        server.ContentMgmt.search.downloadURI(url, name, chunkSize=args.chunksize, checksum=checksum)
+    except HikvisionException as e:
+        logging.error("Could not download %s" % name)
+        logging.error(e)
+        return
+    if journal is not None:
+        journal.record(url, "download", name, url, checksum=checksum.hexdigest())
     if os.environ.get('RUNNING_IN_DOCKER') == 'TRUE':
         os.chmod(name, 0o777)
     end_time = time.perf_counter()
@@ -144,12 +290,74 @@ def photo_download_from_channel(server: hikvisionapi.HikvisionServer, args, url,
     logging.info(f"Finished downloading {name} in {run_time:.2f} seconds")
 
 
-def video_download_from_channel(server: hikvisionapi.HikvisionServer, args, url, filename, cid):
+def log_download_error(server: hikvisionapi.HikvisionServer, name, e):
+    try:
+        supports = server.ContentMgmt.search.get_download_capabilities()
+        logging.debug(f'Device capabilities: {supports}')
+        if supports['DownloadAbility']['isSupportDownloadbyFileName'] == 'false':
+            logging.error(
+                "Downloading by file name is not supported for this device.")
+            logging.error(
+                "Try to add --ffmpeg to force recording the videos.")
+            logging.error(e)
+            return
+        if supports['DownloadAbility']['isSupportDownloadbyTime'] == 'false':
+            logging.error(
+                "Downloading by time is not supported for this device.")
+            logging.error(
+                "Try to add --ffmpeg to force recording the videos.")
+            logging.error(e)
+            return
+    except (HikvisionException, TypeError) as e:
+        logging.error(
+            "Could not get download capabilities. The device dosen't seem to support getting capabilities.")
+        logging.error(
+            "Try to add --ffmpeg to force recording the videos.")
+        logging.error(e)
+        return
+    logging.error(
+        "Could not download %s. Try to add --ffmpeg." % name)
+    logging.error(e)
+
+
+def process_saved_video(args, temporaryname, name, skipSeconds, seconds, saved=None):
+    """Processes a downloaded video with ffmpeg if needed, and calls `saved`
+    once the video is saved as `name`"""
+    try:
+        hikvisionapi.processSavedVideo(
+            temporaryname, debug=args.debug, skipSeconds=skipSeconds, seconds=seconds,
+            fileFormat=args.videoformat, forceTranscode=args.forcetranscoding)
+    except ffmpeg.Error as e:
+        logging.error(
+            "Could not transcode %s. Try to remove --forcetranscoding." % name)
+        logging.error(e)
+        return
+    if temporaryname != name and os.path.exists(temporaryname):
+        # processSavedVideo keeps the .mp4 name, even for other formats
+        os.replace(temporaryname, name)
+    if os.environ.get('RUNNING_IN_DOCKER') == 'TRUE' and os.path.exists(name):
+        os.chmod(name, 0o777)
+    if saved is not None:
+        saved()
+
+
+def log_processing_error(future, name):
+    """Logs the exceptions that process_saved_video does not handle itself, which
+    would otherwise be lost in the ffmpeg pool"""
+    if future.cancelled() or future.exception() is None:
+        return
+    logging.error("Could not save %s" % name)
+    logging.error(repr(future.exception()))
+
+
+def video_download_from_channel(server: hikvisionapi.HikvisionServer, args, url, filename, cid, postprocessing=None, window=None,
+                                journal=None, duration=None):
+    """Downloads a video and returns True if only the `window` (startTime, endTime)
+    of it was downloaded, instead of the whole recording. The saved files are
+    recorded in the `journal` with the `duration` of the recording, if given"""
     start_time = time.perf_counter()
-    if args.folders:
-        name = "%s.%s" % (filename, args.videoformat)
-    else:
-        name = "%s-%s.%s" % (filename, cid, args.videoformat)
+    bounded = False
+    name = video_filename(args, filename, cid)
     logging.debug("Started downloading %s" % name)
     logging.debug(
         "Files to download: (url: %r, name: %r)" % (url, name))
@@ -163,6 +371,9 @@ def video_download_from_channel(server: hikvisionapi.HikvisionServer, args, url,
             logging.error(
                 "Could not download %s. Try to remove --frames." % name)
             logging.error(e)
+    processing = hikvisionapi.needsProcessing(
+        seconds=args.seconds, skipSeconds=args.skipseconds,
+        fileFormat=args.videoformat, forceTranscode=args.forcetranscoding)
     if args.ffmpeg:
         try:
             url = url.replace(server.host, server.address(
@@ -173,65 +384,242 @@ def video_download_from_channel(server: hikvisionapi.HikvisionServer, args, url,
             logging.error(
                 "Could not download %s. Try to remove --fmpeg." % name)
             logging.error(e)
-    else:
-        if args.folders:
-            temporaryname = "%s.mp4" % filename
-        else:
-            temporaryname = "%s-%s.mp4" % (filename, cid)
-        
-        if args.skipexisting and os.path.exists(temporaryname) and os.path.getsize(temporaryname) > 0:
-            logging.debug(f"Skipping {temporaryname} as it already exists")
-            return
+    elif args.pipe and processing or args.remux and not processing:
+        if args.skipexisting and os.path.exists(name) and os.path.getsize(name) > 0:
+            logging.debug(f"Skipping {name} as it already exists")
+            return bounded
+        journaled = journal.verified(url, "video", name, args.verify) if journal is not None else None
+        if journaled is not None:
+            logging.debug(f"Skipping {name} as it was already saved")
+            return journaled.source != url
         try:
-            r = server.ContentMgmt.search.downloadURI(url)
-        except hikvisionapi.HikvisionError as e:
-            try:
-                supports = server.ContentMgmt.search.get_download_capabilities()
-                logging.debug(f'Device capabilities: {supports}')
-                if supports['DownloadAbility']['isSupportDownloadbyFileName'] == 'false':
-                    logging.error(
-                        "Downloading by file name is not supported for this device.")
-                    logging.error(
-                        "Try to add --ffmpeg to force recording the videos.")
-                    logging.error(e)
-                    return
-                if supports['DownloadAbility']['isSupportDownloadbyTime'] == 'false':
-                    logging.error(
-                        "Downloading by time is not supported for this device.")
-                    logging.error(
-                        "Try to add --ffmpeg to force recording the videos.")
-                    logging.error(e)
-                    return
-            except (hikvisionapi.HikvisionError, TypeError) as e:
-                logging.error(
-                    "Could not get download capabilities. The device dosen't seem to support getting capabilities.")
-                logging.error(
-                    "Try to add --ffmpeg to force recording the videos.")
-                logging.error(e)
-                return
+            if window is not None:
+                try:
+                    stream_video(args, server.ContentMgmt.search.iterDownloadURI(
+                        url, chunkSize=args.chunksize, startTime=window[0], endTime=window[1]), name, None, None)
+                    bounded = True
+                    if window_ignored(name, window):
+                        # The video is trimmed by ffmpeg after all
+                        bounded = False
+                        hikvisionapi.processSavedVideo(
+                            name, debug=args.debug, skipSeconds=args.skipseconds, seconds=args.seconds,
+                            fileFormat=args.videoformat)
+                except HikvisionException as e:
+                    logging.debug("Could not download only a part of %s, downloading all of it: %s" % (name, e))
+            if not bounded:
+                stream_video(args, server.ContentMgmt.search.iterDownloadURI(url, chunkSize=args.chunksize), name,
+                             args.skipseconds, args.seconds)
+        except HikvisionException as e:
+            log_download_error(server, name, e)
+            return bounded
+        except ffmpeg.Error as e:
             logging.error(
-                "Could not download %s. Try to add --ffmpeg." % name)
+                "Could not transcode %s. Try to remove --pipe." % name)
             logging.error(e)
-            return
-        open(temporaryname, 'wb').write(r.content)
-        try:
-            logging.info(args)
-            hikvisionapi.processSavedVideo(
-                temporaryname, debug=args.debug, skipSeconds=args.skipseconds, seconds=args.seconds,
-                fileFormat=args.videoformat, forceTranscode=args.forcetranscoding)
-        except ffmpeg.Error as e:
+            return bounded
+        except hikvisionapi.RemuxError as e:
             logging.error(
-                "Could not transcode %s. Try to remove --forcetranscoding." % name)
+                "Could not remux %s. Try to remove --remux." % name)
             logging.error(e)
+            return bounded
+        if journal is not None:
+            if bounded:
+                journal.record(url, "video", name, boundPlaybackURI(url, *window), window[1] - window[0])
+            else:
+                journal.record(url, "video", name, url, video_duration(duration, args.skipseconds, args.seconds))
+    else:
+        temporaryname = video_filename(args, filename, cid, "mp4")
+
+        if args.skipexisting and os.path.exists(temporaryname) and os.path.getsize(temporaryname) > 0:
+            logging.debug(f"Skipping {temporaryname} as it already exists")
+            return bounded
+        journaled = journal.verified(url, "video", name, args.verify) if journal is not None else None
+        if journaled is not None:
+            logging.debug(f"Skipping {name} as it was already saved")
+            return journaled.source != url
+        skipSeconds, seconds = args.skipseconds, args.seconds
+        downloaded = journal.verified(url, "download", temporaryname, args.verify) if journal is not None else None
+        if downloaded is not None:
+            # Only the processing of the video was interrupted
+            logging.debug(f"Skipping the download of {temporaryname} as it was already downloaded")
+            bounded = downloaded.source != url
+        else:
+            checksum = None
+            ignored = False
+            try:
+                if window is not None:
+                    try:
+                        checksum = hikvisionapi.Checksum() if journal is not None else None
+                        if not download_segments(server, args, url, temporaryname, window):
+                            server.ContentMgmt.search.downloadURI(
+                                url, temporaryname, chunkSize=args.chunksize, startTime=window[0], endTime=window[1],
+                                checksum=checksum)
+                        else:
+                            # The joined segments were not streamed
+                            checksum = None
+                        # The trim is only dropped if the DVR really sent the window
+                        ignored = window_ignored(temporaryname, window)
+                        bounded = not ignored
+                    except HikvisionException as e:
+                        logging.debug("Could not download only a part of %s, downloading all of it: %s" % (name, e))
+                if not bounded and not ignored:
+                    checksum = hikvisionapi.Checksum() if journal is not None else None
+                    server.ContentMgmt.search.downloadURI(
+                        url, temporaryname, chunkSize=args.chunksize, checksum=checksum)
+            except HikvisionException as e:
+                log_download_error(server, name, e)
+                return bounded
+            if journal is not None:
+                downloaded = journal.record(
+                    url, "download", temporaryname, boundPlaybackURI(url, *window) if bounded else url,
+                    window[1] - window[0] if bounded else duration,
+                    checksum.hexdigest() if checksum is not None else None)
+        if bounded:
+            # Only the needed part was downloaded, so there is nothing left to cut
+            skipSeconds, seconds = None, None
+        saved = None
+        if journal is not None:
+            unchanged = temporaryname == name and not hikvisionapi.needsProcessing(
+                seconds=seconds, skipSeconds=skipSeconds, fileFormat=args.videoformat,
+                forceTranscode=args.forcetranscoding)
+
+            def saved():
+                journal.record(url, "video", name, downloaded.source,
+                               video_duration(downloaded.duration, skipSeconds, seconds),
+                               downloaded.checksum if unchanged else None)
+        if postprocessing is not None:
+            # Keep downloading while ffmpeg processes this recording
+            future = postprocessing.submit(
+                process_saved_video, args, temporaryname, name, skipSeconds, seconds, saved)
+            future.add_done_callback(lambda future: log_processing_error(future, name))
+            logging.info(f"Finished downloading {name} in {time.perf_counter() - start_time:.2f} seconds")
+            return bounded
+        process_saved_video(args, temporaryname, name, skipSeconds, seconds, saved)
     if os.environ.get('RUNNING_IN_DOCKER') == 'TRUE':
         os.chmod(name, 0o777)
     end_time = time.perf_counter()
     run_time = end_time - start_time
     logging.info(f"Finished downloading {name} in {run_time:.2f} seconds")
+    return bounded
 
 
-def search_for_recordings(server: hikvisionapi.HikvisionServer, args) -> dict:
-    start_time = time.perf_counter()
+def stream_video(args, chunks, name, skipSeconds, seconds):
+    """Saves a video while it is downloaded, with --remux if it only needs to be
+    put in an MP4 file, or with ffmpeg otherwise"""
+    if args.remux and not hikvisionapi.needsProcessing(
+            seconds=seconds, skipSeconds=skipSeconds, fileFormat=args.videoformat,
+            forceTranscode=args.forcetranscoding):
+        hikvisionapi.remuxVideoStream(chunks, name)
+    else:
+        hikvisionapi.processVideoStream(
+            chunks, name, debug=args.debug, skipSeconds=skipSeconds, seconds=seconds, fileFormat=args.videoformat)
+
+
+def video_duration(duration: timedelta | None, skipSeconds: int | None, seconds: int | None) -> timedelta | None:
+    """Returns the duration of the video saved from a recording of the given duration.
+    Like processSavedVideo, the recording is cut to `seconds` before `skipSeconds` are skipped"""
+    if duration is None:
+        return None
+    if seconds:
+        duration = min(duration, timedelta(seconds=seconds))
+    if skipSeconds:
+        duration -= timedelta(seconds=skipSeconds)
+    return max(duration, timedelta(0))
+
+
+def download_segments(server: hikvisionapi.HikvisionServer, args, url, filename, window) -> bool:
+    """Downloads the window of a recording as --segments time slices at the same time and
+    joins them into filename. Returns False if the recording was not split"""
+    start, end = window
+    shard = max((end - start) / args.segments, MIN_SEGMENT)
+    slices = split_time_range(start, end, timedelta(seconds=math.ceil(shard.total_seconds())))
+    if args.segments <= 1 or len(slices) < 2:
+        return False
+    names = ["%s.%d" % (filename, i) for i in range(len(slices))]
+    logging.debug("Downloading %s in %s segments" % (filename, len(slices)))
+    try:
+        with ThreadPoolExecutor(max_workers=len(slices)) as executor:
+            futures = [executor.submit(server.ContentMgmt.search.downloadURI, url, name, chunkSize=args.chunksize,
+                                       startTime=slice_start, endTime=slice_end)
+                       for name, (slice_start, slice_end) in zip(names, slices)]
+            for future in futures:
+                future.result()
+        if window_ignored(names[0], slices[0]):
+            raise HikvisionException("The DVR sent all of the recording for every segment")
+        try:
+            concat_videos(names, filename, debug=args.debug)
+        except ffmpeg.Error as e:
+            logging.error("Could not join the segments of %s, downloading it at once" % filename)
+            logging.error(e)
+            return False
+    finally:
+        # The segments of a failed download are not resumed, the recording is downloaded at once instead
+        for name in names:
+            for leftover in (name, name + ".part", name + ".part.json"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+    return True
+
+
+def window_ignored(filename, window) -> bool:
+    """Returns True if the video downloaded for the (startTime, endTime) `window` of a
+    recording is longer than the window, because the DVR ignored the times of the
+    playbackURI and sent all of the recording"""
+    try:
+        duration = ffmpeg.probe(filename).get("format", {}).get("duration")
+    except ffmpeg.Error as e:
+        logging.debug("Could not check the duration of %s: %s" % (filename, e))
+        return False
+    if duration in (None, "N/A"):
+        return False
+    expected = (window[1] - window[0]).total_seconds()
+    if float(duration) <= expected + max(WINDOW_TOLERANCE, expected / 10):
+        return False
+    logging.warning("The DVR sent %.0f seconds of %s instead of only %.0f, trimming it with ffmpeg" % (
+        float(duration), filename, expected))
+    return True
+
+
+def download_window(args, recordingobj: Recording, bounds: tuple = None) -> tuple | None:
+    """Returns the (startTime, endTime) part of the recording that is needed, considering
+    --skipseconds, --seconds and the `bounds` of the channel, or None if all of it is needed
+    and it is not split into --segments"""
+    if args.ffmpeg or args.frames or recordingobj.endTime is None:
+        return None
+    start, end = recordingobj.startTime, recordingobj.endTime
+    if args.seconds:
+        end = min(end, recordingobj.startTime + timedelta(seconds=args.seconds))
+    if args.skipseconds:
+        start = start + timedelta(seconds=args.skipseconds)
+    if bounds is not None:
+        start, end = max(start, bounds[0]), min(end, bounds[1])
+    if start >= end or (start, end) == (recordingobj.startTime, recordingobj.endTime) and args.segments <= 1:
+        return None
+    return start, end
+
+
+def split_time_range(starttime: datetime, endtime: datetime, shard: timedelta) -> List[tuple]:
+    """Splits the interval between starttime and endtime into consecutive shards"""
+    shards = []
+    while starttime < endtime:
+        shards.append((starttime, min(starttime + shard, endtime)))
+        starttime += shard
+    return shards or [(starttime, endtime)]
+
+
+def merge_search_results(results: List[List[hikvisionapi.SearchMatch]]) -> List[hikvisionapi.SearchMatch]:
+    """Returns the recordings found by multiple searches in time order,
+    without the recordings that were found by more than one search"""
+    recordings = {}
+    for result in results:
+        for match in result:
+            recordings.setdefault(match.playbackURI, match)
+    return sorted(recordings.values(), key=lambda match: match.startTime)
+
+
+def select_channels(args, channelList: dict = None) -> List[dict]:
+    """Returns the channels given with --cameras, or the main streams from the
+    channel list of the server"""
     channelids = []
     channels = []
     if args.cameras:
@@ -241,21 +629,101 @@ def search_for_recordings(server: hikvisionapi.HikvisionServer, args) -> dict:
                 'id': str(cid),
                 'channelName': str(cid),
             })
+        return channels
+    for channel in channelList['StreamingChannelList']['StreamingChannel']:
+        if (int(channel['id']) % 10 == 1):
+            if args.photos:
+                # Force looking at the hidden 103 channel for the photos
+                channel['id'] = str(int(channel['id'])+2)
+            channelids.append(channel['id'])
+            channels.append(channel)
+        logging.info("Found channels %s" % channelids)
+    return channels
+
+
+def search_interval(args) -> tuple:
+    """Returns the start and end times of the recordings that are searched"""
+    if args.days:
+        endtime = datetime.now().replace(
+            hour=23, minute=59, second=59, microsecond=0)
+        starttime = endtime - timedelta(days=args.days)
+    elif args.yesterday:
+        endtime = datetime.now().replace(
+            hour=23, minute=59, second=59, microsecond=0) - timedelta(days=1)
+        starttime = endtime - timedelta(days=1)
     else:
+        starttime = args.starttime
+        endtime = args.endtime
+
+    logging.debug("Using %s and %s as start and end times" %
+                  (starttime.isoformat() + "Z", endtime.isoformat() + "Z"))
+    return starttime, endtime
+
+
+def in_timespan(args, recordingobj: Recording) -> bool:
+    return not (recordingobj.endTime < args.starttime or recordingobj.startTime > args.endtime)
+
+
+def channel_metadata(starttime: datetime, endtime: datetime, recordings: List[Recording]) -> dict:
+    """Returns the data structure kept for a channel with the given recordings"""
+    return {
+        "num_videos": len(recordings),
+        "filenames": [],
+        "sources": [],
+        "starts": [],
+        "duration": endtime - starttime,
+        "startTime": starttime,
+        "endTime": endtime,
+        "minStartTime": recordings[0].startTime if recordings else None,
+        "recordings": recordings,
+    }
+
+
+def search_for_recordings(server: hikvisionapi.HikvisionServer, args) -> dict:
+    start_time = time.perf_counter()
+    channelList = None
+    if not args.cameras:
         try:
             channelList = server.Streaming.getChannels()
-            for channel in channelList['StreamingChannelList']['StreamingChannel']:
-                if (int(channel['id']) % 10 == 1):
-                    if args.photos:
-                        # Force looking at the hidden 103 channel for the photos
-                        channel['id'] = str(int(channel['id'])+2)
-                    channelids.append(channel['id'])
-                    channels.append(channel)
-                logging.info("Found channels %s" % channelids)
         except HikvisionException as e:
             logging.error(
                 "Could not get channel list. If you still want to continue, add the argument --cameras with the channel ids you want to download.")
             raise e
+    channels = select_channels(args, channelList)
+    starttime, endtime = search_interval(args)
+
+    # The server also returns the recordings that only overlap the interval,
+    # so there is no need to search around it for --concat
+    search_start = starttime
+    search_end = endtime
+
+    index = None
+    sync_starts = {}
+    if args.index:
+        index = RecordingIndex(args.index)
+        for channel in channels:
+            sync_starts[channel['id']] = index.sync_start(server.host, channel['id'])
+
+    # Search all the channels and time shards at once
+    searches = {}
+    with ThreadPoolExecutor(max_workers=args.searchworkers) as executor:
+        for channel in channels:
+            cid = channel['id']
+            if index is not None and sync_starts[cid] is not None:
+                # Only search for the recordings made since the last sync
+                searches[cid] = [executor.submit(
+                    list, server.ContentMgmt.search.iterPastRecordingsForID(
+                        cid, sync_starts[cid].strftime("%Y-%m-%dT%H:%M:%SZ"), "2037-10-10T23:59:59Z"))]
+            elif args.allrecordings or index is not None:
+                searches[cid] = [executor.submit(
+                    list, server.ContentMgmt.search.iterAllRecordingsForID(cid))]
+            else:
+                searches[cid] = [
+                    executor.submit(list, server.ContentMgmt.search.iterPastRecordingsForID(
+                        cid, shard_start.isoformat() + "Z", shard_end.isoformat() + "Z"))
+                    for shard_start, shard_end in split_time_range(
+                        search_start, search_end, timedelta(hours=args.searchshard))
+                ]
 
     downloadDict = {
         "num_videos": 0,
@@ -265,104 +733,57 @@ def search_for_recordings(server: hikvisionapi.HikvisionServer, args) -> dict:
     for channel in channels:
         cname = channel['channelName']
         cid = channel['id']
-        if args.days:
-            endtime = datetime.now().replace(
-                hour=23, minute=59, second=59, microsecond=0)
-            starttime = endtime - timedelta(days=args.days)
-        elif args.yesterday:
-            endtime = datetime.now().replace(
-                hour=23, minute=59, second=59, microsecond=0) - timedelta(days=1)
-            starttime = endtime - timedelta(days=1)
-        else:
-            starttime = args.starttime
-            endtime = args.endtime
-
-        logging.debug("Using %s and %s as start and end times" %
-                      (starttime.isoformat() + "Z", endtime.isoformat() + "Z"))
 
         try:
-            if args.allrecordings:
-                recordings = server.ContentMgmt.search.getAllRecordingsForID(
-                    cid)
-                logging.info("There are %s recordings in total for channel %s" %
-                             (recordings['CMSearchResult']['numOfMatches'], cid))
-            else:
-               
-                if args.concat:
-                    # List recordings around given time to estimate true duration
-                    # Would break if one recording is longer than a day. Could be solved
-                    # by listing all recordings but that takes a lot of time.
-                    earlier_start = starttime - timedelta(days=1)
-                    later_end = endtime + timedelta(days=1)
-                    recordings = server.ContentMgmt.search.getPastRecordingsForID(
-                        cid, earlier_start.isoformat() + "Z", later_end.isoformat() + "Z")
-                else:
-                    recordings = server.ContentMgmt.search.getPastRecordingsForID(
-                        cid, starttime.isoformat() + "Z", endtime.isoformat() + "Z")
-
-                logging.info("Found %s recordings for channel %s" %
-                             (recordings['CMSearchResult']['numOfMatches'], cid))
+            recordinglist = merge_search_results(
+                [search.result() for search in searches[cid]])
         except hikvisionapi.classes.HikvisionException as e:
             logging.error("Could not get recordings for channel %s" % cid)
             logging.error(e)
-            continue
-        
-        # This loops from every recording
-        if recordings['CMSearchResult']['numOfMatches'] != "0":
-            recordinglist = recordings['CMSearchResult']['matchList']['searchMatchItem']
+            if index is None:
+                continue
+            logging.error("Using the recordings already indexed for channel %s" % cid)
+            recordinglist = None
+        if index is not None:
+            if recordinglist is not None:
+                index.update(server.host, cid, sync_starts[cid], recordinglist)
+            if args.allrecordings:
+                recordinglist = index.query(server.host, cid)
+            else:
+                recordinglist = index.query(
+                    server.host, cid, search_start.isoformat() + "Z", search_end.isoformat() + "Z")
+        if args.allrecordings:
+            logging.info("There are %s recordings in total for channel %s" %
+                         (len(recordinglist), cid))
         else:
-            recordinglist = []
-        # In case there is only one recording, we need to make it a list
-        if type(recordinglist) is not list:
-            recordinglist = [recordinglist]
-        
-        # Prepare data structure for the channel
-        downloadDict["channels"][cid] = {
-            "num_videos": 0,
-            "filenames": [],
-            "duration": endtime - starttime,
-            "startTime": starttime.isoformat() + "Z",
-            "endTime": endtime.isoformat() + "Z",
-            "minStartTime": None,
-            "recordings": [],
-        }
+            logging.info("Found %s recordings for channel %s" %
+                         (len(recordinglist), cid))
 
         result = []
         for i in recordinglist:
+            rec = Recording.from_search_match(i, cid, cname)
 
             # Check if the recoding is in the required timespan
-            recording_startTime = datetime.strptime(
-                i['timeSpan']['startTime'], "%Y-%m-%dT%H:%M:%SZ")
-            recording_endTime = datetime.strptime(
-                i['timeSpan']['endTime'], "%Y-%m-%dT%H:%M:%SZ")
-            if recording_endTime < args.starttime or recording_startTime > args.endtime:
+            if not in_timespan(args, rec):
                 continue
-            
-            rec = Recording(
-                cid=cid,
-                cname=cname,
-                url=i['mediaSegmentDescriptor']['playbackURI'],
-                startTime=i['timeSpan']['startTime'],
-                endTime=i['timeSpan']['endTime'],
-            )
-            
+
             result.append(rec)
-            downloadDict["channels"][cid]["num_videos"] += 1
             logging.debug("Found recording type %s on channel %s" % (
-                i['mediaSegmentDescriptor']['contentType'], cid
+                i.contentType, cid
             ))
 
-            if not args.photos and i['mediaSegmentDescriptor']['contentType'] != 'video':
+            if not args.photos and i.contentType != 'video':
                 # This recording is not a video, skip it
                 continue
 
         # Save channel metadata
-        downloadDict["channels"][cid]["recordings"].extend(result)
-        if downloadDict["channels"][cid]["recordings"]:
-            downloadDict["channels"][cid]["minStartTime"] = downloadDict["channels"][cid]["recordings"][0].startTime
+        downloadDict["channels"][cid] = channel_metadata(starttime, endtime, result)
         downloadDict["num_videos"] += downloadDict["channels"][cid]["num_videos"]
         downloadDict["num_channels"] += 1
 
+    if index is not None:
+        index.close()
+
     end_time = time.perf_counter()
     run_time = end_time - start_time
     logging.info(
@@ -380,113 +801,230 @@ def search_for_recordings_mock(args) -> dict:
                 "num_videos": 5,
                 "filenames": [],
                 "duration": timedelta(minutes=10),
-                "startTime": "2021-12-19T09:04:46Z",
+                "startTime": datetime(2021, 12, 19, 9, 4, 46),
                 "endTime": None,
                 "minStartTime": None,
                 "recordings": [
                     Recording(cid=1, cname="Channel 1",
-                            startTime="2021-12-19T09:04:46Z", url="https://tedyst.ro"),
+                            startTime=datetime(2021, 12, 19, 9, 4, 46), url="https://tedyst.ro"),
                     Recording(cid=1, cname="Channel 1",
-                            startTime="2021-12-19T09:04:47Z", url="https://tedyst.ro"),
+                            startTime=datetime(2021, 12, 19, 9, 4, 47), url="https://tedyst.ro"),
                     Recording(cid=1, cname="Channel 1",
-                            startTime="2021-12-19T09:04:48Z", url="https://tedyst.ro"),
+                            startTime=datetime(2021, 12, 19, 9, 4, 48), url="https://tedyst.ro"),
                     Recording(cid=1, cname="Channel 1",
-                            startTime="2021-12-19T09:04:49Z", url="https://tedyst.ro"),
+                            startTime=datetime(2021, 12, 19, 9, 4, 49), url="https://tedyst.ro"),
                     Recording(cid=1, cname="Channel 1",
-                            startTime="2021-12-19T09:04:50Z", url="https://tedyst.ro"),
+                            startTime=datetime(2021, 12, 19, 9, 4, 50), url="https://tedyst.ro"),
                     Recording(cid=1, cname="Channel 1",
-                            startTime="2021-12-19T09:04:51Z", url="https://tedyst.ro"),
+                            startTime=datetime(2021, 12, 19, 9, 4, 51), url="https://tedyst.ro"),
                 ],
             }
         }
     }
 
 
-def download_recording(server: hikvisionapi.HikvisionServer, args, recordingobj: Recording, original_path):
+def download_recording(server: hikvisionapi.HikvisionServer, args, recordingobj: Recording, original_path, postprocessing=None):
+    filename, _, _ = _download_recording(server, args, recordingobj, original_path, postprocessing)
+    return filename
+
+
+def recording_name(args, recordingobj: Recording, original_path) -> str:
+    """Returns the path of the files of a recording, without the channel and extension,
+    creating its folder if needed"""
+    recording_time = recordingobj.startTime
+    filepath = os.path.abspath(original_path)
+    if args.folders:
+        filepath = os.path.join(filepath, recordingobj.cname)
+        if args.folders in ["oneperyear", "onepermonth", "oneperday"]:
+            filepath = os.path.join(filepath, str(recording_time.year))
+            if args.folders in ["onepermonth", "oneperday"]:
+                filepath = os.path.join(filepath, str(recording_time.month))
+                if args.folders in ["oneperday"]:
+                    filepath = os.path.join(filepath, str(recording_time.day))
+        create_folder(filepath)
+
+    # You can choose your own filename, this is just an example
+    if args.localtimefilenames:
+        delta = datetime.now(
+            timezone.utc).astimezone().tzinfo.utcoffset(datetime.now(timezone.utc).astimezone())
+        date = recording_time + delta
+        name = date.strftime("%Y%m%d%H%M%S")
+    elif args.videoname != "":
+        name = args.videoname + "_" + recording_time.strftime("%Y%m%d%H%M%S")
+    else:
+        name = recording_time.strftime("%Y%m%d%H%M%S")
+    return os.path.join(filepath, name)
+
+
+def video_filename(args, filename, cid, extension=None) -> str:
+    """Returns the name of the video saved for a recording"""
+    if args.folders:
+        return "%s.%s" % (filename, extension or args.videoformat)
+    return "%s-%s.%s" % (filename, cid, extension or args.videoformat)
+
+
+def inside_bounds(recordingobj: Recording, bounds: tuple = None) -> bool:
+    # A recording that is already inside the bounds does not need to be cut either
+    return bounds is not None and recordingobj.endTime is not None and \
+        bounds[0] <= recordingobj.startTime and recordingobj.endTime <= bounds[1]
+
+
+def _download_recording(server: hikvisionapi.HikvisionServer, args, recordingobj: Recording, original_path,
+                        postprocessing=None, bounds=None, journal=None):
+    # Returns the filename, whether only the part of the recording inside
+    # the bounds of the channel was downloaded, and when the saved video starts
     filename = None
+    bounded = False
+    start = None
     try:
         logger = logging.getLogger('hikload')
         if args.mock:
             logger.info("Mocking download of %s" % recordingobj.url)
             time.sleep(1)
-            return
-        os.chdir(original_path)
-        recording_time = datetime.strptime(
-            recordingobj.startTime, "%Y-%m-%dT%H:%M:%SZ")
-        filepath = ""
-        if args.folders:
-            create_folder_and_chdir(recordingobj.cname)
-            filepath = os.path.join(filepath, recordingobj.cname)
-            if args.folders in ["oneperyear", "onepermonth", "oneperday"]:
-                create_folder_and_chdir(recording_time.year)
-                filepath = os.path.join(filepath, str(recording_time.year))
-                if args.folders in ["onepermonth", "oneperday"]:
-                    create_folder_and_chdir(recording_time.month)
-                    filepath = os.path.join(filepath, str(recording_time.month))
-                    if args.folders in ["oneperday"]:
-                        create_folder_and_chdir(recording_time.day)
-                        filepath = os.path.join(filepath, str(recording_time.day))
-
-        # You can choose your own filename, this is just an example
-        if args.localtimefilenames:
-            date = datetime.strptime(
-                recordingobj.startTime, "%Y-%m-%dT%H:%M:%SZ")
-            delta = datetime.now(
-                timezone.utc).astimezone().tzinfo.utcoffset(datetime.now(timezone.utc).astimezone())
-            date = date + delta
-            name = re.sub(r'[-T\:Z]', '', date.isoformat())
-        elif args.videoname != "":
-            name = args.videoname + "_" + re.sub(r'[-T\:Z]', '', recordingobj.startTime)
-        else:
-            name = re.sub(r'[-T\:Z]', '', recordingobj.startTime)
+            return filename, bounded, start
+        if archived(args, recordingobj, original_path):
+            return filename, bounded, start
+        name = recording_name(args, recordingobj, original_path)
 
+        window = None
         if not args.skipdownload:
             if args.photos:
                 photo_download_from_channel(
-                    server, args, recordingobj.url, name, recordingobj.cid)
+                    server, args, recordingobj.url, name, recordingobj.cid, journal)
             else:
-                video_download_from_channel(
-                    server, args, recordingobj.url, name, recordingobj.cid)
+                window = download_window(args, recordingobj, bounds)
+                if not video_download_from_channel(
+                        server, args, recordingobj.url, name, recordingobj.cid, postprocessing,
+                        window, journal, recordingobj.duration):
+                    # All of the recording was downloaded
+                    window = None
+                bounded = window is not None or inside_bounds(recordingobj, bounds)
         else:
             logging.debug("Skipping download of %s" % recordingobj.url)
 
-        if args.folders:
-            os.chdir(original_path)
-        
-        if args.folders:
-            filename = "%s.%s" % (name, args.videoformat)
-        else:
-            filename = "%s-%s.%s" % (name, recordingobj.cid, args.videoformat)
-        os.path.join(filepath, filename)
+        filename = video_filename(args, name, recordingobj.cid)
+        start = video_start(args, recordingobj, window)
     except TypeError as e:
         logging.error(
             "HikVision dosen't apparently like to return correct XML data...")
         logging.error(repr(e))
         logging.error(recordingobj)
 
-    return filename
+    return filename, bounded, start
+
+
+def video_start(args, recordingobj: Recording, window: tuple | None) -> datetime:
+    """Returns when the video saved from a recording starts, which is the start of the
+    downloaded `window`, or the start of the recording after --skipseconds"""
+    if window is not None:
+        return window[0]
+    if args.skipseconds:
+        return recordingobj.startTime + timedelta(seconds=args.skipseconds)
+    return recordingobj.startTime
+
+
+def archived(args, recordingobj: Recording, original_path) -> bool:
+    """Returns True if the recording was already appended to the --archive of its channel"""
+    if not args.archive or recordingobj.url not in archived_recordings(
+            original_path, recordingobj.cid, recordingobj.startTime.date()):
+        return False
+    logging.debug("%s is already archived" % recordingobj.url)
+    return True
 
 
-def download_recordings(server: hikvisionapi.HikvisionServer, args, downloadDict: dict):
+def download_recordings(server: hikvisionapi.HikvisionServer, args, downloadDict: dict,
+                        executor=None, postprocessing=None, progress_bar=None):
+    """Downloads all the recordings found for a server. The pools and the progress bar
+    are created for this server, unless they are shared with other servers"""
     logger = logging.getLogger('hikload')
     if args.downloads:
-        create_folder_and_chdir(args.downloads)
-    original_path = os.path.abspath(os.getcwd())
+        original_path = create_folder(os.path.abspath(args.downloads))
+    else:
+        original_path = os.path.abspath(os.getcwd())
+
+    journal = open_journal(args, original_path)
 
-    logger.info("Downloading recordings...")
-    with tqdm.tqdm(total=downloadDict["num_videos"]) as progress_bar:
+    logger.info("Downloading recordings from %s..." % server.host)
+    # The recordings are processed by ffmpeg as soon as they are downloaded,
+    # and leaving this block waits for all of them to be processed
+    with contextlib.ExitStack() as stack:
+        if progress_bar is None:
+            progress_bar = stack.enter_context(tqdm.tqdm(total=downloadDict["num_videos"]))
+        if postprocessing is None:
+            postprocessing = stack.enter_context(ThreadPoolExecutor(max_workers=args.ffmpegworkers))
+        if executor is None:
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=args.workers))
+        futures = {}
         for cid, channel_metadata in downloadDict["channels"].items():
-            try:
-                for recordingobj in channel_metadata["recordings"]:
-                    filename = download_recording(server, args, recordingobj, original_path)
-                    downloadDict["channels"][cid]["filenames"].append(filename)
-                    progress_bar.update()
-            except TypeError:
-                # Value (channel_metadata) is not subscriptible
-                pass
+            if not isinstance(channel_metadata, dict):
+                continue
+            if concatenated(args, journal, cid, channel_metadata):
+                progress_bar.update(channel_metadata["num_videos"])
+                continue
+            bounds = channel_bounds(args, channel_metadata)
+            futures[cid] = []
+            for recordingobj in channel_metadata["recordings"]:
+                future = executor.submit(
+                    _download_recording, server, args, recordingobj, original_path, postprocessing, bounds, journal)
+                future.add_done_callback(lambda _: progress_bar.update())
+                futures[cid].append(future)
+        for cid, channel_futures in futures.items():
+            save_channel_results(downloadDict["channels"][cid],
+                                 [future.result() for future in channel_futures])
     return downloadDict
 
 
+def open_journal(args, folder) -> DownloadJournal | None:
+    """Returns the --journal of a downloads folder"""
+    if not args.journal:
+        return None
+    return DownloadJournal.forFolder(create_folder(folder))
+
+
+def channel_key(args, cid, channel_metadata: dict) -> str:
+    """Returns the key of the concatenated video of a channel in the journal"""
+    return "%s/%s/%s-%s" % (args.server, cid, channel_metadata["startTime"].strftime("%Y%m%d%H%M%S"),
+                            channel_metadata["endTime"].strftime("%Y%m%d%H%M%S"))
+
+
+def concatenated(args, journal: DownloadJournal | None, cid, channel_metadata: dict) -> bool:
+    """Returns True if the videos of a channel were already concatenated by a previous run,
+    so the channel can be skipped"""
+    if not args.concat or journal is None or channel_metadata.get("endTime") is None:
+        return False
+    entry = journal.verified(channel_key(args, cid, channel_metadata), "concat", verify=args.verify)
+    if entry is None:
+        return False
+    logging.info("The videos of channel %s were already concatenated into %s" % (cid, entry.path))
+    channel_metadata["concatenated"] = entry.path
+    return True
+
+
+def channel_bounds(args, channel_metadata: dict) -> tuple | None:
+    if args.concat and args.trim:
+        # Download only what is left after trimming the concatenated video
+        return channel_metadata["startTime"], channel_metadata["endTime"]
+    return None
+
+
+def save_channel_results(channel_metadata: dict, results: List[tuple]):
+    """Saves the (filename, bounded, start) results of downloading the recordings of a channel,
+    in the order of the recordings, for --concat and --archive"""
+    bounded = []
+    for (filename, recording_bounded, start), recordingobj in zip(results, channel_metadata["recordings"]):
+        bounded.append(recording_bounded)
+        if filename is not None:
+            channel_metadata["filenames"].append(filename)
+            channel_metadata["sources"].append(recordingobj)
+            channel_metadata["starts"].append(start)
+    # The concatenated video will not need to be trimmed again
+    channel_metadata["trimmed"] = bool(bounded) and all(bounded)
+    if bounded and bounded[0] and not channel_metadata["trimmed"]:
+        # The first video does not start before the start of the channel anymore
+        channel_metadata["minStartTime"] = max(
+            channel_metadata["minStartTime"], channel_metadata["startTime"])
+
+
 def process_recordings_with_ffmpeg(args, downloadDict: dict):
     logger = logging.getLogger('hikload')
     # Check for max duration of the video and if it's too long, promt user
@@ -498,23 +1036,258 @@ def process_recordings_with_ffmpeg(args, downloadDict: dict):
 
     if args.downloads:
         create_folder_and_chdir(args.downloads)
+    journal = open_journal(args, os.getcwd())
 
-    logger.info("Concatenating videos..")
-    with tqdm.tqdm(total=downloadDict["num_channels"]) as progress_bar:
+    logger.info("Archiving videos.." if args.archive else "Concatenating videos..")
+    slots = concat_slots(args)
+    with tqdm.tqdm(total=downloadDict["num_channels"]) as progress_bar, \
+            ThreadPoolExecutor(max_workers=args.concatworkers) as executor:
+        futures = []
         for cid, channel_metadata in downloadDict["channels"].items():
             if not isinstance(channel_metadata, dict):
                 continue
 
-            concat_filename = concat_channel_videos(channel_metadata, cid, args)
+            future = executor.submit(process_channel_adaptively, args, cid, channel_metadata, journal, slots)
+            future.add_done_callback(lambda _: progress_bar.update())
+            futures.append(future)
+        for future in futures:
+            future.result()
 
-            if args.trim:
-                cut_filename = cut_video(concat_filename, channel_metadata)
-                logger.info("Trimmed video saved as %s" % cut_filename)
 
-            progress_bar.update()
+def concat_slots(args) -> AdaptiveLimiter:
+    """Returns the limit of the channels concatenated at the same time, up to --concatworkers"""
+    return AdaptiveLimiter(args.concatworkers, name="concatenations")
 
 
-def run(args):
+def process_channel_adaptively(args, cid, channel_metadata: dict, journal, slots: AdaptiveLimiter):
+    """Processes a channel with process_channel_with_ffmpeg once `slots` lets it, and records
+    how fast its videos were copied, so fewer channels are processed at the same time when
+    the disk cannot keep up"""
+    with slots:
+        started = time.perf_counter()
+        process_channel_with_ffmpeg(args, cid, channel_metadata, journal)
+        size = sum(os.path.getsize(name) for name in channel_metadata["filenames"] if os.path.exists(name))
+        slots.finished(size, time.perf_counter() - started)
+
+
+def process_channel_with_ffmpeg(args, cid, channel_metadata: dict, journal=None):
+    logger = logging.getLogger('hikload')
+    if channel_metadata.get("concatenated"):
+        return
+    if args.archive:
+        archive_channel_videos(channel_metadata, cid, args)
+        return
+    concat_filename = concat_channel_videos(channel_metadata, cid, args)
+    if concat_filename is None:
+        return
+
+    if args.trim and not channel_metadata.get("trimmed"):
+        cut_filename = cut_video(concat_filename, channel_metadata)
+        if cut_filename is None:
+            return
+        logger.info("Trimmed video saved as %s" % cut_filename)
+        concat_filename = cut_filename
+    if journal is not None:
+        journal.record(channel_key(args, cid, channel_metadata), "concat", concat_filename,
+                       duration=channel_metadata["duration"])
+
+
+class PipelineChannel():
+    """The recordings of a channel in the --pipeline mode, which are finished once
+    the channel is searched and all of them are downloaded and processed by ffmpeg"""
+
+    def __init__(self, channel: dict, starttime: datetime, endtime: datetime):
+        self.cid = channel['id']
+        self.cname = channel['channelName']
+        self.metadata = channel_metadata(starttime, endtime, [])
+        self.results = []
+        # The search is pending too, until all the recordings are found
+        self.pending = 1
+        self._lock = threading.Lock()
+
+    def add(self, recordingobj: Recording) -> int:
+        """Adds a recording that was found and returns its index"""
+        with self._lock:
+            self.metadata["recordings"].append(recordingobj)
+            self.metadata["num_videos"] += 1
+            if self.metadata["minStartTime"] is None or recordingobj.startTime < self.metadata["minStartTime"]:
+                self.metadata["minStartTime"] = recordingobj.startTime
+            self.results.append((None, False, None))
+            self.pending += 1
+            return len(self.results) - 1
+
+    def finish(self, index: int = None, result: tuple = None) -> bool:
+        """Marks the search, or the recording at `index`, as finished and returns
+        True if it was the last thing the channel waited for"""
+        with self._lock:
+            if index is not None:
+                self.results[index] = result
+            self.pending -= 1
+            return self.pending == 0
+
+
+class BoundedPostprocessing():
+    """Submits the videos of one recording to the ffmpeg pool, waiting while
+    `slots` videos are already waiting or being processed"""
+
+    def __init__(self, pool: ThreadPoolExecutor, slots: threading.Semaphore):
+        self.pool = pool
+        self.slots = slots
+        self.futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        future = self.pool.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+        return future
+
+
+def search_channel_into_queue(server: hikvisionapi.HikvisionServer, args, channel: PipelineChannel,
+                              starttime: datetime, endtime: datetime, recordings: queue.Queue, progress_bar):
+    """Puts the recordings of a channel in the queue while they are found,
+    waiting when the downloads fall behind"""
+    seen = set()
+    try:
+        if args.allrecordings:
+            searches = [server.ContentMgmt.search.iterAllRecordingsForID(channel.cid)]
+        else:
+            searches = [
+                server.ContentMgmt.search.iterPastRecordingsForID(
+                    channel.cid, shard_start.isoformat() + "Z", shard_end.isoformat() + "Z")
+                for shard_start, shard_end in split_time_range(starttime, endtime, timedelta(hours=args.searchshard))
+            ]
+        for search in searches:
+            for match in search:
+                # A recording that spans two shards is found by both searches
+                if match.playbackURI in seen:
+                    continue
+                seen.add(match.playbackURI)
+                rec = Recording.from_search_match(match, channel.cid, channel.cname)
+                if not in_timespan(args, rec):
+                    continue
+                with progress_bar.get_lock():
+                    progress_bar.total += 1
+                progress_bar.refresh()
+                recordings.put((channel, channel.add(rec), rec))
+    except (HikvisionException, requests.exceptions.RequestException) as e:
+        logging.error("Could not get recordings for channel %s" % channel.cid)
+        logging.error(e)
+    logging.info("Found %s recordings for channel %s" % (channel.metadata["num_videos"], channel.cid))
+
+
+def search_and_download_pipeline(server: hikvisionapi.HikvisionServer, args) -> dict:
+    """The --pipeline version of search_for_recordings, download_recordings and
+    process_recordings_with_ffmpeg. The stages are connected by bounded queues, so every
+    recording is downloaded as soon as it is found, processed by ffmpeg as soon as it is
+    downloaded, and every channel is concatenated as soon as all its videos are ready"""
+    logger = logging.getLogger('hikload')
+    channelList = None
+    if not args.cameras:
+        try:
+            channelList = server.Streaming.getChannels()
+        except HikvisionException as e:
+            logging.error(
+                "Could not get channel list. If you still want to continue, add the argument --cameras with the channel ids you want to download.")
+            raise e
+    starttime, endtime = search_interval(args)
+    channels = [PipelineChannel(channel, starttime, endtime) for channel in select_channels(args, channelList)]
+    if args.downloads:
+        create_folder_and_chdir(args.downloads)
+    original_path = os.path.abspath(os.getcwd())
+
+    journal = open_journal(args, original_path)
+    recordings = queue.Queue(maxsize=args.queuesize or 2 * args.workers)
+    transcodes = threading.Semaphore(2 * args.ffmpegworkers)
+    downloadDict = {
+        "num_videos": 0,
+        "num_channels": len(channels),
+        "channels": {},
+    }
+    # The channels are finished by up to --concatworkers at the same time
+    slots = concat_slots(args)
+    summary = threading.Lock()
+    finishing = []
+
+    def finish_channel(channel: PipelineChannel):
+        # The videos are concatenated in the order of the recordings, not of the searches
+        order = sorted(range(len(channel.results)), key=lambda i: channel.metadata["recordings"][i].startTime)
+        channel.metadata["recordings"] = [channel.metadata["recordings"][i] for i in order]
+        save_channel_results(channel.metadata, [channel.results[i] for i in order])
+        if args.concat or args.archive:
+            process_channel_adaptively(args, channel.cid, channel.metadata, journal, slots)
+        # Only the summary of the channel is kept once its videos are saved
+        channel.metadata["recordings"] = []
+        channel.metadata["sources"] = []
+        channel.metadata["starts"] = []
+        channel.results = []
+        with summary:
+            downloadDict["channels"][channel.cid] = channel.metadata
+            downloadDict["num_videos"] += channel.metadata["num_videos"]
+
+    def finish(channel: PipelineChannel, index: int = None, result: tuple = None):
+        if channel.finish(index, result):
+            finishing.append((channel, concat.submit(finish_channel, channel)))
+
+    def search(channel: PipelineChannel):
+        try:
+            if not concatenated(args, journal, channel.cid, channel.metadata):
+                search_channel_into_queue(server, args, channel, starttime, endtime, recordings, progress_bar)
+        except Exception as e:
+            # The recordings found before the error are still downloaded
+            logging.error("Could not get recordings for channel %s" % channel.cid)
+            logging.error(repr(e))
+        finally:
+            finish(channel)
+
+    def download():
+        while True:
+            item = recordings.get()
+            if item is None:
+                return
+            channel, index, recordingobj = item
+            bounds = channel_bounds(args, channel.metadata)
+            jobs = BoundedPostprocessing(postprocessing, transcodes)
+            try:
+                result = _download_recording(server, args, recordingobj, original_path, jobs, bounds, journal)
+            except Exception as e:
+                # A worker that stops would leave the searches waiting for the queue forever
+                logging.error("Could not download %s" % recordingobj)
+                logging.error(e)
+                result = (None, False, None)
+            if jobs.futures:
+                jobs.futures[-1].add_done_callback(
+                    lambda _, channel=channel, index=index, result=result: (
+                        progress_bar.update(), finish(channel, index, result)))
+            else:
+                progress_bar.update()
+                finish(channel, index, result)
+
+    logger.info("Downloading recordings from %s..." % server.host)
+    # Leaving every block waits for the stage before the next one is closed
+    with tqdm.tqdm(total=0) as progress_bar, \
+            ThreadPoolExecutor(max_workers=args.concatworkers) as concat, \
+            ThreadPoolExecutor(max_workers=args.ffmpegworkers) as postprocessing:
+        with ThreadPoolExecutor(max_workers=args.workers) as downloads:
+            workers = [downloads.submit(download) for _ in range(args.workers)]
+            try:
+                with ThreadPoolExecutor(max_workers=args.searchworkers) as searches:
+                    for future in [searches.submit(search, channel) for channel in channels]:
+                        future.result()
+            finally:
+                # The workers would wait for more recordings forever
+                for _ in workers:
+                    recordings.put(None)
+            for future in workers:
+                future.result()
+    for channel, future in finishing:
+        if future.exception() is not None:
+            logging.error("Could not finish channel %s" % channel.cid)
+            logging.error(repr(future.exception()))
+    return downloadDict
+
+
+def check_server_args(args):
     if args.server == "" or args.server == None:
         raise HikvisionException(
             "No server specified! You need to specify a server with --server")
@@ -525,9 +1298,28 @@ def run(args):
         raise HikvisionException(
             "No password specified! You need to specify a password with --password")
 
-    server = hikvisionapi.HikvisionServer(
-        args.server, args.username, args.password, httptimeout=args.httptimeout)
 
+def bandwidth_limits(args, shared: list = None) -> list:
+    """Returns the BandwidthLimiters of a server, its own --bandwidth and the ones
+    shared with other servers, which are the --totalbandwidth if not given"""
+    if shared is None:
+        shared = [BandwidthLimiter(*args.totalbandwidth)] if args.totalbandwidth else []
+    limits = list(shared)
+    if args.bandwidth:
+        limits.append(BandwidthLimiter(*args.bandwidth))
+    return limits
+
+
+def create_server(args, sharedBandwidth: list = None) -> hikvisionapi.HikvisionServer:
+    return hikvisionapi.HikvisionServer(
+        args.server, args.username, args.password, httptimeout=args.httptimeout,
+        poolsize=max(args.poolsize, args.workers * args.segments, args.searchworkers), maxconnections=args.maxconnections,
+        adaptive=args.adaptive, retries=args.retries, retryBackoff=args.retrybackoff,
+        breakerThreshold=args.breakerthreshold, breakerTimeout=args.breakertimeout,
+        bandwidthLimits=bandwidth_limits(args, sharedBandwidth))
+
+
+def setup_logging(args):
     FORMAT = "[%(name)s - %(funcName)20s() ] %(message)s"
     logging.basicConfig(format=FORMAT)
     logger = logging.getLogger('hikload')
@@ -535,8 +1327,41 @@ def run(args):
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
+    return logger
+
+
+def run(args):
+    if args.fleet:
+        # The fleet driver builds on this module, so it is only imported when used
+        from hikload.fleet import run_fleet
+        return run_fleet(args)
+    check_server_args(args)
+    server = create_server(args)
+    logger = setup_logging(args)
+
+    if args.asyncio and (args.ffmpeg or args.frames or args.pipe or args.remux or args.segments > 1 or args.index
+                         or args.mock or args.journal):
+        logger.warning("--asyncio does not support --ffmpeg, --frames, --pipe, --remux, --segments, --index, "
+                       "--mock and --journal, downloading with threads instead")
+        args.asyncio = False
+
+    if args.pipeline and (args.asyncio or args.index or args.mock):
+        logger.warning("--pipeline does not support --asyncio, --index and --mock, "
+                       "searching and downloading one after the other instead")
+        args.pipeline = False
 
     with logging_redirect_tqdm():
+        if args.pipeline:
+            server.test_connection()
+            search_and_download_pipeline(server, args)
+            return
+        if args.asyncio:
+            # The asyncio driver builds on this module, so it is only imported when used
+            from hikload.asyncdownload import search_and_download_async
+            downloadDict = asyncio.run(search_and_download_async(args))
+            if args.concat or args.archive:
+                process_recordings_with_ffmpeg(args, downloadDict)
+            return
         server.test_connection()
         if args.mock:
             downloadDict = search_for_recordings_mock(args)
@@ -546,6 +1371,6 @@ def run(args):
 
         downloadDict = download_recordings(server, args, downloadDict)
 
-        if args.concat:
+        if args.concat or args.archive:
             process_recordings_with_ffmpeg(args, downloadDict)       
 
@@ -0,0 +1,110 @@
+import copy
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
+
+from hikload.download import (check_server_args, create_parser, create_server, download_recordings,
+                              process_recordings_with_ffmpeg, search_for_recordings, search_for_recordings_mock,
+                              setup_logging)
+from hikload.hikvisionapi.classes import BandwidthLimiter, HikvisionException
+
+
+def load_fleet(args) -> dict:
+    """Returns the arguments used for every server in the --fleet file, by name.
+
+    The file looks like {"defaults": {...}, "servers": [{...}, ...]}, where every
+    server has the long names of the command line options, like "server", "cameras"
+    or "starttime", and an optional "name". The options that are not given are the
+    ones from the command line. The recordings of every server are saved in a folder
+    with its name inside --downloads, unless "downloads" is given.
+    """
+    with open(args.fleet) as f:
+        config = json.load(f)
+    parser = create_parser()
+    fleet = {}
+    for entry in config["servers"]:
+        options = {**config.get("defaults", {}), **entry}
+        name = str(options.pop("name", options.get("server")))
+        if name in fleet:
+            raise HikvisionException("The server %s is listed more than once in %s" % (name, args.fleet))
+        argv = []
+        for option, value in options.items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                argv.append("--%s" % option if value else "--no-%s" % option)
+                continue
+            if isinstance(value, list):
+                value = ",".join(str(i) for i in value)
+            argv.extend(["--%s" % option, str(value)])
+        # Only the options given for this server replace the ones of the command line
+        server_args = parser.parse_args(argv, namespace=copy.copy(args))
+        server_args.fleet = None
+        if "downloads" not in options:
+            server_args.downloads = os.path.join(args.downloads, re.sub(r'[^\w.-]', '_', name))
+        fleet[name] = server_args
+    return fleet
+
+
+def download_from_fleet_server(args, executor, postprocessing, progress_bar, sharedBandwidth) -> dict:
+    check_server_args(args)
+    server = create_server(args, sharedBandwidth)
+    try:
+        server.test_connection()
+        if args.mock:
+            downloadDict = search_for_recordings_mock(args)
+            args.skipdownload = True
+        else:
+            downloadDict = search_for_recordings(server, args)
+        with progress_bar.get_lock():
+            progress_bar.total += downloadDict["num_videos"]
+        progress_bar.refresh()
+        return download_recordings(server, args, downloadDict, executor, postprocessing, progress_bar)
+    finally:
+        server.close()
+
+
+def run_fleet(args):
+    logger = setup_logging(args)
+    fleet = load_fleet(args)
+    logger.info("Downloading from %s servers" % len(fleet))
+    start_time = time.perf_counter()
+    results = {}
+    sharedBandwidth = [BandwidthLimiter(*args.totalbandwidth)] if args.totalbandwidth else []
+    with logging_redirect_tqdm():
+        # All the servers share the download and ffmpeg pools, so --workers and
+        # --ffmpegworkers are global limits, while --maxconnections is per server
+        with tqdm.tqdm(total=0) as progress_bar, \
+                ThreadPoolExecutor(max_workers=args.ffmpegworkers) as postprocessing, \
+                ThreadPoolExecutor(max_workers=args.workers) as executor, \
+                ThreadPoolExecutor(max_workers=len(fleet) or 1) as servers:
+            futures = {
+                name: servers.submit(download_from_fleet_server, server_args, executor, postprocessing, progress_bar,
+                                     sharedBandwidth)
+                for name, server_args in fleet.items()
+            }
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result()
+                except (HikvisionException, requests.exceptions.RequestException) as e:
+                    logger.error("Could not download the recordings from %s" % name)
+                    logger.error(e)
+
+        for name, downloadDict in results.items():
+            if fleet[name].concat or fleet[name].archive:
+                process_recordings_with_ffmpeg(fleet[name], downloadDict)
+
+    for name in fleet:
+        if name in results:
+            logger.info("%s: %s recordings from %s channels" % (
+                name, results[name]["num_videos"], results[name].get("num_channels", len(results[name]["channels"]))))
+        else:
+            logger.info("%s: failed" % name)
+    logger.info(f"Finished downloading from {len(results)}/{len(fleet)} servers "
+                f"in {time.perf_counter() - start_time:.2f} seconds")
@@ -61,6 +61,79 @@ def downloadRTSP(url: str, videoName: str, seconds: int = 9999999, debug: bool =
         raise e
 
 
+def needsProcessing(seconds: int = 9999999, skipSeconds: int = 0, fileFormat: str = "mp4", forceTranscode: bool = False) -> bool:
+    """Returns True if a video downloaded from the DVR needs to be processed by ffmpeg.
+
+    Parameters:
+        seconds (int): the maximum number of seconds that should be recorded (default is 999999)
+        skipSeconds (int): the number of seconds that should be skipped when downloading (default is 0)
+        fileFormat (str): the format of the resulting video (default is mp4)
+        forceTranscode (bool): force the transcoding, even if it is not needed (default is False)
+    """
+    if forceTranscode == False or forceTranscode == None:
+        if fileFormat == "mp4":
+            if skipSeconds == None and seconds == None:
+                return False
+            if skipSeconds == 0 and seconds == 9999999:
+                return False
+    return True
+
+
+def processVideoStream(chunks, videoName: str, seconds: int = 9999999, debug: bool = False, skipSeconds: int = 0, fileFormat: str = "mp4"):
+    """Processes a video with ffmpeg while it is being downloaded, by feeding the
+    downloaded chunks to the stdin of ffmpeg. Only the processed video is saved.
+
+    Parameters:
+        chunks (iterable): the chunks of the downloaded video, as bytes
+        videoName (str): the filename of the processed video
+        seconds (int): the maximum number of seconds that should be recorded (default is 999999)
+        debug (bool): Enables debug logging (default is False)
+        skipSeconds (int): the number of seconds that should be skipped when downloading (default is 0)
+        fileFormat (str): the format of the resulting video (default is mp4)
+    """
+    logger.debug("Starting processing %s while downloading" % videoName)
+    try:
+        if seconds:
+            stream = ffmpeg.input("pipe:", t=seconds)
+        else:
+            stream = ffmpeg.input("pipe:")
+        newname = "%s-edited.%s" % (os.path.splitext(videoName)[0], fileFormat)
+        if skipSeconds:
+            stream = ffmpeg.output(stream, newname, ss=skipSeconds)
+        else:
+            stream = ffmpeg.output(stream, newname)
+        if not debug:
+            stream = stream.global_args('-loglevel', 'error')
+    except AttributeError:
+        raise Exception(
+            "The version of ffmpeg used is wrong! Be sure to uninstall ffmpeg using pip and install ffmpeg-python or use a virtualenv! For more information see the README!")
+    # The output of ffmpeg is not captured, so it can never block while we write to its stdin
+    process = ffmpeg.run_async(stream, pipe_stdin=True, overwrite_output=True)
+    try:
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            # ffmpeg already has everything it needs, for example when seconds is set
+            logger.debug("ffmpeg stopped reading %s before the end of the download" % videoName)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            process.wait()
+        if process.returncode != 0:
+            raise ffmpeg.Error('ffmpeg', None, None)
+    except BaseException:
+        # Do not leave a partially processed video behind
+        if os.path.exists(newname):
+            os.remove(newname)
+        raise
+    os.replace(newname, videoName)
+
+
 def processSavedVideo(videoName: str, seconds: int = 9999999, debug: bool = False, skipSeconds: int = 0, fileFormat: str = "mp4", forceTranscode: bool = False):
     """Downloads an RTSP livestream from url to videoName.
 
@@ -72,16 +145,10 @@ def processSavedVideo(videoName: str, seconds: int = 9999999, debug: bool = Fals
         skipSeconds (int): the number of seconds that should be skipped when downloading (default is 0)
         forceTranscode (bool): force the transcoding, even if it is not needed (default is False)
     """
-    if forceTranscode == False or forceTranscode == None:
-        if fileFormat == "mp4":
-            if skipSeconds == None and seconds == None:
-                logger.debug(
-                    "Skipping processing %s since it is not needed" % videoName)
-                return
-            if skipSeconds == 0 and seconds == 9999999:
-                logger.debug(
-                    "Skipping processing %s since it is not needed" % videoName)
-                return
+    if not needsProcessing(seconds=seconds, skipSeconds=skipSeconds, fileFormat=fileFormat, forceTranscode=forceTranscode):
+        logger.debug(
+            "Skipping processing %s since it is not needed" % videoName)
+        return
     logger.debug("Starting processing %s" % videoName)
     try:
         if seconds:
@@ -1,9 +1,141 @@
 import hikload.hikvisionapi as hikvisionapi
+import copy
+import json
+import os
+import re
+import time
 import uuid
 import logging
+from collections import OrderedDict, namedtuple
+import requests
+from lxml import etree
+from datetime import datetime, timedelta
 
 logger = logging.getLogger('hikload')
 
+PLAYBACK_TIME_FORMAT = "%Y%m%dT%H%M%SZ"
+
+# The errors after which an interrupted download is resumed. The HTTPError is raised
+# for the responses of a busy DVR
+RESUME_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                 requests.HTTPError)
+
+SearchMatch = namedtuple(
+    "SearchMatch", ["trackID", "startTime", "endTime", "playbackURI", "contentType"])
+SearchMatch.__doc__ = "A recording found by a search, without the rest of the searchMatchItem"
+
+
+def _searchMatch(element) -> SearchMatch:
+    return SearchMatch(
+        trackID=element.findtext("{*}trackID"),
+        startTime=element.findtext("{*}timeSpan/{*}startTime"),
+        endTime=element.findtext("{*}timeSpan/{*}endTime"),
+        playbackURI=element.findtext("{*}mediaSegmentDescriptor/{*}playbackURI"),
+        contentType=element.findtext("{*}mediaSegmentDescriptor/{*}contentType"),
+    )
+
+
+def _getURIParameter(playbackURI: str, name: str):
+    match = re.search(r"[?&]%s=([^&]*)" % name, playbackURI, re.IGNORECASE)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def boundPlaybackURI(playbackURI: str, startTime: datetime = None, endTime: datetime = None) -> str:
+    """
+    Returns a time based playbackURI for the part of the recording between
+    `startTime` and `endTime`. The parameters that are not given are kept.
+    The name and size of the file are removed, so the DVR searches by time.
+    """
+    base, _, query = playbackURI.partition("?")
+    times = {}
+    if startTime is not None:
+        times["starttime"] = startTime.strftime(PLAYBACK_TIME_FORMAT)
+    if endTime is not None:
+        times["endtime"] = endTime.strftime(PLAYBACK_TIME_FORMAT)
+    parameters = []
+    for parameter in query.split("&") if query else []:
+        name = parameter.split("=", 1)[0].lower()
+        if name in ("name", "size"):
+            continue
+        if name in times:
+            parameter = "%s=%s" % (name, times.pop(name))
+        parameters.append(parameter)
+    parameters.extend("%s=%s" % time for time in times.items())
+    return base + "?" + "&".join(parameters)
+
+
+def shiftPlaybackURI(playbackURI: str, offset: int):
+    """
+    Returns a time based playbackURI that starts at the moment of the recording
+    estimated to be at byte `offset`, or None if the playbackURI does not contain
+    the start time, end time and size needed for the estimation.
+    """
+    try:
+        startTime = datetime.strptime(
+            _getURIParameter(playbackURI, "starttime"), PLAYBACK_TIME_FORMAT)
+        endTime = datetime.strptime(
+            _getURIParameter(playbackURI, "endtime"), PLAYBACK_TIME_FORMAT)
+        size = int(_getURIParameter(playbackURI, "size"))
+    except (TypeError, ValueError):
+        return None
+    if size <= 0 or offset >= size:
+        return None
+    seconds = int((endTime - startTime).total_seconds() * offset / size)
+    return boundPlaybackURI(playbackURI, startTime=startTime + timedelta(seconds=seconds))
+
+
+def _downloadRequest(playbackURI: str) -> dict:
+    # Built directly instead of parsing an XML template on every call
+    return hikvisionapi.classes.Hasher({
+        'downloadRequest': OrderedDict([
+            ('playbackURI', playbackURI),
+            ('@attrs', {'version': '1.0'}),
+        ])
+    })
+
+
+def _searchDescription(ChannelID, startTime, endTime) -> dict:
+    return hikvisionapi.classes.Hasher({
+        'CMSearchDescription': OrderedDict([
+            ('searchID', str(uuid.uuid4())),
+            ('trackIDList', OrderedDict([
+                ('trackID', str(ChannelID)),
+                ('@attrs', {}),
+            ])),
+            ('timeSpanList', OrderedDict([
+                ('timeSpan', OrderedDict([
+                    ('startTime', str(startTime)),
+                    ('endTime', str(endTime)),
+                    ('@attrs', {}),
+                ])),
+                ('@attrs', {}),
+            ])),
+            ('maxResults', '64'),
+            ('@attrs', {'version': '1.0'}),
+        ])
+    })
+
+
+def _resumableOffset(partname: str, playbackURI: str) -> int:
+    # The sidecar is only trusted if it was written for the same recording
+    try:
+        with open(partname + ".json") as f:
+            sidecar = json.load(f)
+        size = os.path.getsize(partname)
+    except (OSError, ValueError):
+        return 0
+    if sidecar.get("playbackURI") != playbackURI:
+        return 0
+    return min(int(sidecar.get("bytes", 0)), size)
+
+
+def _writeSidecar(partname: str, playbackURI: str, size: int):
+    with open(partname + ".json.tmp", "w") as f:
+        json.dump({"playbackURI": playbackURI, "bytes": size}, f)
+    os.replace(partname + ".json.tmp", partname + ".json")
+
 
 class _search():
     def __init__(self, parent, httptimeout):
@@ -20,12 +152,12 @@ class _search():
         return hikvisionapi.getXML(self.parent, "ContentMgmt/search/profile", httptimeout=self.httptimeout)
 
     def getRaw(self, data: dict):
-        return hikvisionapi.postXML(self.parent, "ContentMgmt/search", data=data, httptimeout=self.httptimeout)
+        with self.parent.searchSlots:
+            return hikvisionapi.postXML(self.parent, "ContentMgmt/search", data=data, httptimeout=self.httptimeout)
 
     def get(self, data: dict):
         # TODO: This is a hack, since the server likes to return a limited number of results
-        result = hikvisionapi.postXML(
-            self.parent, "ContentMgmt/search", data=data, httptimeout=self.httptimeout)
+        result = self.getRaw(data)
         if result['CMSearchResult']['responseStatusStrg'] == "NO MATCHES":
             return result
         original = result
@@ -44,8 +176,7 @@ class _search():
                     result['CMSearchResult']['matchList']['searchMatchItem'][-1]
                     ['timeSpan']['startTime']
                 )
-                result = hikvisionapi.postXML(
-                    self.parent, "ContentMgmt/search", data=data, httptimeout=self.httptimeout)
+                result = self.getRaw(data)
                 for i in result['CMSearchResult']['matchList']['searchMatchItem']:
                     original['CMSearchResult']['matchList']['searchMatchItem'].append(
                         i)
@@ -57,67 +188,208 @@ class _search():
         original['CMSearchResult']['responseStatusStrg'] = "OK"
         return original
 
-    def download(self, data: dict):
-        result = hikvisionapi.getXML(self.parent, "ContentMgmt/download",
-                                     data=data, rawResponse=True, httptimeout=self.httptimeout)
-        return result
+    def iter(self, data: dict):
+        """
+        Yields the recordings found by the search described by `data` as `SearchMatch`
+        records, one at a time. The pages are requested one after another, until the DVR
+        returns all the results. Every page is parsed while it is received and yielded once
+        its response is closed, so a slow consumer does not keep a search slot or a
+        connection to the DVR.
+        """
+        data = copy.deepcopy(data)
+        timeSpan = data['CMSearchDescription']['timeSpanList']['timeSpan']
+        previousPage = set()
+        while True:
+            status = None
+            last = None
+            page = set()
+            matches = []
+            with self.parent.searchSlots, hikvisionapi.postXMLRaw(
+                    self.parent, "ContentMgmt/search", xmldata=hikvisionapi.dict2xml(data),
+                    httptimeout=self.httptimeout, rawResponse=True, stream=True) as response:
+                if response.status_code != 200:
+                    raise hikvisionapi.HikvisionException(
+                        "Server returned status code %s: %s" % (response.status_code, response.text))
+                response.raw.decode_content = True
+                for _, element in etree.iterparse(response.raw, events=("end",), remove_comments=True):
+                    tag = etree.QName(element).localname
+                    if tag == "responseStatusStrg":
+                        status = element.text
+                    elif tag == "statusString" and element.getparent().getparent() is None:
+                        # The root is a ResponseStatus, so the search failed
+                        raise hikvisionapi.HikvisionException(element.text)
+                    elif tag == "searchMatchItem":
+                        match = _searchMatch(element)
+                        # Free the items that were already yielded
+                        element.clear()
+                        while element.getprevious() is not None:
+                            del element.getparent()[0]
+                        page.add(match.playbackURI)
+                        last = match
+                        # The next page starts with the last item of the previous one
+                        if match.playbackURI not in previousPage:
+                            matches.append(match)
+            yield from matches
+            if status != "MORE":
+                return
+            if last is None:
+                logger.error(
+                    "Server did not return any results, but says that there are MORE?")
+                return
+            logger.debug("Using %s as starttime and %s as endtime for the new search" % (
+                last.startTime, timeSpan['endTime']))
+            data['CMSearchDescription']['searchID'] = str(uuid.uuid4())
+            timeSpan['startTime'] = last.startTime
+            previousPage = page
+
+    def iterPastRecordingsForID(self, ChannelID, startTime="", endTime=""):
+        return self.iter(_searchDescription(ChannelID, startTime, endTime))
+
+    def iterAllRecordingsForID(self, ChannelID):
+        return self.iter(_searchDescription(
+            ChannelID, "2000-01-01T00:00:00Z", "2037-10-10T23:59:59Z"))
+
+    def download(self, data: dict, filename: str = None, chunkSize: int = 1024 * 1024, checksum=None):
+        """
+        Downloads the recording described by `data`.
+        If `filename` is given, the recording is streamed to `filename`.part in chunks
+        of `chunkSize` bytes, which is renamed to `filename` once complete, and the size
+        of the file is returned. Otherwise the whole `requests.Response` is returned.
+        If a `Checksum` is given, it is computed while the file is written.
+        """
+        with self.parent.downloadSlots:
+            if filename is None:
+                return hikvisionapi.getXML(self.parent, "ContentMgmt/download",
+                                           data=data, rawResponse=True, httptimeout=self.httptimeout)
+            response = hikvisionapi.getXML(self.parent, "ContentMgmt/download",
+                                           data=data, rawResponse=True, httptimeout=self.httptimeout, stream=True)
+            started = time.perf_counter()
+            size = hikvisionapi.saveStream(response, filename + ".part", chunkSize, throttle=self.parent.throttle,
+                                           checksum=checksum)
+            self.parent.measureTransfer(size, time.perf_counter() - started)
+        os.replace(filename + ".part", filename)
+        return size
 
     def get_download_capabilities(self):
         result = hikvisionapi.getXML(
             self.parent, "ContentMgmt/download/capabilities", httptimeout=self.httptimeout)
         return result
 
-    def downloadURI(self, playbackURI):
-        dictdata = hikvisionapi.xml2dict(b"""<downloadRequest version="1.0"
-            xmlns="http://www.isapi.org/ver20/XMLSchema">
-        <playbackURI></playbackURI>
-        </downloadRequest>
-        """)
-        dictdata['downloadRequest']['playbackURI'] = playbackURI
-        return self.download(dictdata)
+    def downloadURI(self, playbackURI, filename: str = None, chunkSize: int = 1024 * 1024, resume: bool = True,
+                    startTime: datetime = None, endTime: datetime = None, checksum=None):
+        """
+        Downloads a recording using its playbackURI.
+        If `filename` is given, the recording is streamed to `filename`.part, next to a
+        `filename`.part.json sidecar that records the playbackURI and the bytes received.
+        If `resume` is set and a previous download of the same recording was interrupted,
+        the download continues from the last received byte, or from the estimated moment
+        of the recording if the DVR does not support byte ranges.
+        If `startTime` or `endTime` are given, only that part of the recording is requested.
+        If the transfer is interrupted, it is resumed up to `retries` times of the server, which
+        are the only retries of the download. The errors left are raised as HikvisionException.
+        If a `Checksum` is given, it is computed while the file is written, including
+        the part that was downloaded before resuming.
+        """
+        if startTime is not None or endTime is not None:
+            playbackURI = boundPlaybackURI(playbackURI, startTime, endTime)
+        if filename is None:
+            return self.download(_downloadRequest(playbackURI))
+
+        partname = filename + ".part"
+        attempt = 0
+        while True:
+            try:
+                self._downloadPart(playbackURI, filename, partname, chunkSize, resume, checksum)
+                break
+            except hikvisionapi.HikvisionException as e:
+                # The part file keeps what was received, so the download continues from there
+                if not isinstance(e.__cause__, RESUME_ERRORS) or not resume or attempt >= self.parent.retries:
+                    raise
+                delay = self.parent.retryDelay(attempt)
+                logger.warning("The download of %s was interrupted (%s), resuming in %.2f seconds" % (
+                    filename, e, delay))
+                time.sleep(delay)
+                attempt += 1
+        size = os.path.getsize(partname)
+        os.replace(partname, filename)
+        os.remove(partname + ".json")
+        return size
+
+    def _downloadPart(self, playbackURI, filename: str, partname: str, chunkSize: int, resume: bool, checksum=None):
+        dictdata = _downloadRequest(playbackURI)
+        offset = _resumableOffset(partname, playbackURI) if resume else 0
+        headers = None
+        if offset:
+            logger.debug("Resuming download of %s from byte %s" % (filename, offset))
+            headers = {'Range': 'bytes=%s-' % offset}
+        with self.parent.downloadSlots:
+            # The download is retried by resuming it in downloadURI
+            response = hikvisionapi.getXML(self.parent, "ContentMgmt/download", data=dictdata,
+                                           rawResponse=True, httptimeout=self.httptimeout,
+                                           stream=True, headers=headers, retries=0)
+            if response.status_code in hikvisionapi.utils.RETRY_STATUSES:
+                response.close()
+                raise hikvisionapi.HikvisionException(
+                    "Server returned status code %s" % response.status_code) from requests.HTTPError(response=response)
+            if offset and response.status_code == 416:
+                # The part file already holds the whole recording
+                response.close()
+                if checksum is not None:
+                    checksum.resume(partname, offset)
+            else:
+                if offset and response.status_code == 200:
+                    shifted = shiftPlaybackURI(playbackURI, offset)
+                    if shifted is not None:
+                        logger.debug(
+                            "The server ignored the byte range, resuming %s from %s" % (filename, shifted))
+                        response.close()
+                        dictdata['downloadRequest']['playbackURI'] = shifted
+                        response = hikvisionapi.getXML(self.parent, "ContentMgmt/download", data=dictdata,
+                                                       rawResponse=True, httptimeout=self.httptimeout, stream=True,
+                                                       retries=0)
+                    else:
+                        logger.debug(
+                            "The server ignored the byte range, downloading %s from the start" % filename)
+                        offset = 0
+                _writeSidecar(partname, playbackURI, offset)
+                started = time.perf_counter()
+                try:
+                    size = hikvisionapi.saveStream(response, partname, chunkSize, offset=offset,
+                                                   progress=lambda size: _writeSidecar(partname, playbackURI, size),
+                                                   throttle=self.parent.throttle, checksum=checksum)
+                except RESUME_ERRORS as e:
+                    raise hikvisionapi.HikvisionException("%s: %s" % (e.__class__.__name__, e)) from e
+                self.parent.measureTransfer(size - offset, time.perf_counter() - started)
+
+    def iterDownloadURI(self, playbackURI, chunkSize: int = 1024 * 1024, startTime: datetime = None, endTime: datetime = None):
+        """
+        Yields the recording with the given playbackURI in chunks of `chunkSize` bytes,
+        as they are received from the DVR.
+        If `startTime` or `endTime` are given, only that part of the recording is requested.
+        """
+        if startTime is not None or endTime is not None:
+            playbackURI = boundPlaybackURI(playbackURI, startTime, endTime)
+        with self.parent.downloadSlots:
+            response = hikvisionapi.getXML(self.parent, "ContentMgmt/download", data=_downloadRequest(playbackURI),
+                                           rawResponse=True, httptimeout=self.httptimeout, stream=True)
+            with response:
+                if response.status_code != 200:
+                    raise hikvisionapi.HikvisionException(
+                        "Server returned status code %s: %s" % (response.status_code, response.text))
+                try:
+                    for chunk in response.iter_content(chunk_size=chunkSize):
+                        yield chunk
+                        self.parent.throttle(len(chunk))
+                except RESUME_ERRORS as e:
+                    raise hikvisionapi.HikvisionException("%s: %s" % (e.__class__.__name__, e)) from e
 
     def getPastRecordingsForID(self, ChannelID, startTime="", endTime=""):
-        dictdata = hikvisionapi.xml2dict(b"""<CMSearchDescription version="1.0"
-            xmlns="http://www.isapi.org/ver20/XMLSchema">
-            <searchID></searchID>
-            <trackIDList>
-                <trackID></trackID>
-            </trackIDList>
-            <timeSpanList>
-                <timeSpan>
-                    <startTime></startTime>
-                    <endTime></endTime>
-                </timeSpan>
-            </timeSpanList>
-            <maxResults>64</maxResults>
-            </CMSearchDescription>""")
-        dictdata['CMSearchDescription']['searchID'] = str(uuid.uuid4())
-        dictdata['CMSearchDescription']['trackIDList']['trackID'] = str(
-            ChannelID)
-        (dictdata['CMSearchDescription']['timeSpanList']
-         ['timeSpan']['startTime']) = str(startTime)
-        (dictdata['CMSearchDescription']['timeSpanList']
-         ['timeSpan']['endTime']) = str(endTime)
+        dictdata = _searchDescription(ChannelID, startTime, endTime)
         return self.get(dictdata)
 
     def getAllRecordingsForID(self, ChannelID):
-        dictdata = hikvisionapi.xml2dict(b"""<CMSearchDescription version="1.0"
-            xmlns="http://www.isapi.org/ver20/XMLSchema">
-            <searchID></searchID>
-            <trackIDList>
-            <trackID></trackID>
-            </trackIDList>
-            <timeSpanList>
-                <timeSpan>
-                    <startTime>2000-01-01T00:00:00Z</startTime>
-                    <endTime>2037-10-10T23:59:59Z</endTime>
-                </timeSpan>
-            </timeSpanList>
-            <maxResults>64</maxResults>
-            </CMSearchDescription>""")
-        dictdata['CMSearchDescription']['searchID'] = str(uuid.uuid4())
-        dictdata['CMSearchDescription']['trackIDList']['trackID'] = str(
-            ChannelID)
+        dictdata = _searchDescription(
+            ChannelID, "2000-01-01T00:00:00Z", "2037-10-10T23:59:59Z")
         return self.get(dictdata)
 
 
@@ -1,3 +1,5 @@
 from .classes import HikvisionServer, HikvisionException
-from .utils import getXML, getXMLRaw, postXML, postXMLRaw, deleteXMLRaw, deleteXML, putXML, putXMLRaw, dict2xml, xml2dict
-from .RTSPutils import downloadRTSP, downloadRTSPOnlyFrames, processSavedVideo
+from ._ContentMgmt import SearchMatch
+from .utils import getXML, getXMLRaw, postXML, postXMLRaw, deleteXMLRaw, deleteXML, putXML, putXMLRaw, dict2xml, xml2dict, saveStream, Checksum
+from .RTSPutils import downloadRTSP, downloadRTSPOnlyFrames, processSavedVideo, processVideoStream, needsProcessing
+from .remux import PSRemuxer, RemuxError, remuxVideoStream
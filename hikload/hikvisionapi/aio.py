@@ -0,0 +1,540 @@
+"""An asyncio version of the DVR/NVR client, using httpx.
+
+This is an optional part of hikvisionapi, which needs httpx to be installed
+(`pip install hikload[async]`). The XML helpers, the search descriptions and
+the playbackURI handling are shared with the blocking client.
+"""
+import asyncio
+import contextlib
+import copy
+import logging
+import os
+import uuid
+from datetime import datetime
+
+import httpx
+from lxml import etree
+
+import hikload.hikvisionapi as hikvisionapi
+from hikload.hikvisionapi._ContentMgmt import (
+    _downloadRequest, _resumableOffset, _searchDescription, _searchMatch, _writeSidecar, boundPlaybackURI,
+    shiftPlaybackURI)
+from hikload.hikvisionapi.classes import CircuitBreaker
+from hikload.hikvisionapi.utils import IDEMPOTENT_POSTS, RETRY_STATUSES
+
+logger = logging.getLogger('hikload')
+
+# The errors after which a request, or an interrupted download, is sent again
+RETRY_ERRORS = (httpx.NetworkError, httpx.TimeoutException, httpx.RemoteProtocolError)
+
+
+class AsyncHikvisionServer:
+    """This is the asyncio version of `HikvisionServer`.
+    All the requests are coroutines, and the connections to the DVR are kept
+    open in a single pool shared by all the tasks.
+
+    Parameters:
+        host (str): The host address, without `http` or `https`
+        user (str): The username for the DVR
+        password (str): The password
+        protocol (str): The intended protocol
+                        Should be `http`(default) or `https`
+        poolsize (int): The maximum number of connections kept open to the DVR (default is 10)
+        maxconnections (int): The maximum number of recordings downloaded at
+                              the same time from the DVR (default is unlimited)
+        retries (int): The number of times a request that can be safely repeated is
+                       retried, like in `HikvisionServer` (default is 3)
+        retryBackoff (float): The seconds waited before the first retry (default is 1)
+        maxBackoff (float): The most seconds waited before a retry (default is 30)
+        breakerThreshold (int): The number of failed requests in a row after which no more
+                                requests are sent for a while, see `CircuitBreaker` (default is 5)
+        breakerTimeout (float): The seconds no requests are sent for (default is 30)
+        bandwidthLimits (list): The `BandwidthLimiter`s the downloads from the DVR go through
+                                (default is no limit)
+
+    The connection errors are raised as `HikvisionException`.
+    """
+
+    def __init__(self, host, user, password, protocol="http", httptimeout: int | None = None, poolsize: int = 10,
+                 maxconnections: int | None = None, retries: int = 3, retryBackoff: float = 1.0,
+                 maxBackoff: float = 30.0, breakerThreshold: int = 5, breakerTimeout: float = 30.0,
+                 bandwidthLimits: list = ()):
+        self.host = host
+        self.protocol = protocol
+        self.user = user
+        self.password = password
+        self.poolsize = poolsize
+        self.retries = retries
+        self.retryBackoff = retryBackoff
+        self.maxBackoff = maxBackoff
+        # The breaker does not wait while it holds its lock, so it can be shared with the event loop
+        self.circuitBreaker = CircuitBreaker(host, breakerThreshold, breakerTimeout)
+        self.bandwidthLimits = list(bandwidthLimits)
+        if maxconnections:
+            self.downloadSlots = asyncio.BoundedSemaphore(maxconnections)
+        else:
+            self.downloadSlots = contextlib.nullcontext()
+        self.client = httpx.AsyncClient(
+            auth=httpx.DigestAuth(user, password),
+            limits=httpx.Limits(max_connections=poolsize, max_keepalive_connections=poolsize),
+            timeout=httptimeout)
+        self.System = _AsyncSystem(self, httptimeout)
+        self.Streaming = _AsyncStreaming(self, httptimeout)
+        self.ContentMgmt = _AsyncContentMgmt(self, httptimeout)
+
+    def __repr__(self) -> str:
+        return "%s(host=%s, protocol=%s, user=%s)" % (self.__class__.__name__, self.host, self.protocol, self.user)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # The retries are spaced out in the same way as the ones of the blocking client
+    retryDelay = hikvisionapi.HikvisionServer.retryDelay
+
+    async def throttle(self, size: int):
+        """Waits until `size` more bytes can be downloaded within the bandwidth limits"""
+        for limiter in self.bandwidthLimits:
+            delay = limiter.reserve(size)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        """This closes all the connections kept open to the DVR"""
+        await self.client.aclose()
+
+    def address(self, protocol: bool = True, credentials: bool = True):
+        """This returns the formatted address of the DVR
+
+        Parameters:
+            protocol (bool): Includes the `http`/`https` part in URL (default is True)
+            credentials (bool): Includes the credentials in URL (default is True)
+        """
+        string = ""
+        if protocol:
+            string += self.protocol + "://"
+        if credentials:
+            string += "%s:%s@" % (self.user, self.password)
+        string += self.host + "/ISAPI"
+        return string
+
+    async def test_connection(self):
+        """This method tests the connection to the DVR"""
+        try:
+            await self.System.getDeviceInfo()
+        except hikvisionapi.HikvisionException as e:
+            raise hikvisionapi.HikvisionException("Error while testing connection: %s" % e)
+
+
+@contextlib.contextmanager
+def _httpErrors():
+    try:
+        yield
+    except httpx.HTTPError as e:
+        raise hikvisionapi.HikvisionException("%s: %s" % (e.__class__.__name__, e)) from e
+
+
+def _checkResponse(response: dict) -> dict:
+    if 'ResponseStatus' in response:
+        if 'statusCode' in response['ResponseStatus']:
+            if response['ResponseStatus']['statusCode'] != '1':
+                raise hikvisionapi.HikvisionException(
+                    response['ResponseStatus']['statusString'])
+    if 'userCheck' in response:
+        if response['userCheck']['statusValue'] != 200:
+            raise hikvisionapi.HikvisionException(
+                response['userCheck']['statusString'])
+    return response
+
+
+async def requestXMLRaw(server: AsyncHikvisionServer, method: str, path: str, xmldata: str = None,
+                        rawResponse: bool = False, httptimeout: int | None = None, stream: bool = False,
+                        headers: dict = None):
+    """This returns the response of the DVR to the following request
+
+    Parameters:
+        server (AsyncHikvisionServer): The basic info about the DVR
+        method (str): The HTTP method of the request
+        path (str): The ISAPI path that will be executed
+        xmldata (str): This should be formatted using `utils.dict2xml`
+                       This is the data that will be transmitted to the server.
+                       It is optional.
+        rawResponse (bool): Returns the `httpx.Response` instead of the text
+        stream (bool): Does not read the body of the response until it is iterated.
+                       The response needs to be closed with `aclose()`
+        headers (dict): Extra HTTP headers sent with the request
+
+    The request goes through the circuit breaker of the server, and the requests that
+    can be safely repeated are retried after connection errors, timeouts and busy responses.
+    """
+    if xmldata is not None:
+        logger.debug("Data sent: %s" % xmldata)
+    request = server.client.build_request(
+        method, "%s/%s" % (server.address(credentials=False), path),
+        content=xmldata, headers={'Content-Type': 'application/xml', **(headers or {})},
+        timeout=httptimeout)
+    idempotent = method == "GET" or (method == "POST" and path in IDEMPOTENT_POSTS)
+    attempt = 0
+    while True:
+        server.circuitBreaker.before()
+        try:
+            with _httpErrors():
+                responseRaw = await server.client.send(request, stream=stream)
+        except hikvisionapi.HikvisionException as e:
+            if not isinstance(e.__cause__, RETRY_ERRORS):
+                raise
+            server.circuitBreaker.failed()
+            if not idempotent or attempt >= server.retries:
+                raise
+            delay = server.retryDelay(attempt)
+            logger.debug("%s %s failed (%s), retrying in %.2f seconds" % (method, path, e, delay))
+        else:
+            if responseRaw.status_code not in RETRY_STATUSES:
+                server.circuitBreaker.succeeded()
+                break
+            server.circuitBreaker.failed()
+            if not idempotent or attempt >= server.retries:
+                break
+            delay = server.retryDelay(attempt, responseRaw.headers.get("Retry-After"))
+            await responseRaw.aclose()
+            logger.debug("%s %s returned status code %s, retrying in %.2f seconds" % (
+                method, path, responseRaw.status_code, delay))
+        await asyncio.sleep(delay)
+        attempt += 1
+    if rawResponse:
+        return responseRaw
+    return responseRaw.text
+
+
+async def requestXML(server: AsyncHikvisionServer, method: str, path: str, data: dict = None, xmldata: str = None,
+                     httptimeout: int | None = None) -> dict:
+    """This returns the parsed response of the DVR to the following request
+
+    Parameters:
+        server (AsyncHikvisionServer): The basic info about the DVR
+        method (str): The HTTP method of the request
+        path (str): The ISAPI path that will be executed
+        data (dict): This is the data that will be transmitted to the server.
+                     It is optional, and will overwrite `xmldata`
+        xmldata (str): This should be formatted using `utils.dict2xml`
+                       This is the data that will be transmitted to the server.
+                       It is optional.
+    """
+    tosend = xmldata
+    if data:
+        tosend = hikvisionapi.dict2xml(data)
+    return _checkResponse(hikvisionapi.xml2dict(
+        await requestXMLRaw(server, method, path, xmldata=tosend, httptimeout=httptimeout)))
+
+
+async def getXML(server: AsyncHikvisionServer, path: str, data: dict = None, xmldata: str = None,
+                 httptimeout: int | None = None) -> dict:
+    return await requestXML(server, "GET", path, data=data, xmldata=xmldata, httptimeout=httptimeout)
+
+
+async def putXML(server: AsyncHikvisionServer, path: str, data: dict = None, xmldata: str = None,
+                 httptimeout: int | None = None) -> dict:
+    return await requestXML(server, "PUT", path, data=data, xmldata=xmldata, httptimeout=httptimeout)
+
+
+async def postXML(server: AsyncHikvisionServer, path: str, data: dict = None, xmldata: str = None,
+                  httptimeout: int | None = None) -> dict:
+    return await requestXML(server, "POST", path, data=data, xmldata=xmldata, httptimeout=httptimeout)
+
+
+async def deleteXML(server: AsyncHikvisionServer, path: str, data: dict = None, xmldata: str = None,
+                    httptimeout: int | None = None) -> dict:
+    return await requestXML(server, "DELETE", path, data=data, xmldata=xmldata, httptimeout=httptimeout)
+
+
+async def _raiseForStatus(response: httpx.Response, expected=(200,)):
+    if response.status_code not in expected:
+        await response.aread()
+        await response.aclose()
+        raise hikvisionapi.HikvisionException(
+            "Server returned status code %s: %s" % (response.status_code, response.text))
+
+
+async def saveStream(response: httpx.Response, filename: str, chunkSize: int = 1024 * 1024, offset: int = 0,
+                     progress=None, throttle=None) -> int:
+    """Writes the body of a streamed response to a file, chunk by chunk
+
+    Parameters:
+        response (httpx.Response): A response created with `stream=True`
+        filename (str): The path of the file that is written
+        chunkSize (int): The number of bytes read at once (default is 1MiB)
+        offset (int): The body is written starting from this byte of the file,
+                      keeping everything before it (default is 0)
+        progress (function): Called with the size of the file after every chunk
+        throttle (coroutine function): Awaited with the size of every chunk before the next
+                                       one is read, to keep the download within a bandwidth limit
+
+    Returns:
+        size (int): The size of the file
+    """
+    await _raiseForStatus(response, (200, 206))
+    try:
+        size = offset
+        # Writing to the local disk is fast compared to the DVR, so the chunks
+        # are written without leaving the event loop
+        with _httpErrors(), open(filename, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            async for chunk in response.aiter_bytes(chunk_size=chunkSize):
+                f.write(chunk)
+                size += len(chunk)
+                if progress is not None:
+                    f.flush()
+                    progress(size)
+                if throttle is not None:
+                    await throttle(len(chunk))
+    finally:
+        await response.aclose()
+    return size
+
+
+class _AsyncSystem():
+    def __init__(self, parent, httptimeout):
+        self.parent = parent
+        self.httptimeout = httptimeout
+
+    async def getDeviceInfo(self):
+        """
+        Returns the device info as a dictionary
+        """
+        return await getXML(self.parent, "System/deviceInfo", httptimeout=self.httptimeout)
+
+    async def getCapabilities(self):
+        """
+        It is used to get device capability.
+        """
+        return await getXML(self.parent, "System/capabilities", httptimeout=self.httptimeout)
+
+    async def reboot(self):
+        """
+        Reboot the device.
+        """
+        return await putXML(self.parent, "System/reboot", httptimeout=self.httptimeout)
+
+    async def getConfigurationData(self):
+        """
+        Get device’s configuration data.
+        """
+        return await getXML(self.parent, "System/configurationData", httptimeout=self.httptimeout)
+
+
+class _AsyncStreaming():
+    def __init__(self, parent, httptimeout):
+        self.parent = parent
+        self.httptimeout = httptimeout
+
+    async def status(self):
+        """
+        It is used to get a device streaming status
+        """
+        return await getXML(self.parent, "Streaming/status", httptimeout=self.httptimeout)
+
+    async def getChannels(self):
+        """
+        It is used to get the properties of streaming channels for the device
+        """
+        return await getXML(self.parent, "Streaming/channels", httptimeout=self.httptimeout)
+
+    async def getChannelByID(self, ChannelID):
+        """
+        It is used to get the properties of a particular streaming channel for the
+        device
+        """
+        return await getXML(self.parent, "Streaming/channels/%s" % ChannelID, httptimeout=self.httptimeout)
+
+    async def putChannelByID(self, ChannelID, StreamingChannel):
+        """
+        It is used to update the properties of a particular streaming channel for the
+        device
+        """
+        return await putXML(self.parent, "Streaming/channels/%s" % ChannelID,
+                            StreamingChannel, httptimeout=self.httptimeout)
+
+
+class _AsyncSearch():
+    def __init__(self, parent, httptimeout):
+        self.parent = parent.parent
+        self.httptimeout = httptimeout
+
+    async def profile(self):
+        """
+        Returns the types of searches supported by the device, see `_search.profile`
+        """
+        return await getXML(self.parent, "ContentMgmt/search/profile", httptimeout=self.httptimeout)
+
+    async def get(self, data: dict):
+        """
+        Returns all the recordings found by the search described by `data` as a list of `SearchMatch`
+        """
+        return [match async for match in self.iter(data)]
+
+    async def iter(self, data: dict):
+        """
+        Yields the recordings found by the search described by `data` as `SearchMatch`
+        records, one at a time, while each page of results is still being received.
+        The pages are requested one after another, until the DVR returns all the results.
+        """
+        data = copy.deepcopy(data)
+        timeSpan = data['CMSearchDescription']['timeSpanList']['timeSpan']
+        previousPage = set()
+        while True:
+            response = await requestXMLRaw(
+                self.parent, "POST", "ContentMgmt/search", xmldata=hikvisionapi.dict2xml(data),
+                httptimeout=self.httptimeout, rawResponse=True, stream=True)
+            await _raiseForStatus(response)
+            status = None
+            last = None
+            page = set()
+            parser = etree.XMLPullParser(events=("end",), remove_comments=True)
+            try:
+                with _httpErrors():
+                    async for chunk in response.aiter_bytes():
+                        parser.feed(chunk)
+                        for _, element in parser.read_events():
+                            tag = etree.QName(element).localname
+                            if tag == "responseStatusStrg":
+                                status = element.text
+                            elif tag == "statusString" and element.getparent().getparent() is None:
+                                # The root is a ResponseStatus, so the search failed
+                                raise hikvisionapi.HikvisionException(element.text)
+                            elif tag == "searchMatchItem":
+                                match = _searchMatch(element)
+                                # Free the items that were already yielded
+                                element.clear()
+                                while element.getprevious() is not None:
+                                    del element.getparent()[0]
+                                page.add(match.playbackURI)
+                                last = match
+                                # The next page starts with the last item of the previous one
+                                if match.playbackURI not in previousPage:
+                                    yield match
+                    parser.close()
+            finally:
+                await response.aclose()
+            if status != "MORE":
+                return
+            if last is None:
+                logger.error(
+                    "Server did not return any results, but says that there are MORE?")
+                return
+            logger.debug("Using %s as starttime and %s as endtime for the new search" % (
+                last.startTime, timeSpan['endTime']))
+            data['CMSearchDescription']['searchID'] = str(uuid.uuid4())
+            timeSpan['startTime'] = last.startTime
+            previousPage = page
+
+    def iterPastRecordingsForID(self, ChannelID, startTime="", endTime=""):
+        return self.iter(_searchDescription(ChannelID, startTime, endTime))
+
+    def iterAllRecordingsForID(self, ChannelID):
+        return self.iter(_searchDescription(
+            ChannelID, "2000-01-01T00:00:00Z", "2037-10-10T23:59:59Z"))
+
+    async def getPastRecordingsForID(self, ChannelID, startTime="", endTime=""):
+        return await self.get(_searchDescription(ChannelID, startTime, endTime))
+
+    async def getAllRecordingsForID(self, ChannelID):
+        return await self.get(_searchDescription(
+            ChannelID, "2000-01-01T00:00:00Z", "2037-10-10T23:59:59Z"))
+
+    async def get_download_capabilities(self):
+        return await getXML(self.parent, "ContentMgmt/download/capabilities", httptimeout=self.httptimeout)
+
+    async def _download(self, dictdata: dict, headers: dict = None) -> httpx.Response:
+        return await requestXMLRaw(self.parent, "GET", "ContentMgmt/download",
+                                   xmldata=hikvisionapi.dict2xml(dictdata), rawResponse=True,
+                                   httptimeout=self.httptimeout, stream=True, headers=headers)
+
+    async def downloadURI(self, playbackURI, filename: str, chunkSize: int = 1024 * 1024, resume: bool = True,
+                          startTime: datetime = None, endTime: datetime = None):
+        """
+        Downloads a recording using its playbackURI to `filename`, like `_search.downloadURI`.
+        The recording is streamed to `filename`.part and interrupted downloads are resumed
+        in the same way, so both clients can continue each other's downloads.
+        If `startTime` or `endTime` are given, only that part of the recording is requested.
+        If the transfer is interrupted, it is resumed up to `retries` times of the server.
+        """
+        if startTime is not None or endTime is not None:
+            playbackURI = boundPlaybackURI(playbackURI, startTime, endTime)
+        partname = filename + ".part"
+        attempt = 0
+        while True:
+            try:
+                await self._downloadPart(playbackURI, filename, partname, chunkSize, resume)
+                break
+            except hikvisionapi.HikvisionException as e:
+                # The part file keeps what was received, so the download continues from there
+                if not isinstance(e.__cause__, RETRY_ERRORS) or not resume or attempt >= self.parent.retries:
+                    raise
+                delay = self.parent.retryDelay(attempt)
+                logger.warning("The download of %s was interrupted (%s), resuming in %.2f seconds" % (
+                    filename, e, delay))
+                await asyncio.sleep(delay)
+                attempt += 1
+        size = os.path.getsize(partname)
+        os.replace(partname, filename)
+        os.remove(partname + ".json")
+        return size
+
+    async def _downloadPart(self, playbackURI, filename: str, partname: str, chunkSize: int, resume: bool):
+        dictdata = _downloadRequest(playbackURI)
+        offset = _resumableOffset(partname, playbackURI) if resume else 0
+        headers = None
+        if offset:
+            logger.debug("Resuming download of %s from byte %s" % (filename, offset))
+            headers = {'Range': 'bytes=%s-' % offset}
+        async with self.parent.downloadSlots:
+            response = await self._download(dictdata, headers)
+            if offset and response.status_code == 416:
+                # The part file already holds the whole recording
+                await response.aclose()
+            else:
+                if offset and response.status_code == 200:
+                    shifted = shiftPlaybackURI(playbackURI, offset)
+                    if shifted is not None:
+                        logger.debug(
+                            "The server ignored the byte range, resuming %s from %s" % (filename, shifted))
+                        await response.aclose()
+                        dictdata['downloadRequest']['playbackURI'] = shifted
+                        response = await self._download(dictdata)
+                    else:
+                        logger.debug(
+                            "The server ignored the byte range, downloading %s from the start" % filename)
+                        offset = 0
+                _writeSidecar(partname, playbackURI, offset)
+                await saveStream(response, partname, chunkSize, offset=offset,
+                                 progress=lambda size: _writeSidecar(partname, playbackURI, size),
+                                 throttle=self.parent.throttle)
+
+    async def iterDownloadURI(self, playbackURI, chunkSize: int = 1024 * 1024, startTime: datetime = None,
+                              endTime: datetime = None):
+        """
+        Yields the recording with the given playbackURI in chunks of `chunkSize` bytes,
+        as they are received from the DVR.
+        If `startTime` or `endTime` are given, only that part of the recording is requested.
+        """
+        if startTime is not None or endTime is not None:
+            playbackURI = boundPlaybackURI(playbackURI, startTime, endTime)
+        async with self.parent.downloadSlots:
+            response = await self._download(_downloadRequest(playbackURI))
+            await _raiseForStatus(response)
+            try:
+                with _httpErrors():
+                    async for chunk in response.aiter_bytes(chunk_size=chunkSize):
+                        yield chunk
+                        await self.parent.throttle(len(chunk))
+            finally:
+                await response.aclose()
+
+
+class _AsyncContentMgmt():
+    def __init__(self, parent, httptimeout=None):
+        self.parent = parent
+        self.search = _AsyncSearch(self, httptimeout)
@@ -1,13 +1,256 @@
 from hikload.hikvisionapi._System import _System
 from hikload.hikvisionapi._Streaming import _Streaming
 from hikload.hikvisionapi._ContentMgmt import _ContentMgmt
-from requests.exceptions import ConnectionError
+import contextlib
+import logging
+import math
+import random
+import threading
+import time
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+from requests.exceptions import ConnectionError, RequestException
+
+logger = logging.getLogger('hikload')
 
 
 class HikvisionException(Exception):
     pass
 
 
+class AdaptiveLimiter:
+    """This limits the number of requests sent at the same time to a DVR,
+    adjusting the limit with additive-increase/multiplicative-decrease.
+
+    Every response received quickly raises the limit by 1/limit, so it grows by
+    one after a full round of requests. An error, a response much slower than the
+    fastest ones or a transfer much slower per connection than the fastest ones
+    cut the limit by `decrease`. It is used as a context manager, like a semaphore.
+    Jobs that are not requests, like concatenating channels, are recorded with `finished`.
+
+    Parameters:
+        maximum (int): The highest limit
+        minimum (int): The lowest limit (default is 1)
+        latencyFactor (float): How many times slower than the fastest ones a response or
+                               a transfer can be before the DVR is considered overloaded
+                               (default is 2)
+        decrease (float): The limit is multiplied by this when the DVR is overloaded (default is 0.5)
+        name (str): What is limited, used in the log messages (default is "requests")
+    """
+
+    # Only the transfers that took at least this many seconds are measured
+    MIN_TRANSFER_SECONDS = 1.0
+    # Responses are never considered slow if they are only this many seconds slower
+    LATENCY_TOLERANCE = 0.1
+
+    def __init__(self, maximum: int, minimum: int = 1, latencyFactor: float = 2.0, decrease: float = 0.5,
+                 name: str = "requests"):
+        self.maximum = max(maximum, minimum)
+        self.minimum = minimum
+        self.latencyFactor = latencyFactor
+        self.decrease = decrease
+        self.name = name
+        self.limit = float(minimum)
+        self.inflight = 0
+        self.latency = None
+        self.throughput = None
+        # The requests that were already sent when the limit was decreased
+        # say nothing about the new limit, so they are ignored
+        self._ignored = 0
+        self._condition = threading.Condition()
+
+    def __repr__(self) -> str:
+        return "%s(limit=%.2f, inflight=%s)" % (self.__class__.__name__, self.limit, self.inflight)
+
+    def __enter__(self):
+        with self._condition:
+            while self.inflight >= int(self.limit):
+                self._condition.wait()
+            self.inflight += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self._condition:
+            self.inflight -= 1
+            if exc_type is not None and issubclass(exc_type, (HikvisionException, RequestException)):
+                self._congested("%s" % exc_type.__name__)
+            self._condition.notify_all()
+
+    def responded(self, latency: float, ok: bool = True):
+        """Records the time it took the DVR to answer a request"""
+        with self._condition:
+            if not ok:
+                self._congested("server error")
+            elif self.latency is not None and \
+                    latency > max(self.latency * self.latencyFactor, self.latency + self.LATENCY_TOLERANCE):
+                self._congested("response after %.2f seconds" % latency)
+            else:
+                self._increase()
+            # The fastest response is remembered, but slowly forgotten, in case the
+            # network or the DVR changed
+            if self.latency is None or latency < self.latency:
+                self.latency = latency
+            else:
+                self.latency += (latency - self.latency) * 0.05
+
+    def transferred(self, size: int, seconds: float):
+        """Records the speed of a finished transfer"""
+        with self._condition:
+            self._transferred(size, seconds)
+
+    def finished(self, size: int, seconds: float):
+        """Records a finished job that is only limited by its throughput, like copying
+        videos on a disk. The limit is raised, unless the job was much slower than the fastest ones"""
+        with self._condition:
+            if self._transferred(size, seconds):
+                self._increase()
+
+    def _transferred(self, size: int, seconds: float) -> bool:
+        # Returns False if the transfer was much slower than the fastest ones
+        if seconds < self.MIN_TRANSFER_SECONDS or size <= 0:
+            # The speed of short transfers mostly depends on the latency
+            return True
+        throughput = size / seconds
+        fast = self.throughput is None or throughput * self.latencyFactor >= self.throughput
+        if not fast:
+            self._congested("transfer at %.0f B/s" % throughput)
+        if self.throughput is None or throughput > self.throughput:
+            self.throughput = throughput
+        else:
+            self.throughput += (throughput - self.throughput) * 0.05
+        return fast
+
+    def _increase(self):
+        if self._ignored > 0:
+            self._ignored -= 1
+            return
+        previous = int(self.limit)
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        if int(self.limit) != previous:
+            logger.debug("Raised the limit of simultaneous %s to %s" % (self.name, int(self.limit)))
+            self._condition.notify_all()
+
+    def _congested(self, reason: str):
+        if self._ignored > 0:
+            self._ignored -= 1
+            return
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        self._ignored = self.inflight
+        logger.debug("Lowered the limit of simultaneous %s to %s (%s)" % (self.name, int(self.limit), reason))
+
+
+class CircuitBreaker:
+    """This stops sending requests to a DVR that keeps failing, for example while
+    it reboots, instead of waiting for every request to time out.
+
+    After `threshold` requests fail in a row, the requests are refused for `timeout`
+    seconds. Then a single request is let through, and the DVR is used again if it
+    succeeds, or refused for another `timeout` seconds if it fails.
+
+    Parameters:
+        host (str): The DVR, used in the error messages
+        threshold (int): The number of failed requests in a row that stop the requests.
+                         0 disables the circuit breaker (default is 5)
+        timeout (float): The number of seconds the requests are refused for (default is 30)
+    """
+
+    def __init__(self, host: str, threshold: int = 5, timeout: float = 30.0):
+        self.host = host
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.openUntil = 0.0
+        self._lock = threading.Lock()
+
+    def before(self):
+        """Raises a HikvisionException if no requests should be sent to the DVR now"""
+        if not self.threshold:
+            return
+        with self._lock:
+            if self.failures < self.threshold:
+                return
+            now = time.monotonic()
+            if now < self.openUntil:
+                raise HikvisionException(
+                    "%s is not responding, not sending requests for %d more seconds" % (
+                        self.host, math.ceil(self.openUntil - now)))
+            # Only this request is let through until it finishes
+            self.openUntil = now + self.timeout
+
+    def succeeded(self):
+        with self._lock:
+            if self.threshold and self.failures >= self.threshold:
+                logger.info("%s is responding again" % self.host)
+            self.failures = 0
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.threshold and self.failures >= self.threshold:
+                if self.failures == self.threshold:
+                    logger.warning("%s is not responding, not sending requests for %s seconds" % (
+                        self.host, self.timeout))
+                self.openUntil = time.monotonic() + self.timeout
+
+
+class BandwidthLimiter:
+    """This is a token bucket that limits the download speed of all the workers
+    that share it, for example to keep a site uplink usable during work hours.
+
+    Every downloaded chunk takes its size in tokens from the bucket, which is refilled
+    at `rate` bytes per second and holds at most one second of tokens. A worker that
+    finds the bucket empty waits until enough tokens are added.
+
+    Parameters:
+        rate (int): The maximum bytes per second, or None for no limit
+        schedule (list): Tuples of (start, end, rate) with the `datetime.time` of the
+                         day between which `rate` is used instead, in the local time.
+                         A window can pass midnight, like 22:00-06:00 (default is none)
+    """
+
+    def __init__(self, rate: int | None, schedule: list = ()):
+        self.rate = rate
+        self.schedule = list(schedule)
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def currentRate(self) -> int | None:
+        """Returns the bytes per second allowed now, or None if there is no limit"""
+        if not self.schedule:
+            return self.rate
+        now = datetime.now().time()
+        for start, end, rate in self.schedule:
+            if (start <= now < end) if start <= end else (now >= start or now < end):
+                return rate
+        return self.rate
+
+    def reserve(self, size: int) -> float:
+        """Takes `size` tokens from the bucket and returns the seconds to wait before
+        using them. The bucket can go into debt, so chunks larger than the bucket
+        still pass, and the workers that come later wait for them"""
+        rate = self.currentRate()
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.updated = now
+            if not rate:
+                return 0.0
+            self.tokens = min(float(rate), self.tokens + elapsed * rate) - size
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / rate
+
+    def consume(self, size: int):
+        """Waits until `size` bytes can be downloaded"""
+        delay = self.reserve(size)
+        if delay > 0:
+            time.sleep(delay)
+
+
 class HikvisionServer:
     """This is a class for storing basic info about a DVR/NVR.
 
@@ -17,13 +260,51 @@ class HikvisionServer:
         password (str): The password
         protocol (str): The intended protocol
                         Should be `http`(default) or `https`
+        poolsize (int): The maximum number of keep-alive connections kept
+                        open to the DVR (default is 10)
+        maxconnections (int): The maximum number of recordings downloaded at
+                              the same time from the DVR (default is unlimited)
+        adaptive (bool): Adjusts the number of downloads and searches sent at the same
+                         time to the DVR using an `AdaptiveLimiter`, up to `maxconnections`
+                         and `poolsize` (default is False)
+        retries (int): The number of times a request that can be safely repeated is
+                       retried after a connection error, a timeout or a 502, 503 or 504
+                       response, and an interrupted download is resumed (default is 3)
+        retryBackoff (float): The seconds waited before the first retry, doubled after
+                              every retry, with random jitter (default is 1)
+        maxBackoff (float): The most seconds waited before a retry (default is 30)
+        breakerThreshold (int): The number of failed requests in a row after which no more
+                                requests are sent for a while, see `CircuitBreaker` (default is 5)
+        breakerTimeout (float): The seconds no requests are sent for (default is 30)
+        bandwidthLimits (list): The `BandwidthLimiter`s the downloads from the DVR go through.
+                                A limiter can be shared with other servers, to limit the
+                                total speed (default is no limit)
     """
 
-    def __init__(self, host, user, password, protocol="http", httptimeout: int | None = None):
+    def __init__(self, host, user, password, protocol="http", httptimeout: int | None = None, poolsize: int = 10,
+                 maxconnections: int | None = None, adaptive: bool = False, retries: int = 3,
+                 retryBackoff: float = 1.0, maxBackoff: float = 30.0, breakerThreshold: int = 5,
+                 breakerTimeout: float = 30.0, bandwidthLimits: list = ()):
         self.host = host
         self.protocol = protocol
         self.user = user
         self.password = password
+        self.poolsize = poolsize
+        self.retries = retries
+        self.retryBackoff = retryBackoff
+        self.maxBackoff = maxBackoff
+        self.circuitBreaker = CircuitBreaker(host, breakerThreshold, breakerTimeout)
+        self.bandwidthLimits = list(bandwidthLimits)
+        if adaptive:
+            self.downloadSlots = AdaptiveLimiter(maxconnections or poolsize)
+            self.searchSlots = AdaptiveLimiter(poolsize)
+        else:
+            if maxconnections:
+                self.downloadSlots = threading.BoundedSemaphore(maxconnections)
+            else:
+                self.downloadSlots = contextlib.nullcontext()
+            self.searchSlots = contextlib.nullcontext()
+        self.session = self._create_session()
         self.System = _System(self, httptimeout)
         self.Streaming = _Streaming(self, httptimeout)
         self.ContentMgmt = _ContentMgmt(self, httptimeout)
@@ -44,6 +325,52 @@ class HikvisionServer:
         else:
             return not result
 
+    def _create_session(self) -> requests.Session:
+        # The digest auth handler keeps the nonce per thread, so every worker
+        # only pays for the 401 challenge once and then reuses it
+        session = requests.Session()
+        session.auth = HTTPDigestAuth(self.user, self.password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.poolsize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.hooks["response"].append(self._measureResponse)
+        return session
+
+    def _measureResponse(self, response, *args, **kwargs):
+        # The time until the headers were received, which is the time the DVR
+        # needed to start answering
+        if "/ContentMgmt/download" in response.url:
+            slots = self.downloadSlots
+        elif "/ContentMgmt/search" in response.url:
+            slots = self.searchSlots
+        else:
+            return
+        if isinstance(slots, AdaptiveLimiter) and response.status_code != 401:
+            slots.responded(response.elapsed.total_seconds(), ok=response.status_code < 500)
+
+    def retryDelay(self, attempt: int, retryAfter: str = None) -> float:
+        """Returns the seconds to wait before retrying a request that failed `attempt` + 1 times"""
+        if retryAfter is not None and retryAfter.isdigit():
+            # The DVR said when it can answer again
+            return min(float(retryAfter), self.maxBackoff)
+        delay = min(self.maxBackoff, self.retryBackoff * 2 ** attempt)
+        # Half of the delay is random, so the workers do not retry all at once
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def measureTransfer(self, size: int, seconds: float):
+        """Records the speed of a finished download, when the downloads are adaptive"""
+        if isinstance(self.downloadSlots, AdaptiveLimiter):
+            self.downloadSlots.transferred(size, seconds)
+
+    def throttle(self, size: int):
+        """Waits until `size` more bytes can be downloaded within the bandwidth limits"""
+        for limiter in self.bandwidthLimits:
+            limiter.consume(size)
+
+    def close(self):
+        """This closes all the connections kept open to the DVR"""
+        self.session.close()
+
     def address(self, protocol: bool = True, credentials: bool = True):
         """This returns the formatted address of the DVR
 
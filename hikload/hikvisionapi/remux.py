@@ -0,0 +1,676 @@
+import itertools
+import logging
+import os
+import struct
+from collections import deque
+
+logger = logging.getLogger('hikload')
+
+# The stream types of the program stream map used by the DVRs for their video
+STREAM_TYPES = {
+    0x1b: "h264",
+    0x24: "hevc",
+}
+
+# The timestamps of MPEG-PS use a 90kHz clock with 33 bits
+CLOCK = 90000
+WRAP = 1 << 33
+# The duration of a frame without timestamps, until there are two frames to compare
+DEFAULT_FRAME_DURATION = CLOCK // 25
+# The timestamps further than this from the last frame are a jump of the clock of the DVR
+MAX_TIMESTAMP_GAP = 10 * CLOCK
+
+START_CODE = b"\x00\x00\x01"
+
+
+class RemuxError(Exception):
+    """The downloaded stream could not be remuxed, like ffmpeg.Error for ffmpeg"""
+
+
+def _box(kind: bytes, *payload: bytes) -> bytes:
+    data = b"".join(payload)
+    return struct.pack(">I", 8 + len(data)) + kind + data
+
+
+def _fullBox(kind: bytes, version: int, flags: int, *payload: bytes) -> bytes:
+    return _box(kind, struct.pack(">I", version << 24 | flags), *payload)
+
+
+def _timestamp(data: bytes) -> int:
+    # A PTS or DTS of a PES header, spread over 5 bytes with marker bits
+    return ((data[0] >> 1) & 0x07) << 30 | data[1] << 22 | (data[2] >> 1) << 15 | data[3] << 7 | data[4] >> 1
+
+
+def _rbsp(nal: bytes) -> bytes:
+    # Removes the emulation prevention bytes, so the bits of the NAL can be read
+    return nal.replace(b"\x00\x00\x03", b"\x00\x00")
+
+
+class BitReader():
+    """Reads the bits of a NAL unit, including its Exp-Golomb codes"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.position = 0
+
+    def bits(self, count: int) -> int:
+        value = 0
+        for _ in range(count):
+            if self.position >> 3 >= len(self.data):
+                raise RemuxError("The parameter set of the video is truncated")
+            value = value << 1 | (self.data[self.position >> 3] >> (7 - (self.position & 7))) & 1
+            self.position += 1
+        return value
+
+    def ue(self) -> int:
+        zeros = 0
+        while self.bits(1) == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self) -> int:
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def _h264Sps(sps: bytes) -> dict:
+    # Reads the fields of an H.264 sequence parameter set needed by the remuxer
+    reader = BitReader(_rbsp(sps[1:]))
+    profile = reader.bits(8)
+    reader.bits(16)
+    reader.ue()
+    chromaFormat, bitDepthLuma, bitDepthChroma = 1, 8, 8
+    separateColourPlanes = 0
+    if profile in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chromaFormat = reader.ue()
+        if chromaFormat == 3:
+            separateColourPlanes = reader.bits(1)
+        bitDepthLuma = reader.ue() + 8
+        bitDepthChroma = reader.ue() + 8
+        reader.bits(1)
+        if reader.bits(1):
+            for i in range(8 if chromaFormat != 3 else 12):
+                if reader.bits(1):
+                    last, next = 8, 8
+                    for _ in range(16 if i < 6 else 64):
+                        if next != 0:
+                            next = (last + reader.se() + 256) % 256
+                        last = next if next != 0 else last
+    log2MaxFrameNum = reader.ue() + 4
+    pocType = reader.ue()
+    log2MaxPocLsb = None
+    if pocType == 0:
+        log2MaxPocLsb = reader.ue() + 4
+    elif pocType == 1:
+        reader.bits(1)
+        reader.se()
+        reader.se()
+        for _ in range(reader.ue()):
+            reader.se()
+    reader.ue()
+    reader.bits(1)
+    widthInMbs = reader.ue() + 1
+    heightInMapUnits = reader.ue() + 1
+    frameMbsOnly = reader.bits(1)
+    if not frameMbsOnly:
+        reader.bits(1)
+    reader.bits(1)
+    cropLeft = cropRight = cropTop = cropBottom = 0
+    if reader.bits(1):
+        cropLeft, cropRight, cropTop, cropBottom = reader.ue(), reader.ue(), reader.ue(), reader.ue()
+    if separateColourPlanes or chromaFormat == 0:
+        cropX, cropY = 1, 2 - frameMbsOnly
+    else:
+        cropX = 1 if chromaFormat == 3 else 2
+        cropY = (2 if chromaFormat == 1 else 1) * (2 - frameMbsOnly)
+    width = widthInMbs * 16 - cropX * (cropLeft + cropRight)
+    height = (2 - frameMbsOnly) * heightInMapUnits * 16 - cropY * (cropTop + cropBottom)
+    return {
+        "profile": profile, "chromaFormat": chromaFormat, "bitDepthLuma": bitDepthLuma,
+        "bitDepthChroma": bitDepthChroma, "separateColourPlanes": separateColourPlanes,
+        "log2MaxFrameNum": log2MaxFrameNum, "pocType": pocType, "log2MaxPocLsb": log2MaxPocLsb,
+        "frameMbsOnly": frameMbsOnly, "width": width, "height": height,
+    }
+
+
+def _h264Config(sps: bytes, pps: bytes) -> tuple:
+    # Returns the width, height and avcC box of an H.264 stream
+    fields = _h264Sps(sps)
+    avcC = struct.pack(">BBBBBB", 1, sps[1], sps[2], sps[3], 0xFF, 0xE1) + \
+        struct.pack(">H", len(sps)) + sps + b"\x01" + struct.pack(">H", len(pps)) + pps
+    if fields["profile"] in (100, 110, 122, 144):
+        avcC += struct.pack(">BBBB", 0xFC | fields["chromaFormat"], 0xF8 | (fields["bitDepthLuma"] - 8),
+                            0xF8 | (fields["bitDepthChroma"] - 8), 0)
+    return fields["width"], fields["height"], _box(b"avcC", avcC)
+
+
+def _h264PocLsb(nal: bytes, sps: dict) -> int | None:
+    # Returns the pic_order_cnt_lsb of the first slice of an H.264 frame, or None if
+    # the frames are not reordered or are fields
+    if sps["pocType"] != 0:
+        return None
+    reader = BitReader(_rbsp(nal[1:64]))
+    reader.ue()
+    reader.ue()
+    reader.ue()
+    if sps["separateColourPlanes"]:
+        reader.bits(2)
+    reader.bits(sps["log2MaxFrameNum"])
+    if not sps["frameMbsOnly"] and reader.bits(1):
+        return None
+    if nal[0] & 0x1F == 5:
+        reader.ue()
+    return reader.bits(sps["log2MaxPocLsb"])
+
+
+def _hevcSps(sps: bytes) -> dict:
+    # Reads the fields of an H.265 sequence parameter set needed by the remuxer
+    rbsp = _rbsp(sps[2:])
+    reader = BitReader(rbsp)
+    reader.bits(4)
+    maxSubLayers = reader.bits(3)
+    temporalIdNesting = reader.bits(1)
+    # The general profile, tier and level are copied to the hvcC as they are
+    generalProfile = rbsp[1:13]
+    reader.bits(96)
+    subLayers = [(reader.bits(1), reader.bits(1)) for _ in range(maxSubLayers)]
+    if maxSubLayers > 0:
+        reader.bits(2 * (8 - maxSubLayers))
+    for profilePresent, levelPresent in subLayers:
+        reader.bits(88 if profilePresent else 0)
+        reader.bits(8 if levelPresent else 0)
+    reader.ue()
+    chromaFormat = reader.ue()
+    separateColourPlanes = reader.bits(1) if chromaFormat == 3 else 0
+    width = reader.ue()
+    height = reader.ue()
+    if reader.bits(1):
+        left, right, top, bottom = reader.ue(), reader.ue(), reader.ue(), reader.ue()
+        width -= (1 if chromaFormat in (0, 3) else 2) * (left + right)
+        height -= (2 if chromaFormat == 1 else 1) * (top + bottom)
+    bitDepthLuma = reader.ue() + 8
+    bitDepthChroma = reader.ue() + 8
+    return {
+        "maxSubLayers": maxSubLayers, "temporalIdNesting": temporalIdNesting, "generalProfile": generalProfile,
+        "chromaFormat": chromaFormat, "separateColourPlanes": separateColourPlanes, "width": width,
+        "height": height, "bitDepthLuma": bitDepthLuma, "bitDepthChroma": bitDepthChroma,
+        "log2MaxPocLsb": reader.ue() + 4,
+    }
+
+
+def _hevcConfig(vps: bytes, sps: bytes, pps: bytes) -> tuple:
+    # Returns the width, height and hvcC box of an H.265 stream
+    fields = _hevcSps(sps)
+    hvcC = b"\x01" + fields["generalProfile"] + struct.pack(
+        ">HBBBBHBB", 0xF000, 0xFC, 0xFC | fields["chromaFormat"], 0xF8 | (fields["bitDepthLuma"] - 8),
+        0xF8 | (fields["bitDepthChroma"] - 8), 0,
+        (fields["maxSubLayers"] + 1) << 3 | fields["temporalIdNesting"] << 2 | 3, 3)
+    for nalType, nal in ((32, vps), (33, sps), (34, pps)):
+        hvcC += struct.pack(">BHH", 0x80 | nalType, 1, len(nal)) + nal
+    return fields["width"], fields["height"], _box(b"hvcC", hvcC)
+
+
+def _hevcPps(pps: bytes) -> dict:
+    # Reads the fields of an H.265 picture parameter set needed to read the slice headers
+    reader = BitReader(_rbsp(pps[2:]))
+    reader.ue()
+    reader.ue()
+    reader.bits(1)
+    return {"outputFlagPresent": reader.bits(1), "extraSliceHeaderBits": reader.bits(3)}
+
+
+def _hevcPocLsb(nal: bytes, sps: dict, pps: dict) -> int:
+    # Returns the slice_pic_order_cnt_lsb of the first slice of an H.265 frame
+    nalType = (nal[0] >> 1) & 0x3F
+    if nalType in (19, 20):
+        # An IDR frame starts the count again
+        return 0
+    reader = BitReader(_rbsp(nal[2:64]))
+    reader.bits(1)
+    if 16 <= nalType <= 23:
+        reader.bits(1)
+    reader.ue()
+    reader.bits(pps["extraSliceHeaderBits"])
+    reader.ue()
+    if pps["outputFlagPresent"]:
+        reader.bits(1)
+    if sps["separateColourPlanes"]:
+        reader.bits(2)
+    return reader.bits(sps["log2MaxPocLsb"])
+
+
+class PSRemuxer():
+    """Remuxes the MPEG-PS stream downloaded from a DVR into an MP4 file while it is
+    downloaded, without ffmpeg. Only the H.264 or H.265 video is kept.
+
+    The PES packets of the video are joined into frames, which are written to the
+    mdat box as soon as they are complete, and the index of the frames is written in
+    the moov box at the end, so the data is only read once.
+
+    Parameters:
+        f (file): The binary file the MP4 is written to, which must be seekable
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self._buffer = bytearray()
+        self._streamTypes = {}
+        self._videoStream = None
+        self._skippedStreams = set()
+        # The elementary stream of the video, from the absolute offset _esOffset
+        self._es = bytearray()
+        self._esOffset = 0
+        self._timestamps = deque()
+        self._frame = None
+        self._codec = None
+        self._parameterSets = {}
+        self._config = None
+        self._mdatStart = None
+        # The index of the written frames
+        self._sizes = []
+        self._offsets = []
+        self._dts = []
+        self._compositionOffsets = []
+        self._keyframes = []
+        # The frames that had their own timestamps, and the (period, count) of their picture
+        # order count, which gives the presentation order of the frames between two resets
+        self._timed = []
+        self._pocs = []
+        self._sliceParameters = None
+        self._pocPeriod = 0
+        self._previousPoc = None
+        self._lastTimestamp = None
+        # Added to the timestamps of the DVR after they jump, so the video stays continuous
+        self._shift = 0
+        self._frameDuration = DEFAULT_FRAME_DURATION
+        self._lastTimedFrame = None
+
+    def write(self, data: bytes):
+        """Remuxes the next bytes of the stream"""
+        self._buffer += data
+        position = 0
+        while True:
+            if self._buffer[position:position + 3] != START_CODE:
+                found = self._buffer.find(START_CODE, position)
+                if found < 0:
+                    # Keep the bytes that could be the start of a start code
+                    position = max(position, len(self._buffer) - 2)
+                    break
+                logger.debug("Skipping %s bytes that are not part of the stream" % (found - position))
+                position = found
+            length = self._unitLength(position)
+            if length is None or position + length > len(self._buffer):
+                break
+            self._unit(bytes(self._buffer[position:position + length]))
+            position += length
+        del self._buffer[:position]
+        self._scan()
+
+    def _unitLength(self, position: int) -> int | None:
+        # Returns the length of the pack header, PES packet or other unit at position
+        if position + 6 > len(self._buffer):
+            return None
+        streamId = self._buffer[position + 3]
+        if streamId == 0xBA:
+            if position + 14 > len(self._buffer):
+                return None
+            if self._buffer[position + 4] & 0xC0 == 0x40:
+                return 14 + (self._buffer[position + 13] & 0x07)
+            # An MPEG-1 pack header
+            return 12
+        if streamId == 0xB9:
+            return 4
+        if streamId < 0xB9:
+            # A start code of the video inside a broken packet
+            return 3
+        return 6 + struct.unpack(">H", self._buffer[position + 4:position + 6])[0]
+
+    def _unit(self, unit: bytes):
+        streamId = unit[3]
+        if streamId == 0xBC:
+            self._programStreamMap(unit)
+        elif 0xE0 <= streamId <= 0xEF:
+            if self._videoStream is None:
+                self._videoStream = streamId
+            if streamId == self._videoStream:
+                self._videoPacket(unit)
+        elif 0xC0 <= streamId <= 0xDF or streamId == 0xBD:
+            if streamId not in self._skippedStreams:
+                self._skippedStreams.add(streamId)
+                logger.debug("Leaving out stream 0x%x, only the video is remuxed" % streamId)
+
+    def _programStreamMap(self, unit: bytes):
+        infoLength = struct.unpack(">H", unit[8:10])[0]
+        position = 10 + infoLength
+        end = position + 2 + struct.unpack(">H", unit[position:position + 2])[0]
+        position += 2
+        while position + 4 <= min(end, len(unit)):
+            streamType, streamId, esInfoLength = struct.unpack(">BBH", unit[position:position + 4])
+            self._streamTypes[streamId] = streamType
+            position += 4 + esInfoLength
+
+    def _videoPacket(self, unit: bytes):
+        pts = dts = None
+        if len(unit) >= 9 and unit[6] & 0xC0 == 0x80:
+            flags = unit[7] >> 6
+            payload = 9 + unit[8]
+            if flags & 0x02 and len(unit) >= 14:
+                pts = _timestamp(unit[9:14])
+                dts = _timestamp(unit[14:19]) if flags == 0x03 and len(unit) >= 19 else pts
+        else:
+            # An MPEG-1 header, after the stuffing bytes and the buffer size
+            payload = 6
+            while payload < len(unit) and unit[payload] == 0xFF:
+                payload += 1
+            if payload < len(unit) and unit[payload] & 0xC0 == 0x40:
+                payload += 2
+            if payload < len(unit) and unit[payload] & 0xE0 == 0x20 and len(unit) >= payload + 5:
+                pts = dts = _timestamp(unit[payload:payload + 5])
+                if unit[payload] & 0x10 and len(unit) >= payload + 10:
+                    dts = _timestamp(unit[payload + 5:payload + 10])
+                payload += 10 if unit[payload] & 0x10 else 5
+            else:
+                payload += 1
+        if pts is not None:
+            # The timestamps are for the first frame that starts in this packet
+            self._timestamps.append((self._esOffset + len(self._es), pts, dts))
+        self._es += unit[payload:]
+
+    def _scan(self, final: bool = False):
+        # Splits the complete NAL units of the elementary stream into frames
+        start = self._es.find(START_CODE)
+        while start >= 0:
+            end = self._es.find(START_CODE, start + 3)
+            if end < 0:
+                if not final:
+                    break
+                end = len(self._es)
+            nal = bytes(self._es[start + 3:end]).rstrip(b"\x00")
+            if nal:
+                self._nal(nal, self._esOffset + start)
+            start = end if end < len(self._es) else -1
+        # Only the NAL unit that is not complete yet is kept
+        keep = start if start >= 0 else len(self._es)
+        del self._es[:keep]
+        self._esOffset += keep
+
+    def _detectCodec(self, nal: bytes):
+        streamType = self._streamTypes.get(self._videoStream)
+        if streamType in STREAM_TYPES:
+            self._codec = STREAM_TYPES[streamType]
+        elif len(nal) > 1 and (nal[0] >> 1) & 0x3F == 32 and nal[1] == 0x01:
+            # Without a program stream map, a VPS means H.265
+            self._codec = "hevc"
+        else:
+            self._codec = "h264"
+        logger.debug("Remuxing %s video" % self._codec)
+
+    def _nal(self, nal: bytes, offset: int):
+        if self._codec is None:
+            self._detectCodec(nal)
+        if self._codec == "hevc":
+            nalType = (nal[0] >> 1) & 0x3F
+            slice = nalType < 32
+            keyframe = 16 <= nalType <= 21
+            firstSlice = slice and len(nal) > 2 and nal[2] & 0x80
+            delimiter = nalType == 35
+            prefix = nalType in (32, 33, 34, 39) or 41 <= nalType <= 44 or 48 <= nalType <= 55
+            parameterSet = {32: "vps", 33: "sps", 34: "pps"}.get(nalType)
+        else:
+            nalType = nal[0] & 0x1F
+            slice = 1 <= nalType <= 5
+            keyframe = nalType == 5
+            firstSlice = slice and len(nal) > 1 and nal[1] & 0x80
+            delimiter = nalType == 9
+            prefix = nalType in (6, 7, 8) or 13 <= nalType <= 18
+            parameterSet = {7: "sps", 8: "pps"}.get(nalType)
+
+        if delimiter or self._frame is None or self._frame["slices"] and (prefix or firstSlice):
+            self._finishFrame()
+            self._frame = {"nals": [], "slices": False, "keyframe": False, "poc": None,
+                           "timestamps": self._frameTimestamps(offset)}
+        if parameterSet is not None and self._parameterSets.get(parameterSet) != nal:
+            self._parameterSets[parameterSet] = nal
+            self._sliceParameters = None
+        if firstSlice:
+            self._frame["poc"] = self._pictureOrderCount(nal, nalType)
+        if not delimiter:
+            self._frame["nals"].append(nal)
+        self._frame["slices"] = self._frame["slices"] or slice
+        self._frame["keyframe"] = self._frame["keyframe"] or keyframe
+
+    def _pictureOrderCount(self, nal: bytes, nalType: int) -> tuple | None:
+        # Returns the period and picture order count of a frame from its first slice,
+        # or None if it cannot be read
+        try:
+            if self._sliceParameters is None:
+                if self._codec == "hevc":
+                    self._sliceParameters = (_hevcSps(self._parameterSets["sps"]), _hevcPps(self._parameterSets["pps"]))
+                else:
+                    self._sliceParameters = (_h264Sps(self._parameterSets["sps"]), None)
+            sps, pps = self._sliceParameters
+            if self._codec == "hevc":
+                lsb = _hevcPocLsb(nal, sps, pps)
+                reset = 16 <= nalType <= 20
+                # Only the frames of the lowest temporal layer that are not leading or
+                # sub-layer non-reference frames are used to find the most significant bits
+                reference = nal[1] & 0x07 == 1 and nalType not in (6, 7, 8, 9) and (nalType > 14 or nalType % 2)
+            else:
+                lsb = _h264PocLsb(nal, sps)
+                reset = nalType == 5
+                reference = nal[0] & 0x60 != 0
+        except (KeyError, RemuxError):
+            return None
+        if lsb is None:
+            return None
+        maxLsb = 1 << sps["log2MaxPocLsb"]
+        if reset or self._previousPoc is None:
+            self._pocPeriod += 1
+            msb = 0
+        else:
+            previousMsb, previousLsb = self._previousPoc
+            msb = previousMsb
+            if lsb < previousLsb and previousLsb - lsb >= maxLsb // 2:
+                msb += maxLsb
+            elif lsb > previousLsb and lsb - previousLsb > maxLsb // 2:
+                msb -= maxLsb
+        if reference:
+            self._previousPoc = (msb, lsb)
+        return self._pocPeriod, msb + lsb
+
+    def _frameTimestamps(self, offset: int) -> tuple | None:
+        timestamps = None
+        while self._timestamps and self._timestamps[0][0] <= offset:
+            timestamps = self._timestamps.popleft()[1:]
+        return timestamps
+
+    def _unwrap(self, timestamp: int) -> int:
+        # The 33 bit clock wraps around every 26 hours
+        if self._lastTimestamp is not None:
+            timestamp += (self._lastTimestamp - timestamp + WRAP // 2) // WRAP * WRAP
+        self._lastTimestamp = timestamp
+        return timestamp
+
+    def _finishFrame(self):
+        frame, self._frame = self._frame, None
+        if frame is None or not frame["slices"]:
+            return
+        if self._config is None:
+            if not frame["keyframe"] or not self._startFile():
+                logger.debug("Skipping a frame before the first keyframe")
+                return
+        timed = frame["timestamps"] is not None
+        if timed:
+            pts, dts = (self._unwrap(timestamp) + self._shift for timestamp in frame["timestamps"])
+            last = self._lastTimedFrame if self._lastTimedFrame is not None else len(self._dts) - 1
+            if not self._dts:
+                pass
+            elif self._dts[last] < dts < self._dts[last] + MAX_TIMESTAMP_GAP:
+                count = len(self._dts) - last
+                if self._lastTimedFrame is not None and dts - self._dts[last] >= count:
+                    # The frames without timestamps since the last timed one are spread between them
+                    self._frameDuration = (dts - self._dts[last]) // count
+                    for i in range(1, count):
+                        self._dts[last + i] = self._dts[last] + (dts - self._dts[last]) * i // count
+            elif self._dts[last] - CLOCK <= dts <= self._dts[last]:
+                # A frame that repeats the timestamps of the last one, which is timed after it instead
+                timed = False
+            else:
+                # The clock of the DVR jumped, so the video continues from the last frame
+                logger.debug("Timestamp jump of %s seconds in the video" % ((dts - self._dts[last]) / CLOCK))
+                shift = self._dts[-1] + self._frameDuration - dts
+                self._shift += shift
+                pts, dts = pts + shift, dts + shift
+        if timed:
+            self._lastTimedFrame = len(self._dts)
+        else:
+            # The presentation time is found from the picture order count once the stream ends
+            dts = pts = self._dts[-1] + self._frameDuration if self._dts else 0
+        data = b"".join(struct.pack(">I", len(nal)) + nal for nal in frame["nals"])
+        self._offsets.append(self.f.tell())
+        self.f.write(data)
+        self._sizes.append(len(data))
+        self._dts.append(dts)
+        self._compositionOffsets.append(pts - dts)
+        self._timed.append(timed)
+        self._pocs.append(frame["poc"])
+        if frame["keyframe"]:
+            self._keyframes.append(len(self._sizes))
+
+    def _startFile(self) -> bool:
+        # Starts the MP4 once the parameter sets of the first keyframe are known
+        try:
+            if self._codec == "hevc":
+                self._config = _hevcConfig(*(self._parameterSets[name] for name in ("vps", "sps", "pps")))
+            else:
+                self._config = _h264Config(*(self._parameterSets[name] for name in ("sps", "pps")))
+        except KeyError:
+            return False
+        brand = b"hev1" if self._codec == "hevc" else b"avc1"
+        self.f.write(_box(b"ftyp", b"isom", struct.pack(">I", 0x200), b"isom", b"iso2", brand, b"mp41"))
+        # The size of the mdat is written once all the frames are
+        self._mdatStart = self.f.tell()
+        self.f.write(struct.pack(">I4sQ", 1, b"mdat", 0))
+        return True
+
+    def close(self):
+        """Writes the last frame and the index of the video"""
+        self._scan(final=True)
+        self._finishFrame()
+        if self._config is None:
+            raise RemuxError("The stream has no H.264 or H.265 video that can be remuxed")
+        for period, frames in itertools.groupby(range(len(self._dts)), key=lambda i: self._pocs[i] and self._pocs[i][0]):
+            if period is not None:
+                self._presentUntimedFrames(list(frames))
+        end = self.f.tell()
+        self.f.seek(self._mdatStart + 8)
+        self.f.write(struct.pack(">Q", end - self._mdatStart))
+        self.f.seek(end)
+        self.f.write(self._moov())
+
+    def _presentUntimedFrames(self, frames: list):
+        # Sets the presentation times of the frames without timestamps between two resets of the
+        # picture order count, from the nearest timed frame before them, or the first one after
+        # them. Without timed frames, the frames are delayed as little as the reordering allows
+        counts = sorted({self._pocs[i][1] for i in frames})
+        if all(self._timed[i] for i in frames) or len(counts) < 2:
+            return
+        step = min(b - a for a, b in zip(counts, counts[1:]))
+
+        def position(i: int) -> int:
+            return (self._pocs[i][1] - counts[0]) * self._frameDuration // step
+
+        timed = [i for i in frames if self._timed[i]]
+        anchor = timed[0] if timed else None
+        start = max(self._dts[i] - position(i) for i in frames)
+        for i in frames:
+            if self._timed[i]:
+                anchor = i
+            elif anchor is not None:
+                pts = self._dts[anchor] + self._compositionOffsets[anchor] + position(i) - position(anchor)
+                self._compositionOffsets[i] = pts - self._dts[i]
+            else:
+                self._compositionOffsets[i] = start + position(i) - self._dts[i]
+
+    def _moov(self) -> bytes:
+        durations = [b - a for a, b in zip(self._dts, self._dts[1:])]
+        durations.append(self._frameDuration)
+        duration = self._dts[-1] - self._dts[0] + durations[-1]
+        width, height, codecConfig = self._config
+        matrix = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+        sampleEntry = _box(
+            b"hev1" if self._codec == "hevc" else b"avc1",
+            b"\x00" * 6, struct.pack(">H", 1), b"\x00" * 16, struct.pack(">HHIIIH", width, height, 0x480000, 0x480000, 0, 1),
+            b"\x00" * 32, struct.pack(">Hh", 0x18, -1), codecConfig)
+        timeToSample = []
+        for sampleDuration in durations:
+            if timeToSample and timeToSample[-1][1] == sampleDuration:
+                timeToSample[-1][0] += 1
+            else:
+                timeToSample.append([1, sampleDuration])
+        tables = [
+            _fullBox(b"stsd", 0, 0, struct.pack(">I", 1), sampleEntry),
+            _fullBox(b"stts", 0, 0, struct.pack(">I", len(timeToSample)),
+                     b"".join(struct.pack(">II", count, delta) for count, delta in timeToSample)),
+        ]
+        if any(self._compositionOffsets):
+            tables.append(_fullBox(b"ctts", 1, 0, struct.pack(">I", len(self._compositionOffsets)),
+                                   b"".join(struct.pack(">Ii", 1, offset) for offset in self._compositionOffsets)))
+        tables += [
+            _fullBox(b"stss", 0, 0, struct.pack(">I", len(self._keyframes)),
+                     b"".join(struct.pack(">I", index) for index in self._keyframes)),
+            _fullBox(b"stsc", 0, 0, struct.pack(">IIII", 1, 1, 1, 1)),
+            _fullBox(b"stsz", 0, 0, struct.pack(">II", 0, len(self._sizes)),
+                     b"".join(struct.pack(">I", size) for size in self._sizes)),
+            _fullBox(b"co64", 0, 0, struct.pack(">I", len(self._offsets)),
+                     b"".join(struct.pack(">Q", offset) for offset in self._offsets)),
+        ]
+        # The frames are shown from the presentation time of the first one
+        edit = _box(b"edts", _fullBox(b"elst", 1, 0, struct.pack(">IQqI", 1, duration, self._compositionOffsets[0], 0x10000)))
+        media = _box(
+            b"mdia",
+            _fullBox(b"mdhd", 1, 0, struct.pack(">QQIQHH", 0, 0, CLOCK, duration, 0x55C4, 0)),
+            _fullBox(b"hdlr", 0, 0, struct.pack(">I", 0), b"vide", b"\x00" * 12, b"VideoHandler\x00"),
+            _box(b"minf",
+                 _fullBox(b"vmhd", 0, 1, b"\x00" * 8),
+                 _box(b"dinf", _fullBox(b"dref", 0, 0, struct.pack(">I", 1), _fullBox(b"url ", 0, 1))),
+                 _box(b"stbl", *tables)))
+        track = _box(
+            b"trak",
+            _fullBox(b"tkhd", 1, 3, struct.pack(">QQIIQQHHHH", 0, 0, 1, 0, duration, 0, 0, 0, 0, 0), matrix,
+                     struct.pack(">II", width << 16, height << 16)),
+            edit, media)
+        return _box(
+            b"moov",
+            _fullBox(b"mvhd", 1, 0, struct.pack(">QQIQIH", 0, 0, CLOCK, duration, 0x10000, 0x100), b"\x00" * 10,
+                     matrix, b"\x00" * 24, struct.pack(">I", 2)),
+            track)
+
+
+def remuxVideoStream(chunks, videoName: str):
+    """Remuxes a video downloaded from the DVR into an MP4 while it is being downloaded,
+    without ffmpeg. Only the video stream is kept.
+
+    Parameters:
+        chunks (iterable): the chunks of the downloaded MPEG-PS stream, as bytes
+        videoName (str): the filename of the MP4
+    """
+    logger.debug("Starting remuxing %s while downloading" % videoName)
+    newname = "%s-edited.mp4" % os.path.splitext(videoName)[0]
+    try:
+        try:
+            with open(newname, "wb") as f:
+                remuxer = PSRemuxer(f)
+                for chunk in chunks:
+                    remuxer.write(chunk)
+                remuxer.close()
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+    except BaseException:
+        # Do not leave a partially remuxed video behind
+        if os.path.exists(newname):
+            os.remove(newname)
+        raise
+    os.replace(newname, videoName)
@@ -1,18 +1,66 @@
 import hikload.hikvisionapi as hikvisionapi
+import hashlib
 import logging
+import os
+import time
 from collections import OrderedDict
-from io import BytesIO
 from typing import Union
 import copy
 import requests
 from lxml import etree
-from requests.auth import HTTPDigestAuth
 from xmler import dict2xml as d2xml
 
 logger = logging.getLogger('hikload')
 
-
-def getXML(server: hikvisionapi.HikvisionServer, path: str, data: dict = None, xmldata: str = None, rawResponse: bool = False, httptimeout: int | None = None) -> dict:
+# These responses mean that the DVR is busy or restarting
+RETRY_STATUSES = (502, 503, 504)
+# The POST requests that only read data, so they can be sent again
+IDEMPOTENT_POSTS = ("ContentMgmt/search",)
+# The errors after which a request is sent again
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+
+def _request(server: hikvisionapi.HikvisionServer, method: str, path: str, xmldata: str = None,
+             httptimeout: int | None = None, stream: bool = False, headers: dict = None,
+             retries: int = None) -> requests.Response:
+    """Sends a request to the DVR through its circuit breaker. The requests that can be
+    safely repeated are retried `retries` times, or the retries of the server, after
+    connection errors, timeouts and busy responses. The connection errors left after
+    the retries are raised as HikvisionException"""
+    idempotent = method == "GET" or (method == "POST" and path in IDEMPOTENT_POSTS)
+    retries = server.retries if retries is None else retries
+    attempt = 0
+    while True:
+        server.circuitBreaker.before()
+        try:
+            response = server.session.request(
+                method, "%s/%s" % (server.address(), path),
+                data=xmldata,
+                headers=headers,
+                timeout=httptimeout,
+                stream=stream)
+        except RETRY_ERRORS as e:
+            server.circuitBreaker.failed()
+            if not idempotent or attempt >= retries:
+                raise hikvisionapi.HikvisionException("%s: %s" % (e.__class__.__name__, e)) from e
+            delay = server.retryDelay(attempt)
+            logger.debug("%s %s failed (%s), retrying in %.2f seconds" % (method, path, e, delay))
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                server.circuitBreaker.succeeded()
+                return response
+            server.circuitBreaker.failed()
+            if not idempotent or attempt >= retries:
+                return response
+            delay = server.retryDelay(attempt, response.headers.get("Retry-After"))
+            response.close()
+            logger.debug("%s %s returned status code %s, retrying in %.2f seconds" % (
+                method, path, response.status_code, delay))
+        time.sleep(delay)
+        attempt += 1
+
+
+def getXML(server: hikvisionapi.HikvisionServer, path: str, data: dict = None, xmldata: str = None, rawResponse: bool = False, httptimeout: int | None = None, stream: bool = False, headers: dict = None, retries: int = None) -> dict:
     """This returns the response of the DVR to the following GET request
 
     Parameters:
@@ -23,6 +71,13 @@ def getXML(server: hikvisionapi.HikvisionServer, path: str, data: dict = None, x
         xmldata (str): This should be formatted using `utils.dict2xml`
                        This is the data that will be transmitted to the server.
                        It is optional.
+        rawResponse (bool): Returns the `requests.Response` instead of the parsed XML
+        stream (bool): Does not read the body of the raw response until it is
+                       iterated. Only used together with `rawResponse`
+        headers (dict): Extra HTTP headers sent with the request.
+                        Only used together with `rawResponse`
+        retries (int): The number of retries after connection errors, instead of
+                       the retries of the server. Only used together with `rawResponse`
     """
     tosend = xmldata
     if data:
@@ -30,7 +85,8 @@ def getXML(server: hikvisionapi.HikvisionServer, path: str, data: dict = None, x
     if tosend is not None:
         logger.debug("Data sent: %s" % tosend)
     if rawResponse:
-        return getXMLRaw(server, path, xmldata=tosend, rawResponse=True, httptimeout=httptimeout)
+        return getXMLRaw(server, path, xmldata=tosend, rawResponse=True, httptimeout=httptimeout, stream=stream,
+                         headers=headers, retries=retries)
     response = xml2dict(getXMLRaw(server, path, xmldata=tosend))
     if 'ResponseStatus' in response:
         if 'statusCode' in response['ResponseStatus']:
@@ -44,7 +100,7 @@ def getXML(server: hikvisionapi.HikvisionServer, path: str, data: dict = None, x
     return response
 
 
-def getXMLRaw(server: hikvisionapi.HikvisionServer, path: str, xmldata: str = None, rawResponse: bool = False, httptimeout: int | None = None) -> dict:
+def getXMLRaw(server: hikvisionapi.HikvisionServer, path: str, xmldata: str = None, rawResponse: bool = False, httptimeout: int | None = None, stream: bool = False, headers: dict = None, retries: int = None) -> dict:
     """
     This returns the response of the DVR to the following GET request
 
@@ -54,22 +110,16 @@ def getXMLRaw(server: hikvisionapi.HikvisionServer, path: str, xmldata: str = No
         xmldata (str): This should be formatted using `utils.dict2xml`
                        This is the data that will be transmitted to the server.
                        It is optional.
+        rawResponse (bool): Returns the `requests.Response` instead of the text
+        stream (bool): Does not read the body of the response until it is iterated
+        headers (dict): Extra HTTP headers sent with the request
+        retries (int): The number of retries after connection errors, instead of the retries of the server
     """
-    headers = {'Content-Type': 'application/xml'}
+    headers = {'Content-Type': 'application/xml', **(headers or {})}
     if xmldata is None:
         logger.debug("%s/%s" % (server.address(), path))
-        responseRaw = requests.get(
-            "%s/%s" % (server.address(), path),
-            headers=headers,
-            auth=HTTPDigestAuth(server.user, server.password),
-            timeout=httptimeout)
-    else:
-        responseRaw = requests.get(
-            "%s/%s" % (server.address(), path),
-            data=xmldata,
-            headers=headers,
-            auth=HTTPDigestAuth(server.user, server.password),
-            timeout=httptimeout)
+    responseRaw = _request(server, "GET", path, xmldata=xmldata, httptimeout=httptimeout,
+                           stream=stream, headers=headers, retries=retries)
     if rawResponse:
         return responseRaw
     responseXML = responseRaw.text
@@ -118,19 +168,7 @@ def putXMLRaw(server: hikvisionapi.HikvisionServer, path: str, xmldata: str = No
                        It is optional.
     """
     headers = {'Content-Type': 'application/xml'}
-    if xmldata is None:
-        responseRaw = requests.put(
-            "%s/%s" % (server.address(), path),
-            headers=headers,
-            auth=HTTPDigestAuth(server.user, server.password),
-            timeout=httptimeout)
-    else:
-        responseRaw = requests.put(
-            "%s/%s" % (server.address(), path),
-            data=xmldata,
-            headers=headers,
-            auth=HTTPDigestAuth(server.user, server.password),
-            timeout=httptimeout)
+    responseRaw = _request(server, "PUT", path, xmldata=xmldata, httptimeout=httptimeout, headers=headers)
     responseXML = responseRaw.text
     return responseXML
 
@@ -177,19 +215,7 @@ def deleteXMLRaw(server: hikvisionapi.HikvisionServer, path: str, xmldata=None,
                        It is optional.
     """
     headers = {'Content-Type': 'application/xml'}
-    if xmldata is None:
-        responseRaw = requests.delete(
-            "%s/%s" % (server.address(), path),
-            headers=headers,
-            auth=HTTPDigestAuth(server.user, server.password),
-            timeout=httptimeout)
-    else:
-        responseRaw = requests.delete(
-            "%s/%s" % (server.address(), path),
-            data=xmldata,
-            headers=headers,
-            auth=HTTPDigestAuth(server.user, server.password),
-            timeout=httptimeout)
+    responseRaw = _request(server, "DELETE", path, xmldata=xmldata, httptimeout=httptimeout, headers=headers)
     if responseRaw.status_code == 401:
         raise hikvisionapi.HikvisionException("Wrong username or password")
     responseXML = responseRaw.text
@@ -226,7 +252,7 @@ def postXML(server: hikvisionapi.HikvisionServer, path: str, data: dict = None,
     return response
 
 
-def postXMLRaw(server: hikvisionapi.HikvisionServer, path: str, xmldata: str = None, httptimeout: int | None = None) -> dict:
+def postXMLRaw(server: hikvisionapi.HikvisionServer, path: str, xmldata: str = None, httptimeout: int | None = None, rawResponse: bool = False, stream: bool = False) -> dict:
     """This returns the response of the DVR to the following POST request
 
     Parameters:
@@ -235,18 +261,102 @@ def postXMLRaw(server: hikvisionapi.HikvisionServer, path: str, xmldata: str = N
         xmldata (str): This should be formatted using `utils.dict2xml`
                        This is the data that will be transmitted to the server.
                        It is optional.
+        rawResponse (bool): Returns the `requests.Response` instead of the text
+        stream (bool): Does not read the body of the response until it is iterated
     """
     headers = {'Content-Type': 'application/xml'}
-    responseRaw = requests.post(
-        "%s/%s" % (server.address(), path),
-        data=xmldata,
-        headers=headers,
-        auth=HTTPDigestAuth(server.user, server.password),
-        timeout=httptimeout)
+    responseRaw = _request(server, "POST", path, xmldata=xmldata, httptimeout=httptimeout,
+                           stream=stream, headers=headers)
+    if rawResponse:
+        return responseRaw
     responseXML = responseRaw.text
     return responseXML
 
 
+class Checksum():
+    """This is the hash of a file, computed while the file is written chunk by chunk.
+
+    Parameters:
+        algorithm (str): The name of a `hashlib` algorithm (default is sha256)
+    """
+
+    def __init__(self, algorithm: str = "sha256"):
+        self.algorithm = algorithm
+        self.hash = hashlib.new(algorithm)
+        self.size = 0
+
+    @classmethod
+    def ofFile(cls, filename: str, algorithm: str = "sha256") -> "Checksum":
+        """Returns the checksum of a file that is already written"""
+        checksum = cls(algorithm)
+        checksum.resume(filename, os.path.getsize(filename))
+        return checksum
+
+    def update(self, data: bytes):
+        self.hash.update(data)
+        self.size += len(data)
+
+    def resume(self, filename: str, offset: int, blockSize: int = 1024 * 1024):
+        """Makes the hash cover the first `offset` bytes of the file, so it can continue
+        with the rest of a resumed download. The bytes are only read again if the hash
+        does not already cover them"""
+        if self.size == offset:
+            return
+        self.hash = hashlib.new(self.algorithm)
+        self.size = 0
+        with open(filename, 'rb') as f:
+            while self.size < offset:
+                block = f.read(min(blockSize, offset - self.size))
+                if not block:
+                    break
+                self.update(block)
+
+    def hexdigest(self) -> str:
+        """Returns the hash with the name of its algorithm, like `sha256:...`"""
+        return "%s:%s" % (self.algorithm, self.hash.hexdigest())
+
+
+def saveStream(response, filename: str, chunkSize: int = 1024 * 1024, offset: int = 0, progress=None,
+               throttle=None, checksum: Checksum = None) -> int:
+    """Writes the body of a streamed response to a file, chunk by chunk
+
+    Parameters:
+        response (requests.Response): A response created with `stream=True`
+        filename (str): The path of the file that is written
+        chunkSize (int): The number of bytes read at once (default is 1MiB)
+        offset (int): The body is written starting from this byte of the file,
+                      keeping everything before it (default is 0)
+        progress (function): Called with the size of the file after every chunk
+        throttle (function): Called with the size of every chunk before the next one is
+                             read, and waits to keep the download within a bandwidth limit
+        checksum (Checksum): Updated with the whole file, including the bytes before `offset`
+
+    Returns:
+        size (int): The size of the file
+    """
+    with response:
+        if response.status_code not in (200, 206):
+            raise hikvisionapi.HikvisionException(
+                "Server returned status code %s: %s" % (response.status_code, response.text))
+        size = offset
+        if checksum is not None:
+            checksum.resume(filename, offset)
+        with open(filename, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            for chunk in response.iter_content(chunk_size=chunkSize):
+                f.write(chunk)
+                size += len(chunk)
+                if checksum is not None:
+                    checksum.update(chunk)
+                if progress is not None:
+                    f.flush()
+                    progress(size)
+                if throttle is not None:
+                    throttle(len(chunk))
+    return size
+
+
 def xml2dict(xml: Union[str, dict]) -> dict:
     """Converts string formatted for the DVR to a dict
 
@@ -257,70 +367,49 @@ def xml2dict(xml: Union[str, dict]) -> dict:
         dictionary (dict): The resulting dictionary
                            This has `@attrs` in place of the attributes
     """
-    # Taken from https://stackoverflow.com/questions/4255277/
-    xslt = b"""<xsl:stylesheet version="1.0"
-    xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
-    <xsl:output method="xml" indent="no"/>
-
-    <xsl:template match="/|comment()|processing-instruction()">
-        <xsl:copy>
-            <xsl:apply-templates/>
-        </xsl:copy>
-    </xsl:template>
-
-    <xsl:template match="*">
-        <xsl:element name="{local-name()}">
-            <xsl:apply-templates select="@*|node()"/>
-        </xsl:element>
-    </xsl:template>
-
-    <xsl:template match="@*">
-        <xsl:attribute name="{local-name()}">
-            <xsl:value-of select="."/>
-        </xsl:attribute>
-    </xsl:template>
-</xsl:stylesheet>
-"""
     if type(xml) == str:
         xml = bytes(xml, "UTF8")
 
-    xmlstr = BytesIO(xml)
-    parser = etree.XMLParser(ns_clean=True)
-    tree = etree.parse(xmlstr, parser=parser)
+    parser = etree.XMLParser(ns_clean=True, remove_comments=True, remove_pis=True)
+    root = etree.fromstring(xml, parser=parser)
 
-    xslt_doc = etree.parse(BytesIO(xslt))
-    transform = etree.XSLT(xslt_doc)
-    tree = transform(tree)
+    return hikvisionapi.classes.Hasher(tree2dict(root))
 
-    return hikvisionapi.classes.Hasher(tree2dict(tree.getroot()))
+
+def _localname(tag: str) -> str:
+    # Strips the namespace from a `{namespace}name` tag or attribute
+    if tag[0] == "{":
+        return tag.rpartition("}")[2]
+    return tag
 
 
 def tree2dict(node):
-    subdict = OrderedDict({})
+    """Converts an element to a dict in a single pass, without namespaces"""
+    tag, value = _element2item(node)
+    return {tag: value}
+
+
+def _element2item(node):
+    subdict = OrderedDict()
     # iterate over the children of this element--tree.getroot
     for e in node.iterchildren():
-        d = tree2dict(e)
-        for k in d.keys():
-            # handle duplicated tags
-            if k in subdict:
-                v = subdict[k]
-        # use append to assert exception
-                try:
-                    v.append(d[k])
-                    subdict.update({k: v})
-                except AttributeError:
-                    subdict.update({k: [v, d[k]]})
+        k, v = _element2item(e)
+        # handle duplicated tags
+        if k in subdict:
+            if type(subdict[k]) is list:
+                subdict[k].append(v)
             else:
-                subdict.update(d)
+                subdict[k] = [subdict[k], v]
+        else:
+            subdict[k] = v
+    tag = node.tag
+    if tag[0] == "{":
+        tag = tag.rpartition("}")[2]
     if subdict:
-        attribdict = dict()
-        for i in node.attrib:
-            val = node.attrib[i]
-            attribdict[str(i)] = val
-        subdict.update({"@attrs": attribdict})
-        return {node.tag: subdict}
+        subdict["@attrs"] = {_localname(i): val for i, val in node.attrib.items()}
+        return tag, subdict
     else:
-        return {node.tag: node.text}
+        return tag, node.text
 
 
 def dict2xml(dictionary: dict) -> str:
@@ -0,0 +1,127 @@
+import logging
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta
+
+from hikload.hikvisionapi import Checksum
+
+logger = logging.getLogger('hikload')
+
+JOURNAL_NAME = ".hikload-journal.sqlite"
+
+JournalEntry = namedtuple(
+    "JournalEntry", ["key", "stage", "source", "path", "size", "mtime", "duration", "checksum", "finished"])
+JournalEntry.__doc__ = "A file saved for a stage of a recording or a channel"
+
+
+class DownloadJournal():
+    """This is a journal of the files saved in a downloads folder, kept in a SQLite
+    database, so a run that was interrupted can skip the files that are already complete.
+
+    Every stage of a recording, like the download from the DVR or the processed video,
+    is written in its own transaction once its file is complete, with the size and
+    modification time of the file, the duration of the video and its checksum.
+    A connection is opened for every change, so the journal can be shared by all the
+    workers and survives the process being killed at any moment.
+
+    Parameters:
+        path (str): The path of the database file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    key TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    source TEXT,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    duration REAL,
+                    checksum TEXT,
+                    finished TEXT NOT NULL,
+                    PRIMARY KEY (key, stage)
+                )""")
+
+    @classmethod
+    def forFolder(cls, folder: str) -> "DownloadJournal":
+        """Returns the journal kept in a downloads folder"""
+        return cls(os.path.join(folder, JOURNAL_NAME))
+
+    @contextmanager
+    def _connect(self):
+        # The connection commits when the block ends, and is closed after it
+        with self._lock, closing(sqlite3.connect(self.path, timeout=30)) as connection, connection:
+            yield connection
+
+    def record(self, key: str, stage: str, path: str, source: str = None, duration: timedelta = None,
+               checksum: str = None) -> JournalEntry:
+        """Records that the file of a stage is complete, and returns its entry.
+
+        Parameters:
+            key (str): The recording or channel, like the playbackURI of a recording
+            stage (str): The stage that saved the file, like `download` or `video`
+            path (str): The complete file
+            source (str): What the file was made from, like the playbackURI that was
+                          actually downloaded (default is none)
+            duration (timedelta): The duration of the video (default is unknown)
+            checksum (str): The `Checksum.hexdigest` of the file, which is computed
+                            from the file if not given
+        """
+        path = os.path.abspath(path)
+        if checksum is None:
+            checksum = Checksum.ofFile(path).hexdigest()
+        stat = os.stat(path)
+        row = (key, stage, source, path, stat.st_size, stat.st_mtime,
+               duration.total_seconds() if duration is not None else None, checksum, datetime.now().isoformat())
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+        logger.debug("Journaled the %s of %s as %s" % (stage, key, path))
+        return _entry(row)
+
+    def get(self, key: str, stage: str) -> JournalEntry | None:
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT * FROM files WHERE key = ? AND stage = ?", (key, stage)).fetchone()
+        return _entry(row) if row is not None else None
+
+    def verified(self, key: str, stage: str, path: str = None, verify: bool = False) -> JournalEntry | None:
+        """Returns the journaled file of a stage if it is still complete, or None if the
+        stage needs to be done again.
+
+        The file is complete if it has the same size and modification time as when it was
+        journaled, which needs no reading. If `verify` is set, its checksum is compared too.
+        If `path` is given, the file must have been saved there.
+        """
+        entry = self.get(key, stage)
+        if entry is None:
+            return None
+        if path is not None and entry.path != os.path.abspath(path):
+            return None
+        try:
+            stat = os.stat(entry.path)
+        except FileNotFoundError:
+            logger.debug("%s was journaled but does not exist anymore" % entry.path)
+            return None
+        if (stat.st_size, stat.st_mtime) != (entry.size, entry.mtime):
+            logger.info("%s changed since it was saved, saving it again" % entry.path)
+            return None
+        if verify and entry.checksum is not None:
+            algorithm = entry.checksum.split(":", 1)[0]
+            if Checksum.ofFile(entry.path, algorithm).hexdigest() != entry.checksum:
+                logger.warning("%s is corrupted, saving it again" % entry.path)
+                return None
+        return entry
+
+
+def _entry(row: tuple) -> JournalEntry:
+    entry = JournalEntry(*row)
+    if entry.duration is not None:
+        entry = entry._replace(duration=timedelta(seconds=entry.duration))
+    return entry
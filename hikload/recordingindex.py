@@ -0,0 +1,87 @@
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+from typing import List
+
+from hikload.hikvisionapi import SearchMatch
+
+logger = logging.getLogger('hikload')
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class RecordingIndex():
+    """This is a local SQLite index of the recordings found on DVRs/NVRs.
+
+    Parameters:
+        path (str): The path of the database file
+        overlap (timedelta): How much of the already indexed time is searched
+                             again when syncing, so recordings that were still
+                             being written are updated (default is 1 hour)
+    """
+
+    def __init__(self, path: str, overlap: timedelta = timedelta(hours=1)):
+        self.path = path
+        self.overlap = overlap
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS recordings (
+                    server TEXT NOT NULL,
+                    cid TEXT NOT NULL,
+                    playbackURI TEXT NOT NULL,
+                    startTime TEXT NOT NULL,
+                    endTime TEXT NOT NULL,
+                    contentType TEXT,
+                    PRIMARY KEY (server, cid, playbackURI)
+                )""")
+            self.connection.execute("""
+                CREATE INDEX IF NOT EXISTS recordings_time
+                ON recordings (server, cid, startTime, endTime)""")
+
+    def close(self):
+        self.connection.close()
+
+    def sync_start(self, server: str, cid: str) -> datetime | None:
+        """Returns the moment from which the channel needs to be searched again,
+        or None if the channel was never indexed"""
+        row = self.connection.execute(
+            "SELECT MAX(endTime) FROM recordings WHERE server = ? AND cid = ?",
+            (server, str(cid))).fetchone()
+        if row[0] is None:
+            return None
+        return datetime.strptime(row[0], TIME_FORMAT) - self.overlap
+
+    def update(self, server: str, cid: str, since: datetime | None, matches: List[SearchMatch]):
+        """Saves the recordings found for a channel after `since`.
+
+        Everything indexed after `since` is replaced, since the search was
+        repeated for that interval.
+        """
+        with self.connection:
+            if since is not None:
+                self.connection.execute(
+                    "DELETE FROM recordings WHERE server = ? AND cid = ? AND endTime > ?",
+                    (server, str(cid), since.strftime(TIME_FORMAT)))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO recordings VALUES (?, ?, ?, ?, ?, ?)",
+                [(server, str(cid), match.playbackURI, match.startTime, match.endTime, match.contentType)
+                 for match in matches])
+        logger.debug("Indexed %s recordings for channel %s on %s" %
+                     (len(matches), cid, server))
+
+    def query(self, server: str, cid: str, startTime: str = None, endTime: str = None) -> List[SearchMatch]:
+        """Returns the indexed recordings of a channel that overlap the interval,
+        in the same format as the ones found by searching the DVR"""
+        sql = "SELECT playbackURI, startTime, endTime, contentType FROM recordings WHERE server = ? AND cid = ?"
+        parameters = [server, str(cid)]
+        if startTime is not None:
+            sql += " AND endTime > ?"
+            parameters.append(startTime)
+        if endTime is not None:
+            sql += " AND startTime < ?"
+            parameters.append(endTime)
+        sql += " ORDER BY startTime"
+        return [SearchMatch(trackID=str(cid), startTime=startTime, endTime=endTime,
+                            playbackURI=playbackURI, contentType=contentType)
+                for playbackURI, startTime, endTime, contentType in self.connection.execute(sql, parameters)]
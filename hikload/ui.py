@@ -82,7 +82,7 @@ class downloadThread(threading.Thread):
 
                 concat_filename = concat_channel_videos(channel_metadata, cid, self.args)
 
-                if self.args.trim:
+                if self.args.trim and not channel_metadata.get("trimmed"):
                     cut_filename = cut_video(concat_filename, channel_metadata)
                     logger.info("Trimmed video saved as %s" % cut_filename)
 
@@ -106,7 +106,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.move(frameGm.topLeft())
 
         server = HikvisionServer(
-            self.args.server, self.args.username, self.args.password, httptimeout=args.httptimeout)
+            self.args.server, self.args.username, self.args.password, httptimeout=args.httptimeout,
+            poolsize=args.poolsize, maxconnections=args.maxconnections)
         self.downloadthread = downloadThread(self, server, args)
         self.downloadthread.start()
 
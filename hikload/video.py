@@ -1,31 +1,280 @@
+import json
 import logging
 import os
-from datetime import datetime, timedelta
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
 import ffmpeg
 
 logger = logging.getLogger('hikload')
 
+# The audio codecs that cannot be copied into these containers, like the G.711 and
+# G.726 audio of many cameras, which is re-encoded when the videos are concatenated
+UNSUPPORTED_AUDIO_CODECS = {
+    "mp4": ("pcm_", "adpcm_"),
+}
+
+# The encoders used by the exact trims to re-encode the frames before the first keyframe
+EXACT_TRIM_ENCODERS = {
+    "h264": "libx264",
+    "hevc": "libx265",
+}
+
+# The names of the profiles reported by ffprobe, in the options of these encoders
+EXACT_TRIM_PROFILES = {
+    "h264": {"constrained baseline": "baseline", "baseline": "baseline", "main": "main", "high": "high",
+             "high 10": "high10", "high 4:2:2": "high422", "high 4:4:4 predictive": "high444"},
+    "hevc": {"main": "main", "main 10": "main10"},
+}
+
+# The parameters of a re-encoded piece that need to be the same as the ones of the copied
+# video, because the concat demuxer keeps the parameters of the first piece for all of them
+VIDEO_PARAMETERS = ("codec", "profile", "level", "pix_fmt", "width", "height", "time_base")
+
+# Seconds between two timestamps that are still considered the same frame
+FRAME_TOLERANCE = 0.02
+
+# Changed when the probes hold more information, so the older cached probes are not used
+PROBE_VERSION = 2
+
+
+def probe_sidecar(filename: str) -> str:
+    """Returns the file in which the probe of a video is cached"""
+    folder, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(folder, ".%s.probe.json" % name)
+
+
+def probe_video(filename: str, keyframes: bool = False) -> dict:
+    """Returns the duration of a video and the type and codec of its streams, and the
+    times of the keyframes of its first video stream if `keyframes` is set.
+
+    The result is cached in a sidecar next to the video, and reused while the video
+    keeps its size and modification time."""
+    stat = os.stat(filename)
+    sidecar = probe_sidecar(filename)
+    try:
+        with open(sidecar) as f:
+            cached = json.load(f)
+        if (cached.get("version"), cached["size"], cached["mtime"]) == (PROBE_VERSION, stat.st_size, stat.st_mtime) \
+                and (not keyframes or "keyframes" in cached["probe"]):
+            return cached["probe"]
+    except (OSError, ValueError, KeyError):
+        pass
+    probe = ffmpeg.probe(filename)
+    duration = probe.get("format", {}).get("duration")
+    result = {
+        "duration": float(duration) if duration is not None else None,
+        "streams": [_probe_stream(stream) for stream in probe["streams"]],
+    }
+    if keyframes:
+        # The keyframes are relative to the start of the video, like the seeking of ffmpeg
+        start = probe.get("format", {}).get("start_time")
+        start = float(start) if start not in (None, "N/A") else 0
+        packets = ffmpeg.probe(filename, select_streams="v:0", show_entries="packet=pts_time,flags")
+        result["keyframes"] = [float(packet["pts_time"]) - start for packet in packets.get("packets", [])
+                               if "K" in packet.get("flags", "") and packet.get("pts_time") not in (None, "N/A")]
+    with open(sidecar + ".tmp", "w") as f:
+        json.dump({"version": PROBE_VERSION, "size": stat.st_size, "mtime": stat.st_mtime, "probe": result}, f)
+    os.replace(sidecar + ".tmp", sidecar)
+    return result
+
+
+def _probe_stream(stream: dict) -> dict:
+    result = {"type": stream["codec_type"].lower(), "codec": stream.get("codec_name")}
+    if result["type"] == "video":
+        result.update({key: stream.get(key) for key in VIDEO_PARAMETERS[1:]})
+    return result
+
+
+def probe_videos(filenames: list, workers: int = None, keyframes: bool = False) -> list:
+    """Probes the videos at the same time with `probe_video`, in the order of filenames"""
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        return list(executor.map(lambda filename: probe_video(filename, keyframes), filenames))
+
+
+def remove_video(filename: str):
+    """Removes a video together with its cached probe"""
+    for name in (filename, probe_sidecar(filename)):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+
+def concat_codecs(probes: list, fileFormat: str) -> dict:
+    """Returns the ffmpeg output codecs used to concatenate the probed videos,
+    copying the audio only if all of them have audio the container accepts"""
+    audio = [{stream["codec"] for stream in probe["streams"] if stream["type"] == "audio"} for probe in probes]
+    if not any(audio):
+        return {"codec": "copy"}
+    codecs = set.union(*audio)
+    if all(audio) and len(codecs) == 1 and \
+            not any(codec.startswith(UNSUPPORTED_AUDIO_CODECS.get(fileFormat, ())) for codec in codecs if codec):
+        return {"codec": "copy"}
+    # The audio is re-encoded, and the video is still copied
+    return {"vcodec": "copy"}
+
+
+def concat_videos(filenames: list, outname: str, debug: bool = False, codecs: dict = None):
+    """Joins the videos into outname with the output `codecs` of ffmpeg, which copy all the
+    streams by default. If copying all the streams fails, only the video is copied"""
+    # Every call gets its own list, so videos can be joined at the same time
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", dir=os.path.dirname(os.path.abspath(outname)),
+                                     delete=False) as fl:
+        for filename in filenames:
+            fl.write("file '{}'\n".format(os.path.abspath(filename).replace("'", "'\\''")))
+    loglevel = [] if debug else ['-loglevel', 'error']
+    try:
+        stream = ffmpeg.input(fl.name, f='concat', safe=0)
+        codecs = codecs or {"codec": "copy"}
+        try:
+            stream.output(outname, **codecs).global_args(*loglevel).overwrite_output().run()
+        except ffmpeg.Error:
+            if "codec" not in codecs:
+                raise
+            # The audio codec is probably not supported by the container
+            stream.output(outname, vcodec='copy').global_args(*loglevel).overwrite_output().run()
+    finally:
+        os.remove(fl.name)
+
+
+def exact_trim_options(stream: dict) -> dict | None:
+    """Returns the ffmpeg output options that re-encode the frames of a video stream with the
+    same parameters as the stream, or None if the encoder cannot match them"""
+    codec = stream.get("codec")
+    profile = EXACT_TRIM_PROFILES.get(codec, {}).get((stream.get("profile") or "").lower())
+    level = stream.get("level")
+    time_base = stream.get("time_base") or ""
+    if profile is None or not isinstance(level, int) or level <= 0 or not stream.get("pix_fmt") or \
+            not time_base.startswith("1/"):
+        return None
+    options = {"vcodec": EXACT_TRIM_ENCODERS[codec], "pix_fmt": stream["pix_fmt"], "profile:v": profile,
+               "video_track_timescale": time_base[2:]}
+    if codec == "h264":
+        # The level of H.264 is reported multiplied by 10, and the one of HEVC by 30
+        options["level"] = "%.1f" % (level / 10)
+    else:
+        options["x265-params"] = "level-idc=%g:log-level=error" % (level / 30)
+    return options
+
+
+def trim_video(filename: str, start: float = 0, end: float = None, exact: bool = False,
+               debug: bool = False) -> list:
+    """Copies the part of a video between `start` and `end` seconds without re-encoding it,
+    and returns the pieces that replace the video when concatenating.
+
+    The copy can only start at a keyframe, so it starts at the last keyframe before `start`.
+    If `exact` is set, the frames from `start` until the next keyframe are re-encoded into
+    a piece of their own instead, and the copy starts at that keyframe. The piece is only
+    used if it has the same codec parameters as the video, so they can be concatenated
+
+    Parameters:
+        filename (str): The video
+        start (float): The second the part starts at (default is the start of the video)
+        end (float): The second the part ends at (default is the end of the video)
+        exact (bool): Re-encode the frames before the first keyframe (default is False)
+        debug (bool): Enables debug logging (default is False)
+    """
+    probe = probe_video(filename, keyframes=True)
+    keyframes = probe.get("keyframes") or []
+    base, extension = os.path.splitext(filename)
+    loglevel = [] if debug else ['-loglevel', 'error']
+    pieces = []
+    copyStart = start
+    if start > 0 and keyframes:
+        following = [keyframe for keyframe in keyframes if keyframe >= start - FRAME_TOLERANCE]
+        video = next((stream for stream in probe["streams"] if stream["type"] == "video"), {})
+        # Only the frames between start and a keyframe before the end need to be re-encoded
+        between = following and following[0] - start > FRAME_TOLERANCE and (end is None or following[0] < end)
+        options = None
+        if exact and between:
+            options = exact_trim_options(video)
+            if options is None:
+                logger.warning("Cannot re-encode the start of %s with the parameters of its video, "
+                               "starting at a keyframe" % filename)
+        if options is not None:
+            head = "%s.head%s" % (base, extension)
+            try:
+                (
+                    ffmpeg
+                    .input(filename, ss=start)
+                    .output(head, t=following[0] - start, acodec='copy', **options)
+                    .global_args(*loglevel)
+                    .overwrite_output()
+                    .run()
+                )
+                encoded = next((stream for stream in probe_video(head)["streams"] if stream["type"] == "video"), {})
+                different = [key for key in VIDEO_PARAMETERS if encoded.get(key) != video.get(key)]
+                if different:
+                    logger.warning("The re-encoded start of %s has a different %s, starting at a keyframe" % (
+                        filename, ", ".join(different)))
+                    remove_video(head)
+                else:
+                    pieces.append(head)
+                    copyStart = following[0]
+            except ffmpeg.Error as e:
+                logger.warning("Could not re-encode the start of %s, starting at a keyframe: %s" % (filename, e))
+                remove_video(head)
+        if not pieces:
+            copyStart = max((keyframe for keyframe in keyframes if keyframe <= start + FRAME_TOLERANCE), default=0)
+
+    rest = "%s.trim%s" % (base, extension)
+    output = {"codec": "copy"}
+    if end is not None:
+        output["t"] = end - copyStart
+    try:
+        ffmpeg.input(filename, ss=copyStart).output(rest, **output).global_args(*loglevel).overwrite_output().run()
+    except ffmpeg.Error:
+        for piece in pieces + [rest]:
+            remove_video(piece)
+        raise
+    pieces.append(rest)
+    return pieces
+
+
+def trim_channel_videos(channel_metadata: dict, args) -> list:
+    """Trims the videos of a channel that start before its startTime or end after its
+    endTime, so the concatenated video does not need to be trimmed. Returns the videos
+    to concatenate, in which the trimmed videos are replaced by their pieces"""
+    filenames = []
+    for filename, fileStart in zip(channel_metadata["filenames"], channel_metadata["starts"]):
+        start = (channel_metadata["startTime"] - fileStart).total_seconds()
+        end = (channel_metadata["endTime"] - fileStart).total_seconds()
+        duration = probe_video(filename)["duration"]
+        if duration is not None and (start >= duration or end <= 0):
+            logger.debug("%s is outside of the channel, skipping it" % filename)
+            remove_video(filename)
+            continue
+        if start <= 0 and (duration is None or end >= duration):
+            filenames.append(filename)
+            continue
+        try:
+            pieces = trim_video(filename, max(start, 0), end if duration is None or end < duration else None,
+                                exact=args.exacttrim, debug=args.debug)
+        except ffmpeg.Error as e:
+            logger.error("Error while trimming video {}: {}".format(filename, e))
+            filenames.append(filename)
+            continue
+        logger.debug("Video {} trimmed into {}".format(filename, pieces))
+        remove_video(filename)
+        filenames.extend(pieces)
+    return filenames
+
+
 def concat_channel_videos(channel_metadata: dict, cid, args):
     if not channel_metadata["filenames"]:
         return
 
-    # Create temporary text file as the FFmpeg requires it
-    with open("tmp_list.txt", "w") as fl:
-
-        audio_codec = True
-        for filename in channel_metadata["filenames"]:
-            fl.write("file '{}'\n".format(filename))
-            
-            # Find out if the file has audio stream 
-            has_audio = False
-            probe = ffmpeg.probe(filename)
-            for stream in probe["streams"]:
-                if stream["codec_type"].lower() == "audio":
-                    has_audio = True
-                    break
-            audio_codec = audio_codec and has_audio
-    
+    # Find out which streams can be copied before running the concat
+    codecs = concat_codecs(probe_videos(channel_metadata["filenames"], args.ffmpegworkers), args.videoformat)
+
+    filenames = channel_metadata["filenames"]
+    if args.trim and not channel_metadata.get("trimmed") and "starts" in channel_metadata:
+        # Only the first and last videos are rewritten, instead of the concatenated video
+        filenames = trim_channel_videos(channel_metadata, args)
+        channel_metadata["trimmed"] = True
+
     if args.videoname != "":
         outname = "{}-{}.{}".format(
             args.videoname,
@@ -34,38 +283,17 @@ def concat_channel_videos(channel_metadata: dict, cid, args):
         )
     else:
         outname = "{}-{}.{}".format(
-            channel_metadata["startTime"].replace("-", "").replace(":", "").replace("Z", "").replace("T", ""),
+            channel_metadata["startTime"].strftime("%Y%m%d%H%M%S"),
             cid,
             args.videoformat
         )
 
-    try:
-        (
-            ffmpeg
-            .input('tmp_list.txt', f='concat', safe=0)
-            .output(outname, codec='copy')
-            .overwrite_output()
-            .run()
-        )
-    except ffmpeg._run.Error:
-        # The FFmpeg thrown error while running
-        # This could be because of unsupported audio codec (or the audio is missing)
-        # Try to cocatenate without the audio stream
-        (
-            ffmpeg
-            .input('tmp_list.txt', f='concat', safe=0)
-            .output(outname, vcodec='copy')
-            .overwrite_output()
-            .run()
-        )
+    # Every channel gets its own list of videos, so channels can be concatenated at the same time
+    concat_videos(filenames, outname, debug=args.debug, codecs=codecs)
 
     # Clean up after yourself
-    os.remove("tmp_list.txt")
-    for filename in channel_metadata["filenames"]:
-        try:
-            os.remove(filename)
-        except FileNotFoundError:
-            pass
+    for filename in filenames:
+        remove_video(filename)
 
     logging.debug("Recordings of the channel {} concatenated into video {}".format(cid, outname))
     return outname
@@ -76,11 +304,7 @@ def cut_video(video_name, channel_metadata: dict):
         return
 
     # Cut videos to required duration
-    starttime = datetime.strptime(
-        channel_metadata["startTime"], "%Y-%m-%dT%H:%M:%SZ")
-    minstarttime = datetime.strptime(
-        channel_metadata["minStartTime"], "%Y-%m-%dT%H:%M:%SZ")
-    trim_start =  starttime - minstarttime
+    trim_start = channel_metadata["startTime"] - channel_metadata["minStartTime"]
 
     if trim_start < timedelta(0):
         return
@@ -42,6 +42,10 @@ setup(
         "urllib3==1.26.10; python_version >= '2.7' and python_version not in '3.0, 3.1, 3.2, 3.3, 3.4, 3.5' and python_version < '4'",
         "xmler==0.2.0",
     ],
+    extras_require={
+        # Needed for the asyncio client in hikload.hikvisionapi.aio and --asyncio
+        "async": ["httpx>=0.23"],
+    },
     entry_points={
         "console_scripts": [
             "hikload=hikload.__main__:main",
@@ -0,0 +1,28 @@
+import pytest
+
+import hikload.hikvisionapi.classes as classes
+
+
+class FakeClock:
+    """Replaces the time module of the limiters, so the tests do not wait"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(classes, "time", clock)
+    return clock
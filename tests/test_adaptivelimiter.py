@@ -0,0 +1,129 @@
+import threading
+
+import pytest
+
+from hikload.hikvisionapi.classes import AdaptiveLimiter, HikvisionException
+
+
+def raised(limiter: AdaptiveLimiter, limit: int) -> AdaptiveLimiter:
+    # Answers quickly until the limit is reached
+    while int(limiter.limit) < limit:
+        limiter.responded(0.1)
+    return limiter
+
+
+def test_starts_at_the_minimum():
+    assert AdaptiveLimiter(8).limit == 1
+    assert AdaptiveLimiter(8, minimum=3).limit == 3
+    assert AdaptiveLimiter(2, minimum=3).maximum == 3
+
+
+def test_fast_responses_increase_additively():
+    limiter = AdaptiveLimiter(8)
+    limiter.responded(0.1)
+    assert limiter.limit == 2
+    limiter.responded(0.1)
+    assert limiter.limit == 2.5
+    # A full round of requests at the new limit raises it by one
+    raised(limiter, 3)
+    assert 3 <= limiter.limit < 3.5
+
+
+def test_never_goes_over_the_maximum():
+    limiter = AdaptiveLimiter(3)
+    for _ in range(100):
+        limiter.responded(0.1)
+    assert limiter.limit == 3
+
+
+def test_slow_response_decreases_multiplicatively():
+    limiter = raised(AdaptiveLimiter(8), 4)
+    limit = limiter.limit
+    limiter.responded(0.5)
+    assert limiter.limit == limit / 2
+
+
+def test_small_latency_changes_are_tolerated():
+    limiter = raised(AdaptiveLimiter(8), 4)
+    limit = limiter.limit
+    # Three times slower, but only by AdaptiveLimiter.LATENCY_TOLERANCE
+    limiter.latency = 0.01
+    limiter.responded(0.03)
+    assert limiter.limit > limit
+
+
+def test_server_error_decreases():
+    limiter = raised(AdaptiveLimiter(8), 4)
+    limiter.responded(0.1, ok=False)
+    assert int(limiter.limit) == 2
+
+
+def test_never_goes_under_the_minimum():
+    limiter = AdaptiveLimiter(8, minimum=2)
+    for _ in range(5):
+        limiter.responded(0.1, ok=False)
+    assert limiter.limit == 2
+
+
+def test_request_errors_decrease():
+    limiter = raised(AdaptiveLimiter(8), 4)
+    with pytest.raises(HikvisionException):
+        with limiter:
+            raise HikvisionException("busy")
+    assert int(limiter.limit) == 2
+    # Other errors say nothing about the DVR
+    with pytest.raises(ValueError):
+        with limiter:
+            raise ValueError()
+    assert int(limiter.limit) == 2
+
+
+def test_requests_in_flight_when_decreased_are_ignored():
+    limiter = raised(AdaptiveLimiter(8), 2)
+    with limiter, limiter:
+        limiter.responded(0.1, ok=False)
+        assert limiter.limit == 1
+        # The two requests that were already sent do not change the new limit
+        limiter.responded(0.1)
+        limiter.responded(0.1, ok=False)
+        assert limiter.limit == 1
+    limiter.responded(0.1)
+    assert limiter.limit == 2
+
+
+def test_slow_transfers_decrease():
+    limiter = raised(AdaptiveLimiter(8), 4)
+    limiter.transferred(1000000, 1.0)
+    limit = limiter.limit
+    limiter.transferred(900000, 1.0)
+    assert limiter.limit == limit
+    limiter.transferred(400000, 1.0)
+    assert limiter.limit == limit / 2
+    # Short transfers are not measured
+    limiter.transferred(1000, 0.5)
+    assert limiter.limit == limit / 2
+
+
+def test_finished_jobs_increase_unless_slow():
+    limiter = AdaptiveLimiter(4)
+    limiter.finished(1000000, 1.0)
+    assert limiter.limit == 2
+    limiter.finished(300000, 1.0)
+    assert limiter.limit == 1
+
+
+def test_waits_for_a_free_slot():
+    limiter = AdaptiveLimiter(4)
+    entered = threading.Event()
+
+    def request():
+        with limiter:
+            entered.set()
+
+    with limiter:
+        thread = threading.Thread(target=request)
+        thread.start()
+        assert not entered.wait(0.2)
+    assert entered.wait(5)
+    thread.join()
+    assert limiter.inflight == 0
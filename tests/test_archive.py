@@ -0,0 +1,65 @@
+import struct
+
+import pytest
+
+from hikload.archive import shift_fragment, track_descriptions
+
+
+def box(kind: bytes, *payload: bytes) -> bytes:
+    data = b"".join(payload)
+    return struct.pack(">I", 8 + len(data)) + kind + data
+
+
+def full_box(kind: bytes, version: int, *payload: bytes) -> bytes:
+    return box(kind, struct.pack(">I", version << 24), *payload)
+
+
+def traf(track_id: int, time: int, version: int = 1) -> bytes:
+    return box(b"traf",
+               full_box(b"tfhd", 0, struct.pack(">I", track_id)),
+               full_box(b"tfdt", version, struct.pack(">Q" if version else ">I", time)),
+               full_box(b"trun", 0, struct.pack(">I", 0)))
+
+
+def moof(sequence: int, *trafs: bytes) -> bytearray:
+    return bytearray(box(b"moof", full_box(b"mfhd", 0, struct.pack(">I", sequence)), *trafs))
+
+
+def trak(track_id: int, timescale: int, description: bytes, version: int = 0) -> bytes:
+    times = struct.pack(">QQ" if version else ">II", 0, 0)
+    return box(b"trak",
+               full_box(b"tkhd", version, times, struct.pack(">I", track_id), b"\x00" * 60),
+               box(b"mdia",
+                   full_box(b"mdhd", version, times, struct.pack(">I", timescale), b"\x00" * 8),
+                   box(b"minf", box(b"stbl", full_box(b"stsd", 0, description)))))
+
+
+def test_shift_fragment():
+    fragment = moof(1, traf(1, 1000), traf(2, 500, version=0))
+    shift_fragment(fragment, {1: 90000, 2: 8000}, 10)
+    assert fragment == moof(11, traf(1, 91000), traf(2, 8500, version=0))
+
+
+def test_shift_fragment_past_32_bits():
+    fragment = moof(1, traf(1, 2 ** 32 - 10, version=0))
+    with pytest.raises(ValueError):
+        shift_fragment(fragment, {1: 10}, 0)
+
+
+def test_shift_fragment_without_tfdt():
+    fragment = bytearray(box(b"moof", box(b"traf", full_box(b"tfhd", 0, struct.pack(">I", 1)))))
+    with pytest.raises(ValueError):
+        shift_fragment(fragment, {1: 10}, 0)
+
+
+def test_track_descriptions():
+    moov = box(b"moov", full_box(b"mvhd", 0, b"\x00" * 96),
+               trak(1, 90000, b"avc1"), trak(2, 8000, b"mp4a", version=1))
+    # The whole body of the stsd is compared
+    assert track_descriptions(moov) == {1: (90000, (b"\x00" * 4 + b"avc1").hex()),
+                                        2: (8000, (b"\x00" * 4 + b"mp4a").hex())}
+
+
+def test_track_descriptions_of_incomplete_track():
+    with pytest.raises(ValueError):
+        track_descriptions(box(b"moov", box(b"trak", full_box(b"tkhd", 0, b"\x00" * 80))))
@@ -0,0 +1,76 @@
+from datetime import datetime, time
+
+import pytest
+
+import hikload.hikvisionapi.classes as classes
+from hikload.download import parse_bandwidth
+from hikload.hikvisionapi.classes import BandwidthLimiter
+
+
+def at(monkeypatch, hour: int, minute: int = 0):
+    # Makes the limiter think it is the given time of the day
+    class FakeDatetime:
+        @staticmethod
+        def now():
+            return datetime(2021, 12, 18, hour, minute)
+    monkeypatch.setattr(classes, "datetime", FakeDatetime)
+
+
+def test_no_limit(clock):
+    limiter = BandwidthLimiter(None)
+    limiter.consume(10 ** 9)
+    assert clock.slept == []
+
+
+def test_steady_rate(clock):
+    limiter = BandwidthLimiter(1000)
+    start = clock.now
+    for _ in range(10):
+        limiter.consume(500)
+    assert clock.now - start == pytest.approx(5.0)
+
+
+def test_burst_is_at_most_one_second(clock):
+    limiter = BandwidthLimiter(1000)
+    clock.advance(60)
+    limiter.consume(1000)
+    assert clock.slept == []
+    limiter.consume(1000)
+    assert clock.slept == [pytest.approx(1.0)]
+
+
+def test_large_chunks_go_into_debt(clock):
+    limiter = BandwidthLimiter(1000)
+    clock.advance(60)
+    assert limiter.reserve(3000) == pytest.approx(2.0)
+    # The next worker waits for the debt of the first one
+    assert limiter.reserve(1000) == pytest.approx(3.0)
+    clock.advance(3)
+    assert limiter.reserve(0) == 0
+
+
+def test_workers_share_the_bucket(clock):
+    limiter = BandwidthLimiter(1000)
+    delays = [limiter.reserve(250) for _ in range(4)]
+    assert delays == [pytest.approx(0.25 * i) for i in range(1, 5)]
+
+
+def test_schedule(clock, monkeypatch):
+    limiter = BandwidthLimiter(1000, [(time(8), time(18), 100), (time(22), time(6), None)])
+    at(monkeypatch, 12)
+    assert limiter.currentRate() == 100
+    at(monkeypatch, 20)
+    assert limiter.currentRate() == 1000
+    # The window passes midnight
+    at(monkeypatch, 23, 30)
+    assert limiter.currentRate() is None
+    at(monkeypatch, 5, 59)
+    assert limiter.currentRate() is None
+    at(monkeypatch, 6)
+    assert limiter.currentRate() == 1000
+
+
+def test_parse_bandwidth():
+    assert parse_bandwidth("2M") == (2 * 1024 * 1024, [])
+    assert parse_bandwidth("500K,08:00-18:00=1.5M,22:00-06:00=0") == (
+        500 * 1024, [(time(8), time(18), int(1.5 * 1024 * 1024)), (time(22), time(6), None)])
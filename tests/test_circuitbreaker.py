@@ -0,0 +1,76 @@
+import pytest
+
+from hikload.hikvisionapi.classes import CircuitBreaker, HikvisionException
+
+
+def test_closed_until_the_threshold(clock):
+    breaker = CircuitBreaker("dvr", threshold=3, timeout=30)
+    for _ in range(2):
+        breaker.before()
+        breaker.failed()
+    breaker.before()
+
+
+def test_success_resets_the_failures(clock):
+    breaker = CircuitBreaker("dvr", threshold=3, timeout=30)
+    breaker.failed()
+    breaker.failed()
+    breaker.succeeded()
+    breaker.failed()
+    breaker.failed()
+    breaker.before()
+
+
+def test_opens_after_threshold_failures(clock):
+    breaker = CircuitBreaker("dvr", threshold=3, timeout=30)
+    for _ in range(3):
+        breaker.failed()
+    with pytest.raises(HikvisionException, match="dvr is not responding"):
+        breaker.before()
+    clock.advance(29)
+    with pytest.raises(HikvisionException, match="for 1 more seconds"):
+        breaker.before()
+
+
+def test_half_open_lets_one_request_through(clock):
+    breaker = CircuitBreaker("dvr", threshold=3, timeout=30)
+    for _ in range(3):
+        breaker.failed()
+    clock.advance(30)
+    breaker.before()
+    # The other requests wait for the one that was let through
+    with pytest.raises(HikvisionException):
+        breaker.before()
+
+
+def test_half_open_closes_after_a_success(clock):
+    breaker = CircuitBreaker("dvr", threshold=3, timeout=30)
+    for _ in range(3):
+        breaker.failed()
+    clock.advance(30)
+    breaker.before()
+    breaker.succeeded()
+    for _ in range(3):
+        breaker.before()
+    assert breaker.failures == 0
+
+
+def test_half_open_opens_again_after_a_failure(clock):
+    breaker = CircuitBreaker("dvr", threshold=3, timeout=30)
+    for _ in range(3):
+        breaker.failed()
+    clock.advance(30)
+    breaker.before()
+    breaker.failed()
+    clock.advance(29)
+    with pytest.raises(HikvisionException):
+        breaker.before()
+    clock.advance(1)
+    breaker.before()
+
+
+def test_disabled_with_no_threshold(clock):
+    breaker = CircuitBreaker("dvr", threshold=0)
+    for _ in range(100):
+        breaker.failed()
+    breaker.before()
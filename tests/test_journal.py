@@ -0,0 +1,75 @@
+import os
+from datetime import timedelta
+
+from hikload.download import video_duration
+from hikload.journal import JOURNAL_NAME, DownloadJournal
+
+
+def saved(path, data: bytes = b"video" * 100) -> str:
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_resumes_from_another_run(tmp_path):
+    video = saved(tmp_path / "video.mp4")
+    DownloadJournal.forFolder(str(tmp_path)).record("uri", "download", video, duration=timedelta(seconds=60))
+    assert (tmp_path / JOURNAL_NAME).exists()
+
+    # A new run opens the same journal
+    entry = DownloadJournal.forFolder(str(tmp_path)).verified("uri", "download", video)
+    assert entry.path == video
+    assert entry.size == os.path.getsize(video)
+    assert entry.duration == timedelta(seconds=60)
+    assert entry.checksum is not None
+
+
+def test_stages_are_separate(tmp_path):
+    journal = DownloadJournal.forFolder(str(tmp_path))
+    journal.record("uri", "download", saved(tmp_path / "video.mp4"))
+    assert journal.verified("uri", "video") is None
+    assert journal.verified("other", "download") is None
+
+
+def test_record_replaces_the_stage(tmp_path):
+    journal = DownloadJournal.forFolder(str(tmp_path))
+    journal.record("uri", "download", saved(tmp_path / "a.mp4"))
+    journal.record("uri", "download", saved(tmp_path / "b.mp4"))
+    assert journal.get("uri", "download").path == str(tmp_path / "b.mp4")
+
+
+def test_changed_files_are_saved_again(tmp_path):
+    journal = DownloadJournal.forFolder(str(tmp_path))
+    video = saved(tmp_path / "video.mp4")
+    journal.record("uri", "download", video)
+    with open(video, "ab") as f:
+        f.write(b"more")
+    assert journal.verified("uri", "download") is None
+
+
+def test_missing_or_moved_files_are_saved_again(tmp_path):
+    journal = DownloadJournal.forFolder(str(tmp_path))
+    video = saved(tmp_path / "video.mp4")
+    journal.record("uri", "download", video)
+    assert journal.verified("uri", "download", str(tmp_path / "elsewhere.mp4")) is None
+    os.remove(video)
+    assert journal.verified("uri", "download") is None
+
+
+def test_verify_finds_corrupted_files(tmp_path):
+    journal = DownloadJournal.forFolder(str(tmp_path))
+    video = saved(tmp_path / "video.mp4")
+    entry = journal.record("uri", "download", video)
+    # The same size and modification time, but not the same data
+    saved(tmp_path / "video.mp4", b"VIDEO" * 100)
+    os.utime(video, (entry.mtime, entry.mtime))
+    assert journal.verified("uri", "download") is not None
+    assert journal.verified("uri", "download", verify=True) is None
+
+
+def test_journaled_duration_of_processed_videos():
+    # The recording is cut to --seconds before --skipseconds are skipped, like processSavedVideo
+    assert video_duration(timedelta(seconds=100), 10, 30) == timedelta(seconds=20)
+    assert video_duration(timedelta(seconds=20), 10, 30) == timedelta(seconds=10)
+    assert video_duration(timedelta(seconds=5), 10, 30) == timedelta(0)
+    assert video_duration(timedelta(seconds=100), None, None) == timedelta(seconds=100)
+    assert video_duration(None, 10, 30) is None
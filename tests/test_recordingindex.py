@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+from hikload.hikvisionapi import SearchMatch
+from hikload.recordingindex import RecordingIndex
+
+
+def match(cid, start: str, end: str) -> SearchMatch:
+    return SearchMatch(trackID=str(cid), startTime=start, endTime=end,
+                       playbackURI="rtsp://dvr/Streaming/tracks/%s/?starttime=%s" % (cid, start),
+                       contentType="video")
+
+
+FIRST = match(101, "2021-12-18T00:00:00Z", "2021-12-18T01:00:00Z")
+SECOND = match(101, "2021-12-18T01:00:00Z", "2021-12-18T01:30:00Z")
+
+
+def test_never_indexed(tmp_path):
+    index = RecordingIndex(str(tmp_path / "index.db"))
+    assert index.sync_start("dvr", 101) is None
+    assert index.query("dvr", 101) == []
+
+
+def test_resumes_before_the_last_recording(tmp_path):
+    path = str(tmp_path / "index.db")
+    index = RecordingIndex(path, overlap=timedelta(minutes=10))
+    index.update("dvr", 101, None, [FIRST, SECOND])
+    index.close()
+
+    # A new run only searches the DVR after the indexed recordings, with some overlap
+    index = RecordingIndex(path, overlap=timedelta(minutes=10))
+    assert index.sync_start("dvr", 101) == datetime(2021, 12, 18, 1, 20)
+    assert index.query("dvr", 101) == [FIRST, SECOND]
+    assert index.sync_start("dvr", 102) is None
+    assert index.sync_start("other", 101) is None
+
+
+def test_sync_replaces_the_searched_interval(tmp_path):
+    index = RecordingIndex(str(tmp_path / "index.db"), overlap=timedelta(minutes=10))
+    # The second recording was still being written during the first sync
+    index.update("dvr", 101, None, [FIRST, SECOND._replace(endTime="2021-12-18T01:10:00Z")])
+    since = index.sync_start("dvr", 101)
+    third = match(101, "2021-12-18T01:30:00Z", "2021-12-18T02:00:00Z")
+    index.update("dvr", 101, since, [SECOND, third])
+    assert index.query("dvr", 101) == [FIRST, SECOND, third]
+
+
+def test_query_overlapping_recordings(tmp_path):
+    index = RecordingIndex(str(tmp_path / "index.db"))
+    index.update("dvr", 101, None, [SECOND, FIRST])
+    assert index.query("dvr", 101, "2021-12-18T00:30:00Z", "2021-12-18T00:45:00Z") == [FIRST]
+    assert index.query("dvr", 101, "2021-12-18T00:30:00Z") == [FIRST, SECOND]
+    assert index.query("dvr", 101, endTime="2021-12-18T01:00:00Z") == [FIRST]
+    assert index.query("dvr", 101, "2021-12-18T01:30:00Z") == []
@@ -0,0 +1,60 @@
+import io
+import shutil
+
+import ffmpeg
+import pytest
+
+from hikload.hikvisionapi.remux import PSRemuxer, RemuxError, remuxVideoStream
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+
+
+def make_program_stream(path, bframes: int, codec: str = "libx264"):
+    # A program stream like the one of a DVR, with reordered frames and audio that is left out
+    video = ffmpeg.input("testsrc=size=320x240:rate=25", f="lavfi", t=10)
+    audio = ffmpeg.input("sine=sample_rate=48000", f="lavfi", t=10)
+    options = {"bf": bframes} if codec == "libx264" else {"x265-params": "log-level=error:bframes=%d" % bframes}
+    try:
+        ffmpeg.output(video, audio, str(path), vcodec=codec, acodec="mp2", g=50, f="vob", **options) \
+            .global_args("-loglevel", "error").run(overwrite_output=True, capture_stderr=True)
+    except ffmpeg.Error:
+        pytest.skip("ffmpeg cannot encode %s" % codec)
+
+
+def frame_hashes(path) -> list:
+    # The hashes of the decoded frames of the video, with their presentation times
+    out, _ = ffmpeg.input(str(path)).output("pipe:", map="0:v", f="framemd5") \
+        .global_args("-loglevel", "error").run(capture_stdout=True)
+    lines = [line.split(",") for line in out.decode().splitlines() if not line.startswith("#")]
+    return [(line[1].strip(), line[5].strip()) for line in lines]
+
+
+def remux(source, output, chunkSize: int = 4096):
+    data = source.read_bytes()
+    remuxVideoStream((data[i:i + chunkSize] for i in range(0, len(data), chunkSize)), str(output))
+
+
+@pytest.mark.parametrize("codec, bframes", [("libx264", 0), ("libx264", 2), ("libx264", 3), ("libx265", 3)])
+def test_remux_keeps_every_frame(tmp_path, codec, bframes):
+    source = tmp_path / "source.ps"
+    output = tmp_path / "output.mp4"
+    make_program_stream(source, bframes, codec)
+    remux(source, output)
+    source_frames = frame_hashes(source)
+    assert len(source_frames) == 250
+    assert [md5 for _, md5 in frame_hashes(output)] == [md5 for _, md5 in source_frames]
+
+
+def test_remux_reorders_untimed_frames(tmp_path):
+    # Most frames of the stream have no timestamps, so their presentation times must
+    # come from their picture order count instead
+    source = tmp_path / "source.ps"
+    output = tmp_path / "output.mp4"
+    make_program_stream(source, 2)
+    remux(source, output, chunkSize=1000)
+    assert frame_hashes(output) == frame_hashes(source)
+
+
+def test_remux_without_video():
+    with pytest.raises(RemuxError):
+        PSRemuxer(io.BytesIO()).close()